@@ -0,0 +1,109 @@
+import math
+import numpy as np
+
+
+# Daily bars are compared, since corporate actions take effect from one day to the next
+COMPARISON_BAR_SIZE = '1 day'
+# Days before the last comparison which the next one reaches back, so that it always starts from a known ratio
+COMPARISON_OVERLAP = 7 * 86400
+# Smallest change of the adjusted to raw ratio which is taken as a corporate action, on top of the price rounding
+ADJUSTMENT_TOLERANCE = 1e-4
+PRICE_INCREMENT = 0.01
+PRICE_FIELDS = ['open', 'high', 'low', 'close', 'average']
+SECONDS_PER_DAY = 86400
+
+
+def getDurationString(lower, upper):
+    """
+    ADJUSTED_LAST requests must end now, so the comparison window is a duration back from upper
+    :param lower: (int) Epoch seconds the window has to reach back to
+    :param upper: (int) Epoch seconds
+    :return: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_duration
+    """
+    days = math.ceil((upper - lower) / SECONDS_PER_DAY) + 1
+    return '%d D' % days if days <= 365 else '%d Y' % math.ceil(days / 365)
+
+
+def getComparisonStart(db, symbol, headTimestamp):
+    """
+    :param db: (databases.IBHistoricalDatabase) Connected database of the TRADES bars
+    :param symbol: (str)
+    :param headTimestamp: (int) Epoch seconds of the earliest TRADES data point IB has
+    :return: (int) Epoch seconds the next comparison window has to reach back to: a little before the last one, or
+             the whole history when the symbol was never compared
+    """
+    _, checked, _ = db.getCoverage(symbol, 'ADJUSTED_LAST', COMPARISON_BAR_SIZE)
+    return headTimestamp if checked is None else max(checked - COMPARISON_OVERLAP, headTimestamp)
+
+
+def getCoveredUntil(ranges, start):
+    """
+    :param ranges: (list) Sorted (startEpoch, endEpoch) ranges of the daily TRADES bars stored
+    :param start: (int) Epoch seconds of the first day of a comparison window
+    :return: (int) Epoch seconds up to which daily TRADES bars are stored from start on without a gap, or None when
+             start itself is not covered. Bars are dated at midnight but ranges start when requested, hence a day of
+             slack.
+    """
+    for rangeStart, rangeEnd in ranges:
+        if rangeStart <= start + SECONDS_PER_DAY and rangeEnd >= start:
+            return rangeEnd
+    return None
+
+
+def findFactors(epochs, closes, adjustedCloses):
+    """
+    Finds the corporate actions of a comparison window. IB's adjusted closes are the raw closes times the product of
+    the factors of every dividend and split after them, so the ratio of the two steps on each ex-date.
+    :param epochs: (np.ndarray) Epoch seconds of the daily bars found in both series, sorted
+    :param closes: (np.ndarray) TRADES closes
+    :param adjustedCloses: (np.ndarray) ADJUSTED_LAST closes
+    :return: (tuple) Epoch seconds of each ex-date, and its factor, e.g. 0.5 for a 2 for 1 split
+    """
+    ratios = adjustedCloses / closes
+    steps = np.abs(np.diff(np.log(ratios)))
+    # Both series are rounded to a price increment, which moves their ratio by up to an increment over each price.
+    # Adjusted closes far back in history can be a fraction of the raw ones, so their rounding usually dominates
+    thresholds = ADJUSTMENT_TOLERANCE + PRICE_INCREMENT / np.minimum(closes[1:], closes[:-1]) + \
+        PRICE_INCREMENT / np.minimum(adjustedCloses[1:], adjustedCloses[:-1])
+    events = np.flatnonzero(steps > thresholds)
+    return epochs[events + 1], ratios[events] / ratios[events + 1]
+
+
+def getCumulativeFactors(epochs, exEpochs, factors):
+    """
+    :param epochs: (np.ndarray) Epoch seconds of each bar
+    :param exEpochs: (np.ndarray) Epoch seconds of each ex-date
+    :param factors: (np.ndarray) Factor of each ex-date
+    :return: (np.ndarray) Product of the factors of every ex-date after each bar
+    """
+    order = np.argsort(exEpochs)
+    # Suffix products, with 1 for bars on or after the last ex-date
+    cumulative = np.append(np.cumprod(np.asarray(factors, dtype=np.float64)[order][::-1])[::-1], 1.)
+    return cumulative[np.searchsorted(np.asarray(exEpochs)[order], epochs, side='right')]
+
+
+def adjust(epochs, values, exEpochs, factors):
+    """
+    :param epochs: (np.ndarray) Epoch seconds of each bar
+    :param values: (dict) One array per field
+    :return: (dict) values with the fields of PRICE_FIELDS adjusted, the others as they are
+    """
+    cumulative = getCumulativeFactors(epochs, exEpochs, factors)
+    return {field: array * cumulative if field in PRICE_FIELDS else array for field, array in values.items()}
+
+
+def loadAdjustedBars(db, symbol, barSize, fields, start=None, end=None):
+    """
+    Derives ADJUSTED_LAST bars of any bar size from the stored TRADES bars and the factor table
+    :param db: (databases.IBHistoricalDatabase) Connected database of the TRADES bars
+    :param symbol: (str)
+    :param barSize: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
+    :param fields: (list of str) Columns to read besides epoch. Volumes are left as traded
+    :param start: (int) Epoch seconds of the first bar, or None for the earliest
+    :param end: (int) Epoch seconds of the last bar, or None for the latest
+    :return: (tuple) Epoch seconds of each bar, and one array per field
+    """
+    bars = np.array(db.getBars(symbol, barSize, fields, start, end), dtype=np.float64).reshape(-1, len(fields) + 1)
+    epochs = bars[:, 0].astype(np.int64)
+    exEpochs, factors = db.getAdjustments(symbol)
+    return epochs, adjust(epochs, {field: bars[:, i + 1] for i, field in enumerate(fields)}, exEpochs, factors)
@@ -0,0 +1,163 @@
+import numpy as np
+
+
+BAR_SIZE_SECONDS = {
+    '1 secs': 1,
+    '5 secs': 5,
+    '10 secs': 10,
+    '15 secs': 15,
+    '30 secs': 30,
+    '1 min': 60,
+    '2 mins': 120,
+    '3 mins': 180,
+    '5 mins': 300,
+    '10 mins': 600,
+    '15 mins': 900,
+    '20 mins': 1200,
+    '30 mins': 1800,
+    '1 hour': 3600,
+}
+# Bar sizes of volume bars are their threshold followed by this, e.g. '1000 volume'
+VOLUME_BAR_SUFFIX = ' volume'
+
+
+def isVolumeBarSize(barSize):
+    return barSize.endswith(VOLUME_BAR_SUFFIX)
+
+
+class CompletedBars:
+    """
+    Bars completed at the same time, one entry per row of the QuoteStore they belong to. Time bars are dated by the
+    epoch second they start, volume bars by the epoch seconds of their first trade, fractions included, and numbered
+    from 0 among bars of the same symbol starting at that very time.
+    """
+    def __init__(self, barSize, epochs, rows, open, high, low, close, volume, barCount, average):
+        self.barSize = barSize
+        self.epochs = epochs
+        self.rows = rows
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.barCount = barCount
+        self.average = average
+        self.sequences = None
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class BarAggregator:
+    """
+    Running OHLCV state for every row of a QuoteStore, so memory per symbol stays constant however many ticks arrive.
+    """
+    def __init__(self, barSize, capacity):
+        self.barSize = barSize
+        self.open = np.full(capacity, np.nan)
+        self.high = np.full(capacity, np.nan)
+        self.low = np.full(capacity, np.nan)
+        self.close = np.full(capacity, np.nan)
+        self.volume = np.zeros(capacity)
+        self.notional = np.zeros(capacity)
+        self.barCount = np.zeros(capacity, dtype=np.int64)
+        self.epochs = np.zeros(capacity, dtype=np.int64)
+
+    def add(self, row, price, size, epoch):
+        if self.barCount[row] == 0:
+            self.open[row] = self.high[row] = self.low[row] = price
+            self.epochs[row] = epoch
+        else:
+            self.high[row] = max(self.high[row], price)
+            self.low[row] = min(self.low[row], price)
+        self.close[row] = price
+        self.volume[row] += size
+        self.notional[row] += price * size
+        self.barCount[row] += 1
+
+    def reset(self, row):
+        self.volume[row] = 0.
+        self.notional[row] = 0.
+        self.barCount[row] = 0
+
+    def complete(self, rows, epochs):
+        volume = self.volume[rows]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            average = np.where(volume > 0, self.notional[rows] / volume, self.close[rows])
+        bars = CompletedBars(self.barSize, epochs, rows, self.open[rows], self.high[rows], self.low[rows],
+                             self.close[rows], volume, self.barCount[rows], average)
+
+        self.volume[rows] = 0.
+        self.notional[rows] = 0.
+        self.barCount[rows] = 0
+        return bars
+
+
+class TimeBarAggregator(BarAggregator):
+    """
+    Builds bars on clock boundaries which are shared by all symbols, so every symbol's bar closes in one vectorized
+    step when the first trade of the next interval arrives, or when roll is called by a timer.
+    """
+    def __init__(self, barSize, capacity):
+        super(TimeBarAggregator, self).__init__(barSize, capacity)
+        self.interval = BAR_SIZE_SECONDS[barSize]
+        self.barStart = None
+
+    def update(self, row, price, size, epoch):
+        """
+        :param row: (int) Row of the symbol in the QuoteStore
+        :param price: (float) Trade price
+        :param size: (float) Trade size
+        :param epoch: (float) Epoch seconds of the trade
+        :return: (CompletedBars) Bars closed by this trade, or None
+        """
+        completed = self.roll(epoch)
+        if self.barStart is None:
+            self.barStart = int(epoch) - int(epoch) % self.interval
+        self.add(row, price, size, epoch)
+        return completed
+
+    def roll(self, epoch):
+        """
+        :param epoch: (float) Epoch seconds now
+        :return: (CompletedBars) Bars of the interval which ended before epoch, or None
+        """
+        if self.barStart is None or epoch < self.barStart + self.interval:
+            return None
+        rows = np.flatnonzero(self.barCount)
+        completed = self.complete(rows, np.full(len(rows), self.barStart, dtype=np.int64))
+        self.barStart = None
+        return completed if len(completed) else None
+
+
+class VolumeBarAggregator(BarAggregator):
+    """
+    Closes a symbol's bar once it has traded at least threshold shares. Several volume bars can start within the same
+    second, so they keep the time of their first trade to the fraction of a second and are stored apart from time
+    bars, see databases.CREATE_VOLUME_BAR_SCRIPT.
+    """
+    def __init__(self, threshold, capacity):
+        super(VolumeBarAggregator, self).__init__('%d%s' % (threshold, VOLUME_BAR_SUFFIX), capacity)
+        self.threshold = threshold
+        self.times = np.full(capacity, np.nan)
+        self.sequences = np.zeros(capacity, dtype=np.int64)
+
+    def update(self, row, price, size, epoch):
+        if self.barCount[row] == 0:
+            # Trades received at once share their time, so their bars are told apart by their sequence
+            self.sequences[row] = self.sequences[row] + 1 if epoch == self.times[row] else 0
+            self.times[row] = epoch
+        self.add(row, price, size, epoch)
+        if self.volume[row] < self.threshold:
+            return None
+        rows = np.array([row])
+        bars = self.complete(rows, self.times[rows])
+        bars.sequences = self.sequences[rows]
+        return bars
+
+    def reset(self, row):
+        super(VolumeBarAggregator, self).reset(row)
+        self.times[row] = np.nan
+
+    def roll(self, epoch):
+        return None
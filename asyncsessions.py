@@ -0,0 +1,460 @@
+import time
+import dates
+import asyncio
+import buffers
+import logging
+import metrics
+import handlers
+import planners
+import threading
+import databases
+import adjustments
+import schedulers
+from ibapi import comm
+from collections import deque
+from ibapi.client import EClient
+from ibapi.wrapper import EWrapper
+from ibapi.utils import iswrapper, BadMessage
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds a request may stay in flight, counted from when the PacingScheduler sends it
+REQUEST_TIMEOUT = 60.
+
+
+class IBError(Exception):
+    def __init__(self, reqId, errorCode, errorString):
+        super(IBError, self).__init__('#Request %d: %d %s' % (reqId, errorCode, errorString))
+        self.reqId = reqId
+        self.errorCode = errorCode
+        self.errorString = errorString
+
+
+class LoopQueue:
+    """
+    Stands in for EClient.msg_queue. The EReader thread puts messages from the socket here and they are decoded on
+    the event loop, so callbacks run in the loop without a thread polling a queue.
+    """
+    def __init__(self, loop, process):
+        self.loop = loop
+        self.process = process
+        self.messages = deque()
+        self.lock = threading.Lock()
+        self.scheduled = False
+
+    def put(self, msg):
+        self.messages.append(msg)
+        with self.lock:
+            if self.scheduled:
+                return
+            self.scheduled = True
+        # One wakeup of the loop drains every message which arrived in the meantime
+        self.loop.call_soon_threadsafe(self.drain)
+
+    def drain(self):
+        with self.lock:
+            self.scheduled = False
+        while self.messages:
+            self.process(self.messages.popleft())
+
+    def empty(self):
+        return not self.messages
+
+    def qsize(self):
+        return len(self.messages)
+
+
+class IBAsyncSession(EWrapper, EClient):
+    """
+    asyncio facade over EClient. Every request returns an awaitable resolved by its callbacks, keyed by reqId, so
+    chains such as headTimestamp -> historicalData are written as plain coroutines and any number of them run
+    concurrently in one loop, paced by a PacingScheduler.
+    """
+    def __init__(self, scheduler=None):
+        """
+        :param scheduler: (schedulers.PacingScheduler) Paces the requests, e.g. against a budget shared with other
+                          processes. Defaults to one of its own
+        """
+        EWrapper.__init__(self)
+        EClient.__init__(self, wrapper=self)
+        self.reqId = 0
+        self.loop = None
+        self.cache = databases.ContractCacheDatabase()
+        self.scheduler = scheduler or schedulers.PacingScheduler()
+        self.timer = metrics.RequestTimer()
+        self.wakeup = None
+        self.pumpTask = None
+        self.futures = {}
+        self.timers = {}
+        self.bars = {}
+        self.streams = {}
+        self.contractRequests = {}
+
+    def getNextId(self):
+        self.reqId += 1
+        return self.reqId
+
+    async def connectAsync(self, host, port, clientId):
+        """
+        Connects without blocking the loop, then starts sending queued requests
+        :return: Nothing
+        """
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.msg_queue = LoopQueue(self.loop, self.process)
+        await self.loop.run_in_executor(None, self.connect, host, port, clientId)
+        if not self.isConnected():
+            raise ConnectionError('Could not connect to %s:%d' % (host, port))
+        logger.info('Interactive Brokers is connected.')
+        metrics.IN_FLIGHT.labels(str(clientId)).setFunction(lambda: len(self.scheduler.inFlight))
+        metrics.QUEUED.labels(str(clientId)).setFunction(lambda: len(self.scheduler))
+        self.cache.connect()
+        self.pumpTask = self.loop.create_task(self.pump())
+
+    async def disconnectAsync(self):
+        self.disconnect()
+        if self.pumpTask:
+            await self.pumpTask
+
+    def process(self, msg):
+        try:
+            self.decoder.interpret(comm.read_fields(msg))
+        except BadMessage:
+            logger.warning('Bad message from IB: %s', msg)
+
+    async def pump(self):
+        # Sends queued requests as soon as IB's pacing rules allow
+        while self.isConnected():
+            self.wakeup.clear()
+            self.scheduler.dispatch()
+            wait = self.scheduler.nextWakeup()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), 1. if wait is None else min(wait, 1.))
+            except asyncio.TimeoutError:
+                pass
+
+        # Nothing pending can be answered any more
+        for reqId in list(self.futures):
+            self.fail(reqId, ConnectionError('Disconnected from IB'))
+        for stream in self.streams.values():
+            stream.put_nowait(ConnectionError('Disconnected from IB'))
+
+    def fail(self, reqId, exception):
+        future = self.futures.pop(reqId, None)
+        self.bars.pop(reqId, None)
+        if future is not None and not future.done():
+            future.set_exception(exception)
+
+    def resolve(self, reqId, result):
+        future = self.futures.pop(reqId, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    async def request(self, reqId, contract, whatToShow, identicalKey, send, cancel, requestType,
+                      timeout=REQUEST_TIMEOUT):
+        """
+        Queues a request in the PacingScheduler and waits for its answer
+        :param send: (callable) Sends the request to IB
+        :param cancel: (callable) Cancels it at IB, taking its reqId
+        :param requestType: (str) Name of the request in metrics, e.g. 'historicalData'
+        :param timeout: (float) Seconds the request may stay in flight before it is cancelled, or None
+        :return: Whatever the callbacks resolve the request with
+        """
+        future = self.loop.create_future()
+        self.futures[reqId] = future
+
+        def sendWithTimeout():
+            self.timer.start(reqId, requestType, contract.symbol)
+            send()
+            if timeout is not None:
+                # A request resent after a pacing violation gets a fresh timeout
+                if reqId in self.timers:
+                    self.timers[reqId].cancel()
+                self.timers[reqId] = self.loop.call_later(timeout, self.expire, reqId, cancel, timeout)
+
+        key = schedulers.contractKey(contract, whatToShow)
+        self.scheduler.submit(reqId, key, (key,) + identicalKey, sendWithTimeout)
+        self.wakeup.set()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if self.scheduler.cancel(reqId):
+                cancel(reqId)
+            raise
+        finally:
+            self.futures.pop(reqId, None)
+            self.bars.pop(reqId, None)
+            self.timer.discard(reqId)
+            if reqId in self.timers:
+                self.timers.pop(reqId).cancel()
+            self.wakeup.set()
+
+    def sendMessage(self, send):
+        # Requests other than historical data only count against the message rate
+        self.scheduler.submitMessage(send)
+        self.wakeup.set()
+
+    def expire(self, reqId, cancel, timeout):
+        if reqId in self.futures and self.scheduler.complete(reqId):
+            logger.warning('#Request %d: No answer after %.0f seconds, cancelling', reqId, timeout)
+            cancel(reqId)
+            self.fail(reqId, asyncio.TimeoutError('#Request %d timed out' % reqId))
+            self.wakeup.set()
+
+    async def resolveContract(self, contract, timeout=REQUEST_TIMEOUT):
+        """
+        Fills in conId and primaryExchange, from databases.ContractCacheDatabase or else from IB
+        :param contract: (contracts.Contract) My custom-made Contract object
+        :return: Nothing
+        """
+        if self.cache.resolveContract(contract):
+            return
+        reqId = self.getNextId()
+        future = self.loop.create_future()
+        self.futures[reqId] = future
+        self.contractRequests[reqId] = contract
+        logger.info('#Request %d: Requesting contractDetails for %s', reqId, contract.symbol)
+        self.sendMessage(lambda: self.reqContractDetails(reqId, contract))
+        try:
+            await asyncio.wait_for(future, timeout)
+        finally:
+            self.futures.pop(reqId, None)
+            self.contractRequests.pop(reqId, None)
+
+    async def getHeadTimeStamp(self, contract, whatToShow, useRTH=True, timeout=REQUEST_TIMEOUT):
+        """
+        :param contract: (contracts.Contract) My custom-made Contract object
+        :param whatToShow: (str) https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_what_to_show
+        :param useRTH: (Boolean) True or False
+        :return: (int) Epoch seconds of the earliest data IB has, cached in databases.ContractCacheDatabase
+        """
+        headTimestamp = self.cache.getHeadTimestamp(contract, whatToShow)
+        if headTimestamp is not None:
+            return headTimestamp
+
+        reqId = self.getNextId()
+        logger.info('#Request %d: Queueing headTimestamp request for %s', reqId, contract.symbol)
+        headTimestamp = await self.request(
+            reqId, contract, whatToShow, ('headTimestamp', useRTH),
+            lambda: self.reqHeadTimeStamp(reqId, contract, whatToShow, useRTH, 2), self.cancelHeadTimeStamp,
+            'headTimestamp', timeout)
+        headTimestamp = dates.toEpoch(headTimestamp)
+        self.cache.setHeadTimestamp(contract, whatToShow, headTimestamp)
+        return headTimestamp
+
+    async def requestHistoricalData(self, contract, endDateTime, durationString, barSizeSetting, whatToShow,
+                                    useRTH=True, formatDate=1, timeout=REQUEST_TIMEOUT):
+        """
+        One reqHistoricalData request
+        :param contract: (contracts.Contract) My custom-made Contract object
+        :param endDateTime: (str) Can be an empty string or date string in IB's accepted date format
+        :param durationString: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_duration
+        :param barSizeSetting: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
+        :param whatToShow: (str) https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_what_to_show
+        :param useRTH: (Boolean) True or False
+        :param formatDate: (int) 1 or 2
+        :return: (tuple) BarBuffer of the bars received, and the start and end of the range IB answered for
+        """
+        reqId = self.getNextId()
+        self.bars[reqId] = buffers.BarBuffer()
+        logger.info('#Request %d: Queueing historicalData request for %s', reqId, contract.symbol)
+        return await self.request(
+            reqId, contract, whatToShow, (endDateTime, durationString, barSizeSetting, useRTH, formatDate),
+            lambda: self.reqHistoricalData(reqId, contract, endDateTime, durationString, barSizeSetting, whatToShow,
+                                           useRTH, formatDate, False, []),
+            self.cancelHistoricalData, 'historicalData', timeout)
+
+    async def getHistoricalData(self, contract, lower, upper, barSizeSetting, whatToShow, useRTH=True, formatDate=1,
+                                timeout=REQUEST_TIMEOUT):
+        """
+        Async generator over the fewest requests covering [lower, upper], as worked out by planners.plan. The
+        requests are all queued at once and yielded as they complete; closing the generator cancels the rest.
+        :param lower: (int) Epoch seconds to fetch from
+        :param upper: (int) Epoch seconds to fetch up to
+        :return: (tuple) Per request, a BarBuffer and the start and end of the range IB answered for
+        """
+        requests = planners.plan(lower, upper, barSizeSetting, int(time.time()), useRTH)
+        logger.info('%d historicalData requests planned for %s', len(requests), contract.symbol)
+        tasks = [self.loop.create_task(self.requestHistoricalData(
+            contract, endDateTime, durationString, barSizeSetting, whatToShow, useRTH, formatDate, timeout))
+            for endDateTime, durationString in requests]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def update(self, contracts, barSizeSetting, whatToShow, useRTH=True, formatDate=1):
+        """
+        Fills the gaps in the stored bars of every contract concurrently, as IBHistoricalDataSession.start does
+        :param contracts: (list of contracts.Contract)
+        :return: (int) Number of bars saved
+        """
+        counts = await asyncio.gather(*[self.updateContract(contract, barSizeSetting, whatToShow, useRTH, formatDate)
+                                        for contract in contracts], return_exceptions=True)
+        for contract, count in zip(contracts, counts):
+            if isinstance(count, Exception):
+                logger.error('historicalData for %s failed: %s', contract.symbol, count)
+        return sum(count for count in counts if not isinstance(count, Exception))
+
+    async def updateContract(self, contract, barSizeSetting, whatToShow, useRTH=True, formatDate=1, writer=None):
+        """
+        :param writer: (databases.HistoricalBarWriter) Where bars go, defaults to the writer of whatToShow's database.
+                       Anything with upsertBars, addCoverage and updateAdjustments will do
+        :return: (int) Number of bars saved
+        """
+        if whatToShow == 'ADJUSTED_LAST':
+
+            # Derived from the TRADES bars and the factor table, see adjustments
+            count = await self.updateContract(contract, barSizeSetting, 'TRADES', useRTH, formatDate, writer)
+            await self.updateAdjustments(contract, useRTH, writer)
+            return count
+
+        await self.resolveContract(contract)
+        headTimestamp = await self.getHeadTimeStamp(contract, whatToShow, useRTH)
+
+        db = handlers.IBHistoricBarHandler.getDatabase(whatToShow)
+        writer = writer or handlers.IBHistoricBarHandler.getWriter(whatToShow)
+        db.connect()
+        _, _, ranges = db.getCoverage(contract.symbol, whatToShow, barSizeSetting)
+        db.close()
+
+        count = 0
+        for gapStart, gapEnd in planners.findGaps(ranges, headTimestamp, int(time.time())):
+            async for bars, start, end in self.getHistoricalData(contract, gapStart, gapEnd, barSizeSetting,
+                                                                 whatToShow, useRTH, formatDate):
+                writer.upsertBars(contract.symbol, barSizeSetting, bars.toRecords())
+                writer.addCoverage(contract.symbol, whatToShow, barSizeSetting, dates.toEpoch(start),
+                                   dates.toEpoch(end))
+                count += len(bars)
+        return count
+
+    async def updateAdjustments(self, contract, useRTH=True, writer=None):
+        """
+        Brings the daily TRADES bars up to date, then compares them with one ADJUSTED_LAST request reaching back a
+        little before the last comparison, so that the writer records any new dividend or split
+        :param writer: (databases.HistoricalBarWriter) Defaults to the writer of the TRADES database
+        :return: Nothing
+        """
+        writer = writer or handlers.IBHistoricBarHandler.getWriter('TRADES')
+        await self.updateContract(contract, adjustments.COMPARISON_BAR_SIZE, 'TRADES', useRTH, 1, writer)
+        headTimestamp = await self.getHeadTimeStamp(contract, 'TRADES', useRTH)
+
+        db = handlers.IBHistoricBarHandler.getDatabase('TRADES')
+        db.connect()
+        lower = adjustments.getComparisonStart(db, contract.symbol, headTimestamp)
+        db.close()
+
+        # ADJUSTED_LAST requests cannot have an endDateTime
+        bars, _, _ = await self.requestHistoricalData(
+            contract, '', adjustments.getDurationString(lower, int(time.time())), adjustments.COMPARISON_BAR_SIZE,
+            'ADJUSTED_LAST', useRTH, 1)
+        writer.updateAdjustments(contract.symbol, bars.toRecords())
+
+    async def streamMktData(self, contract, genericTickList='', snapshot=False, regulatorySnapshot=False,
+                            mktDataOptions=()):
+        """
+        Async generator over the ticks of one market data line, which is cancelled when the generator is closed
+        :return: (tuple) tickType and price or size, as sent in tickPrice, tickSize and tickGeneric
+        """
+        reqId = self.getNextId()
+        stream = asyncio.Queue()
+        self.streams[reqId] = stream
+        self.sendMessage(lambda: self.reqMktData(reqId, contract, genericTickList, snapshot, regulatorySnapshot,
+                                                 list(mktDataOptions)))
+        try:
+            while True:
+                tick = await stream.get()
+                if tick is None:
+                    return
+                if isinstance(tick, Exception):
+                    raise tick
+                yield tick
+        finally:
+            del self.streams[reqId]
+            if not snapshot and self.isConnected():
+                self.sendMessage(lambda: self.cancelMktData(reqId))
+
+    @iswrapper
+    def contractDetails(self, reqId, contractDetails):
+        super().contractDetails(reqId, contractDetails)
+        contract = self.contractRequests.get(reqId)
+        if contract is not None:
+            self.cache.setContractDetails(contract, contractDetails)
+            contract.conId = contractDetails.contract.conId
+            contract.primaryExchange = contractDetails.contract.primaryExchange
+
+    @iswrapper
+    def contractDetailsEnd(self, reqId):
+        super().contractDetailsEnd(reqId)
+        self.resolve(reqId, None)
+
+    @iswrapper
+    def headTimestamp(self, reqId, headTimestamp):
+        super().headTimestamp(reqId, headTimestamp)
+        self.scheduler.complete(reqId)
+        self.timer.end(reqId)
+        self.resolve(reqId, headTimestamp)
+
+    @iswrapper
+    def historicalData(self, reqId, bar):
+        super().historicalData(reqId, bar)
+        self.timer.answer(reqId)
+        if reqId in self.bars:
+            self.bars[reqId].append(bar)
+
+    @iswrapper
+    def historicalDataEnd(self, reqId, start, end):
+        super().historicalDataEnd(reqId, start, end)
+        self.scheduler.complete(reqId)
+        bars = self.bars.pop(reqId, None)
+        if bars is not None:
+            self.timer.end(reqId, len(bars))
+            self.resolve(reqId, (bars, start, end))
+
+    @iswrapper
+    def tickPrice(self, reqId, tickType, price, attrib):
+        super().tickPrice(reqId, tickType, price, attrib)
+        if reqId in self.streams:
+            self.streams[reqId].put_nowait((tickType, price))
+
+    @iswrapper
+    def tickSize(self, reqId, tickType, size):
+        super().tickSize(reqId, tickType, size)
+        if reqId in self.streams:
+            self.streams[reqId].put_nowait((tickType, size))
+
+    @iswrapper
+    def tickGeneric(self, reqId, tickType, value):
+        super().tickGeneric(reqId, tickType, value)
+        if reqId in self.streams:
+            self.streams[reqId].put_nowait((tickType, value))
+
+    @iswrapper
+    def tickSnapshotEnd(self, reqId):
+        super().tickSnapshotEnd(reqId)
+        if reqId in self.streams:
+            self.streams[reqId].put_nowait(None)
+
+    @iswrapper
+    def error(self, reqId, errorCode, errorString):
+        super().error(reqId, errorCode, errorString)
+        metrics.ERRORS.labels(str(errorCode)).inc()
+        if errorCode in schedulers.NOTICE_ERROR_CODES:
+            return
+
+        if schedulers.isPacingError(errorCode, errorString):
+            if self.scheduler.retry(reqId):
+                logger.warning('#Request %d: Pacing violation, request requeued', reqId)
+                self.wakeup.set()
+            return
+
+        # Any other error ends the request it belongs to
+        if reqId in self.futures:
+            self.scheduler.complete(reqId)
+            self.fail(reqId, IBError(reqId, errorCode, errorString))
+            self.wakeup.set()
+        elif reqId in self.streams:
+            self.streams[reqId].put_nowait(IBError(reqId, errorCode, errorString))
@@ -0,0 +1,119 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+TRADING_PERIODS = {'1 day': 252, '1 hour': 252 * 7, '30 mins': 252 * 13, '1 min': 252 * 390}
+
+
+def alignPanel(series, fields):
+    """
+    :param series: (list of tuples) (epochs, {field: values}) per symbol, each sorted by epoch
+    :param fields: (list of str)
+    :return: (tuple) Union of all epochs, and {field: (time, symbol) C-contiguous array} with NaN where a symbol has
+             no bar
+    """
+    epochs = np.unique(np.concatenate([symbolEpochs for symbolEpochs, _ in series] or [np.empty(0, np.int64)]))
+    panel = {field: np.full((len(epochs), len(series)), np.nan) for field in fields}
+    for i, (symbolEpochs, values) in enumerate(series):
+        times = np.searchsorted(epochs, symbolEpochs)
+        for field in fields:
+            panel[field][times, i] = values[field]
+    return epochs, panel
+
+
+def fillForward(prices):
+    # Carries the last known price over periods where a symbol has no bar, column by column
+    times = np.where(np.isnan(prices), 0, np.arange(len(prices))[:, None])
+    np.maximum.accumulate(times, axis=0, out=times)
+    return prices[times, np.arange(prices.shape[1])]
+
+
+def getRollingSum(values, window):
+    cumsum = np.cumsum(values, axis=0)
+    sums = np.full(values.shape, np.nan)
+    sums[window - 1:] = cumsum[window - 1:]
+    sums[window:] -= cumsum[:-window]
+    return sums
+
+
+def getRollingMean(prices, window):
+    # Windows which contain a NaN are NaN themselves
+    missing = getRollingSum(np.isnan(prices).astype(np.float64), window)
+    means = getRollingSum(np.nan_to_num(prices), window) / window
+    means[missing > 0] = np.nan
+    return means
+
+
+def movingAverageCrossover(prices, fast, slow):
+    """
+    Long when the fast moving average is above the slow one, flat otherwise
+    :param prices: (np.ndarray) (time, symbol) closes
+    :return: (np.ndarray) (time, symbol) signals in [-1, 1]
+    """
+    return (getRollingMean(prices, fast) > getRollingMean(prices, slow)).astype(np.float64)
+
+
+def getPositions(signals, prices, targetVol=None, window=20, maxLeverage=1.):
+    """
+    Sizes signals into portfolio weights, equally across symbols or scaled to a target volatility per symbol
+    :param signals: (np.ndarray) (time, symbol) signals in [-1, 1]
+    :param prices: (np.ndarray) (time, symbol) closes
+    :param targetVol: (float) Per period volatility each position aims for, or None for equal weights
+    :param window: (int) Lookback of the volatility estimate
+    :param maxLeverage: (float) Cap on the volatility scaling of a single position
+    :return: (np.ndarray) (time, symbol) weights
+    """
+    if targetVol is None:
+        return signals / signals.shape[1]
+
+    returns = np.zeros(prices.shape)
+    returns[1:] = prices[1:] / prices[:-1] - 1.
+    mean = getRollingMean(returns, window)
+    variance = getRollingMean(returns * returns, window) - mean * mean
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.nan_to_num(targetVol / np.sqrt(np.maximum(variance, 0.)), nan=0., posinf=0.)
+    return signals * np.clip(scale, 0., maxLeverage) / signals.shape[1]
+
+
+def evaluate(prices, positions, cost):
+    """
+    :param prices: (np.ndarray) (time, symbol) closes, forward filled
+    :param positions: (np.ndarray) (time, symbol) weights held from the close of each period to the next
+    :param cost: (float) Cost per unit of weight traded
+    :return: (np.ndarray) Portfolio return per period
+    """
+    returns = np.zeros(prices.shape)
+    returns[1:] = prices[1:] / prices[:-1] - 1.
+    positions = np.nan_to_num(positions)
+    turnover = np.abs(np.diff(positions, axis=0, prepend=0.)).sum(axis=1)
+    pnl = np.zeros(len(prices))
+    pnl[1:] = np.nansum(positions[:-1] * returns[1:], axis=1)
+    return pnl - cost * turnover
+
+
+def getStats(pnl, periodsPerYear):
+    equity = np.cumprod(1. + pnl)
+    drawdown = 1. - equity / np.maximum.accumulate(equity)
+    std = pnl.std()
+    return {
+        'totalReturn': float(equity[-1] - 1.) if len(equity) else 0.,
+        'sharpe': float(pnl.mean() / std * np.sqrt(periodsPerYear)) if std > 0 else 0.,
+        'maxDrawdown': float(drawdown.max()) if len(drawdown) else 0.,
+    }
+
+
+def runStrategy(prices, strategy, params, cost, targetVol, periodsPerYear):
+    signals = strategy(prices, **params)
+    positions = getPositions(signals, prices, targetVol)
+    return getStats(evaluate(prices, positions, cost), periodsPerYear)
+
+
+def runSweepChunk(name, shape, dtype, strategy, grid, cost, targetVol, periodsPerYear):
+    # Runs in a pool worker: the prices are read straight out of the parent's shared memory instead of unpickled
+    memory = shared_memory.SharedMemory(name=name)
+    prices = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    try:
+        return [runStrategy(prices, strategy, params, cost, targetVol, periodsPerYear) for params in grid]
+    finally:
+        del prices
+        memory.close()
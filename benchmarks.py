@@ -0,0 +1,332 @@
+import etc
+import time
+import panels
+import events
+import buffers
+import handlers
+import journals
+import databases
+import sessions
+import resource
+import tempfile
+import threading
+import contracts
+import schedulers
+import volatility
+import fakeservers
+import tracemalloc
+import numpy as np
+import pandas as pd
+import multiprocessing
+from collections import deque
+from ibapi.common import BarData, TickAttrib
+from ibapi.ticktype import TickTypeEnum
+
+
+def makeBars(n):
+    bars = []
+    for i in range(n):
+        bar = BarData()
+        bar.date = '20180102  %02d:%02d:00' % (i // 60 % 24, i % 60)
+        bar.open, bar.high, bar.low, bar.close = 100. + i, 101. + i, 99. + i, 100.5 + i
+        bar.volume, bar.barCount, bar.average = 1000 + i, 10, 100.25 + i
+        bars.append(bar)
+    return bars
+
+
+def measure(fn, *args):
+    """
+    :param fn: (callable) Function to benchmark
+    :return: (tuple) Seconds taken and peak traced memory in bytes
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def dataFramePerBar(bars):
+    # The path HistoricalDataEvent and IBHistoricBarHandler used before BarBuffer
+    frames = [
+        pd.DataFrame(index=buffers.BAR_FIELDS,
+                     data=[bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume, bar.barCount, bar.average])
+        for bar in bars]
+    return pd.concat(frames, axis=1, join='outer').T.iloc[::-1]
+
+
+def barBuffer(bars):
+    buffer = buffers.BarBuffer()
+    for bar in bars:
+        buffer.append(bar)
+    return buffer.toDataFrame(reverse=True)
+
+
+def benchmarkBarBuffer(n=20000):
+    bars = makeBars(n)
+    for name, fn in [('DataFrame per bar', dataFramePerBar), ('BarBuffer', barBuffer)]:
+        elapsed, peak = measure(fn, bars)
+        print('%-20s %12.0f bars/sec %10.2f MB peak' % (name, n / elapsed, peak / 1e6))
+
+
+def benchmarkQuoteStore(nSymbols=500, nTicks=1000000):
+    handler = handlers.IBTickHandler(nSymbols)
+    for reqId in range(nSymbols):
+        contract = contracts.Contract('STK', 'SYM%d' % reqId, 'SMART', 'USD')
+        handler.createRecord(reqId, events.TickEvent(contract, '', False, False, []))
+
+    rng = np.random.default_rng(0)
+    reqIds = rng.integers(0, nSymbols, nTicks).tolist()
+    tickTypes = rng.choice([TickTypeEnum.BID, TickTypeEnum.ASK, TickTypeEnum.LAST, TickTypeEnum.BID_SIZE,
+                            TickTypeEnum.ASK_SIZE, TickTypeEnum.LAST_SIZE], nTicks).tolist()
+    values = rng.uniform(10, 500, nTicks).tolist()
+
+    start = time.perf_counter()
+    for reqId, tickType, value in zip(reqIds, tickTypes, values):
+        handler.refreshRecord(reqId, tickType, value)
+    elapsed = time.perf_counter() - start
+    print('%-20s %12.0f ticks/sec' % ('QuoteStore update', nTicks / elapsed))
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        spreads = handler.quoteStore.values[buffers.ASK] - handler.quoteStore.values[buffers.BID]
+    elapsed = time.perf_counter() - start
+    print('%-20s %12.1f us per read of %d symbols' % ('QuoteStore snapshot', elapsed * 1000, len(spreads)))
+
+
+def benchmarkImpliedVols(n=1000000):
+    rng = np.random.default_rng(0)
+    spots = rng.uniform(50, 150, n)
+    strikes = rng.uniform(40, 200, n)
+    times = rng.uniform(1 / 365, 2, n)
+    isCall = rng.random(n) < 0.5
+    prices = volatility.getPrices(spots, strikes, times, rng.uniform(0.05, 1.5, n), isCall)
+
+    start = time.perf_counter()
+    vols = volatility.getImpliedVols(prices, spots, strikes, times, isCall)
+    elapsed = time.perf_counter() - start
+    print('%-20s %12.0f contracts/min, %.1f%% solved' % ('Implied vols', n / elapsed * 60,
+                                                          100 * np.isfinite(vols).mean()))
+
+    start = time.perf_counter()
+    volatility.getImpliedVols(prices * 1.001, spots, strikes, times, isCall, guesses=vols)
+    elapsed = time.perf_counter() - start
+    print('%-20s %12.0f contracts/min' % ('Warm implied vols', n / elapsed * 60))
+
+
+def runServer(ports, kwargs):
+    server = fakeservers.FakeTWSServer(**kwargs)
+    ports.put(server.port)
+    server.serveForever()
+
+
+def startServer(**kwargs):
+    """
+    Starts a fakeservers.FakeTWSServer in its own process, so that it competes with the session under test for
+    neither the GIL nor memory
+    :return: (tuple) The server's process and port
+    """
+    context = multiprocessing.get_context('spawn')
+    ports = context.Queue()
+    process = context.Process(target=runServer, args=(ports, kwargs), name='FakeTWSServer', daemon=True)
+    process.start()
+    return process, ports.get()
+
+
+def report(name, count, elapsed, unit, latencies):
+    latencies = np.array(latencies) * 1e6
+    print('%-20s %12.0f %s/sec  p50 %8.1f us  p99 %8.1f us  %8.1f MB peak RSS' % (
+        name, count / elapsed, unit, np.percentile(latencies, 50), np.percentile(latencies, 99),
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+def benchmarkHistoricalSession(nSymbols=50, barSizeSetting='1 min', days=30, maxRequests=1000, window=10):
+    """
+    Backfills nSymbols from the stand-in through IBHistoricalDataSession.start, timing each batch from its
+    historicalDataEnd callback until the writer committed it. IB's 60 requests per 10 minutes are scaled up to
+    maxRequests per window on both ends.
+    """
+    etc.PATH = tempfile.mkdtemp()
+    process, port = startServer(headTimestamp=int(time.time()) - days * 86400, maxRequests=maxRequests, window=window)
+    session = sessions.IBHistoricalDataSession('127.0.0.1', port, 1)
+    session.scheduler = schedulers.PacingScheduler(
+        globalLimiter=schedulers.SlidingWindowLimiter(maxRequests, window))
+
+    received = {}
+    latencies = []
+    counts = []
+    historicalDataEnd = session.historicalDataEnd
+
+    def onEnd(reqId, start, end):
+        symbol = session.historicBarHandler.records[reqId].contract.symbol
+        received.setdefault(symbol, deque()).append(time.perf_counter())
+        historicalDataEnd(reqId, start, end)
+
+    def onWrite(tblName, barSize, epochs, records):
+        latencies.append(time.perf_counter() - received[tblName].popleft())
+        counts.append(len(records))
+
+    session.historicalDataEnd = onEnd
+    handlers.IBHistoricBarHandler.getWriter('TRADES').addListener(onWrite)
+
+    universe = [contracts.Contract('STK', 'SYM%d' % i, 'SMART', 'USD') for i in range(nSymbols)]
+    start = time.perf_counter()
+    thread = threading.Thread(target=session.start, args=(universe, barSizeSetting, 'TRADES', True, 1, False, []),
+                              daemon=True)
+    thread.start()
+
+    # Done once nothing is queued, in flight or waiting for its answer, twice in a row
+    idle = 0
+    while idle < 2:
+        time.sleep(0.05)
+        busy = len(session.scheduler) or session.scheduler.inFlight or session.historicBarHandler.records
+        idle = 0 if busy or not counts else idle + 1
+    handlers.IBHistoricBarHandler.getWriter('TRADES').flush()
+    elapsed = time.perf_counter() - start
+
+    session.disconnect()
+    thread.join()
+    process.terminate()
+    report('Historical session', sum(counts), elapsed, 'bars', latencies)
+
+
+def benchmarkLiveSession(nSymbols=100, seconds=5., tickRate=50000):
+    """
+    Streams ticks from the stand-in into IBLiveSession.getMktData subscriptions building 1 second bars, timing each
+    message from its decoding through the tickPrice and tickSize callbacks until the QuoteStore and bars are updated.
+    Time spent in the socket and in EClient's message queue is not included.
+    """
+    etc.PATH = tempfile.mkdtemp()
+    process, port = startServer(tickRate=tickRate)
+    session = sessions.IBLiveSession('127.0.0.1', port, 2, barSizes=['1 secs'])
+
+    latencies = []
+    interpret = session.decoder.interpret
+
+    def onMessage(fields):
+        start = time.perf_counter()
+        interpret(fields)
+        latencies.append(time.perf_counter() - start)
+
+    session.decoder.interpret = onMessage
+    thread = threading.Thread(target=session.run, daemon=True)
+    thread.start()
+    for i in range(nSymbols):
+        session.getMktData(contracts.Contract('STK', 'SYM%d' % i, 'SMART', 'USD'), '', False, False, [])
+
+    # Subscribing is paced at 50 messages per second, so ticks are only counted once every line streams
+    while session.messages:
+        time.sleep(0.05)
+    del latencies[:]
+    time.sleep(seconds)
+    count = len(latencies)
+    session.disconnect()
+    thread.join()
+    process.terminate()
+    report('Live session', count, seconds, 'ticks', latencies[:count])
+
+
+def benchmarkJournal(nSymbols=100, nTicks=1000000):
+    """
+    Journals synthetic ticks, then replays them as fast as possible through IBLiveSession's callbacks, connected to
+    the stand-in only to have an EClient
+    """
+    etc.PATH = tempfile.mkdtemp()
+    journal = journals.TickJournal()
+    for reqId in range(nSymbols):
+        journal.subscribe(reqId, contracts.Contract('STK', 'SYM%d' % reqId, 'SMART', 'USD'))
+
+    rng = np.random.default_rng(0)
+    reqIds = rng.integers(0, nSymbols, nTicks).tolist()
+    tickTypes = rng.choice([TickTypeEnum.BID, TickTypeEnum.ASK, TickTypeEnum.LAST], nTicks).tolist()
+    prices = rng.uniform(10, 500, nTicks).round(2).tolist()
+    attrib = TickAttrib()
+    receiveTime = time.time_ns()
+
+    start = time.perf_counter()
+    for i, (reqId, tickType, price) in enumerate(zip(reqIds, tickTypes, prices)):
+        journal.tickPrice(reqId, tickType, price, attrib, receiveTime + i * 1000)
+    elapsed = time.perf_counter() - start
+    journal.close()
+    print('%-20s %12.1f ns per tick' % ('Journal write', elapsed / nTicks * 1e9))
+
+    process, port = startServer(tickRate=0)
+    session = sessions.IBLiveSession('127.0.0.1', port, 3, barSizes=['1 secs'])
+    start = time.perf_counter()
+    count = journals.JournalReplayer().replay(session, session.subscribe)
+    elapsed = time.perf_counter() - start
+    session.disconnect()
+    process.terminate()
+    print('%-20s %12.0f ticks/sec' % ('Journal replay', count / elapsed))
+
+
+def benchmarkLineManager(nSymbols=1000, maxLines=100, seconds=30.):
+    """
+    Subscribes to more symbols than the stand-in has lines for through a schedulers.MarketDataLineManager, and
+    reports how stale the quotes get once the snapshot rotation is in its steady state. At 50 messages per second
+    the stalest quote is about (nSymbols - streaming lines) / 50 seconds old.
+    """
+    etc.PATH = tempfile.mkdtemp()
+    process, port = startServer(tickRate=5000, maxLines=maxLines)
+    manager = schedulers.MarketDataLineManager(maxLines=maxLines, refreshInterval=0.)
+    session = sessions.IBLiveSession('127.0.0.1', port, 6, lineManager=manager)
+    thread = threading.Thread(target=session.run, daemon=True)
+    thread.start()
+    for i in range(nSymbols):
+        session.getMktData(contracts.Contract('STK', 'SYM%d' % i, 'SMART', 'USD'), '', False, False, [], priority=i)
+
+    time.sleep(seconds)
+    quoteStore = session.tickHandler.quoteStore
+    staleness = quoteStore.getStaleness()
+    refreshed = np.sum(quoteStore.times[:, :quoteStore.size].max(axis=0) > 0)
+    session.disconnect()
+    thread.join()
+    process.terminate()
+    print('%-20s %12d streaming  %5d refreshed  p50 %6.2f s  max %6.2f s stale' % (
+        'Line manager', len(manager.streaming), refreshed, np.nanpercentile(staleness, 50),
+        np.nanmax(staleness)))
+
+
+def benchmarkPanels(nSymbols=50, days=20):
+    """
+    Reads 5 min, 1 hour and daily panels resampled from 1 min bars, first from SQLite and then from the cache, and
+    again after new bars of one symbol dropped its entries
+    """
+    etc.PATH = tempfile.mkdtemp()
+    db = databases.HistoricalTradesDatabase()
+    writer = databases.getWriter(db)
+    endEpoch = int(time.time())
+    symbols = ['SYM%d' % i for i in range(nSymbols)]
+    for symbol in symbols:
+        writer.upsertBars(symbol, '1 min', fakeservers.makeBars(symbol, endEpoch, '%d D' % days, '1 min', 1, 10 ** 6))
+    writer.flush()
+
+    service = panels.PanelService(db)
+    for label in ['SQLite', 'Cache']:
+        for barSize in ['5 mins', '1 hour', '1 day']:
+            start = time.perf_counter()
+            epochs, panel = service.getPanel(symbols, barSize, fields=('close', 'volume'))
+            elapsed = time.perf_counter() - start
+            print('%-20s %-8s %8.2f ms  %s panel' % ('Panel ' + label, barSize, elapsed * 1e3, panel['close'].shape))
+
+    writer.upsertBars(symbols[0], '1 min', fakeservers.makeBars(symbols[0], endEpoch, '60 S', '1 min', 1, 1))
+    writer.flush()
+    start = time.perf_counter()
+    service.getPanel(symbols, '1 hour', fields=('close', 'volume'))
+    print('%-20s %-8s %8.2f ms  %d MB cached' % (
+        'Panel invalidated', '1 hour', (time.perf_counter() - start) * 1e3, service.nbytes // 2 ** 20))
+    service.close()
+    writer.close()
+
+
+if __name__ == '__main__':
+    benchmarkBarBuffer()
+    benchmarkQuoteStore()
+    benchmarkImpliedVols()
+    benchmarkHistoricalSession()
+    benchmarkLiveSession()
+    benchmarkJournal()
+    benchmarkLineManager()
+    benchmarkPanels()
@@ -0,0 +1,187 @@
+import time
+import numpy as np
+import pandas as pd
+from ibapi.ticktype import TickTypeEnum
+
+
+BAR_FIELDS = ['date', 'open', 'high', 'low', 'close', 'volume', 'barCount', 'average']
+BAR_DTYPE = np.dtype([
+    ('date', 'S32'),
+    ('open', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('close', 'f8'),
+    ('volume', 'f8'),
+    ('barCount', 'i8'),
+    ('average', 'f8'),
+])
+
+
+class BarBuffer:
+    """
+    Preallocated columnar buffer of BarData. Appending is amortised O(1) since the underlying structured array
+    doubles its capacity whenever it fills up, instead of building a DataFrame per bar.
+    """
+    def __init__(self, capacity=1024):
+        self.data = np.empty(capacity, dtype=BAR_DTYPE)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def grow(self):
+        data = np.empty(2 * len(self.data), dtype=BAR_DTYPE)
+        data[:self.size] = self.data[:self.size]
+        self.data = data
+
+    def append(self, bar):
+        """
+        :param bar: (BarData) Bar received from IB's historicalData wrapper
+        :return: Nothing
+        """
+        self.appendRow(bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume, bar.barCount, bar.average)
+
+    def appendRow(self, date, open, high, low, close, volume, barCount, average):
+        if self.size == len(self.data):
+            self.grow()
+        self.data[self.size] = (date, open, high, low, close, volume, barCount, average)
+        self.size += 1
+
+    def view(self):
+        """
+        :return: (np.ndarray) Structured array of the bars appended so far. Not a copy, so it is only valid until
+                 the next append or clear
+        """
+        return self.data[:self.size]
+
+    def dates(self):
+        return np.char.decode(self.data['date'][:self.size], 'ascii')
+
+    def toRecords(self, reverse=False):
+        """
+        :param reverse: (Boolean) Whether to return the most recent bar first
+        :return: (list of tuples) One tuple per bar, ordered as BAR_FIELDS
+        """
+        data = self.view()[::-1] if reverse else self.view()
+        return [(record[0].decode('ascii'),) + record[1:] for record in data.tolist()]
+
+    def toDataFrame(self, reverse=False):
+        """
+        :param reverse: (Boolean) Whether to return the most recent bar first
+        :return: (pd.DataFrame) One column per field in BAR_FIELDS
+        """
+        data = self.view()[::-1] if reverse else self.view()
+        df = pd.DataFrame({field: data[field] for field in BAR_FIELDS[1:]})
+        df.insert(0, 'date', np.char.decode(data['date'], 'ascii'))
+        return df
+
+    def clear(self):
+        self.size = 0
+
+
+QUOTE_FIELDS = ['bid', 'ask', 'last', 'close', 'bidSize', 'askSize', 'lastSize', 'volume', 'high', 'low', 'open',
+                'lastRTH']
+BID, ASK, LAST, CLOSE, BID_SIZE, ASK_SIZE, LAST_SIZE, VOLUME, HIGH, LOW, OPEN, LAST_RTH = range(len(QUOTE_FIELDS))
+# Live and delayed tick types both land in the same column
+TICK_COLUMNS = {
+    TickTypeEnum.BID: BID, TickTypeEnum.DELAYED_BID: BID,
+    TickTypeEnum.ASK: ASK, TickTypeEnum.DELAYED_ASK: ASK,
+    TickTypeEnum.LAST: LAST, TickTypeEnum.DELAYED_LAST: LAST,
+    TickTypeEnum.CLOSE: CLOSE, TickTypeEnum.DELAYED_CLOSE: CLOSE,
+    TickTypeEnum.BID_SIZE: BID_SIZE, TickTypeEnum.DELAYED_BID_SIZE: BID_SIZE,
+    TickTypeEnum.ASK_SIZE: ASK_SIZE, TickTypeEnum.DELAYED_ASK_SIZE: ASK_SIZE,
+    TickTypeEnum.LAST_SIZE: LAST_SIZE, TickTypeEnum.DELAYED_LAST_SIZE: LAST_SIZE,
+    TickTypeEnum.VOLUME: VOLUME, TickTypeEnum.DELAYED_VOLUME: VOLUME,
+    TickTypeEnum.HIGH: HIGH, TickTypeEnum.DELAYED_HIGH: HIGH,
+    TickTypeEnum.LOW: LOW, TickTypeEnum.DELAYED_LOW: LOW,
+    TickTypeEnum.OPEN: OPEN, TickTypeEnum.DELAYED_OPEN: OPEN,
+    TickTypeEnum.LAST_RTH_TRADE: LAST_RTH,
+}
+
+
+class QuoteStore:
+    """
+    Top of book for every subscribed symbol, one row per reqId. Values and their receive times are kept field-major,
+    so that values[BID] is a contiguous array across all symbols which can be read without copying.
+    """
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.values = np.full((len(QUOTE_FIELDS), capacity), np.nan)
+        self.times = np.zeros((len(QUOTE_FIELDS), capacity), dtype=np.int64)
+        # Epoch nanoseconds each row was subscribed, which its staleness counts from until its first update
+        self.subscribed = np.zeros(capacity, dtype=np.int64)
+        self.symbols = np.empty(capacity, dtype=object)
+        self.rows = {}
+        self.freeRows = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def addSymbol(self, reqId, symbol, now=None):
+        """
+        :param reqId: (int) reqId of the market data subscription
+        :param symbol: (str)
+        :param now: (int) Epoch nanoseconds, defaults to now
+        :return: (int) Row of the symbol
+        """
+        if self.freeRows:
+            row = self.freeRows.pop()
+        elif self.size < self.capacity:
+            row = self.size
+            self.size += 1
+        else:
+            raise IndexError('QuoteStore is full with %d symbols' % self.capacity)
+
+        self.rows[reqId] = row
+        self.symbols[row] = symbol
+        self.subscribed[row] = now or time.time_ns()
+        return row
+
+    def removeSymbol(self, reqId):
+        row = self.rows.pop(reqId)
+        self.values[:, row] = np.nan
+        self.times[:, row] = 0
+        self.subscribed[row] = 0
+        self.symbols[row] = None
+        self.freeRows.append(row)
+
+    def update(self, reqId, tickType, value, receiveTime=None):
+        """
+        :param reqId: (int)
+        :param tickType: (int) See https://interactivebrokers.github.io/tws-api/tick_types.html
+        :param value: (float) Price or size
+        :param receiveTime: (int) Epoch nanoseconds, defaults to now
+        :return: (int) Column updated, or None if the tick type is not kept
+        """
+        column = TICK_COLUMNS.get(tickType)
+        if column is not None:
+            row = self.rows[reqId]
+            self.values[column, row] = value
+            self.times[column, row] = receiveTime or time.time_ns()
+        return column
+
+    def get(self, reqId, column):
+        return self.values[column, self.rows[reqId]]
+
+    def getStaleness(self, now=None):
+        """
+        :param now: (int) Epoch nanoseconds, defaults to now
+        :return: (np.ndarray) Seconds since any field of each row was last updated, or since it was subscribed when
+                 it never was, NaN for free rows
+        """
+        latest = np.maximum(self.times[:, :self.size].max(axis=0), self.subscribed[:self.size])
+        now = now or time.time_ns()
+        return np.where(latest > 0, (now - latest) / 1e9, np.nan)
+
+    def snapshot(self):
+        """
+        :return: (tuple) Symbols per row and a (field, row) view of the values. Not a copy, so it keeps changing
+        """
+        return self.symbols[:self.size], self.values[:, :self.size]
+
+    def getLast(self):
+        # Before the first trade of the day, fall back on the last regular hours trade and then the close
+        values = self.values[:, :self.size]
+        last = np.where(np.isnan(values[LAST]), values[LAST_RTH], values[LAST])
+        return np.where(np.isnan(last), values[CLOSE], last)
@@ -0,0 +1,353 @@
+import os
+import shutil
+import logging
+import threading
+import databases
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+COLUMN_DTYPES = {
+    'epoch': np.dtype('<i8'),
+    'open': np.dtype('<f8'),
+    'high': np.dtype('<f8'),
+    'low': np.dtype('<f8'),
+    'close': np.dtype('<f8'),
+    'volume': np.dtype('<f8'),
+    'barCount': np.dtype('<i8'),
+    'average': np.dtype('<f8'),
+}
+VALUE_FIELDS = ['open', 'high', 'low', 'close', 'volume', 'barCount', 'average']
+CHUNK_PREFIX = 'chunk.'
+VERSION_SUFFIX = '.version'
+# Readers racing a merge which removes what they resolved try again
+LOAD_ATTEMPTS = 3
+
+
+class ColumnarStore:
+    """
+    One raw little-endian file per (barSize, symbol, field), sorted by epoch without duplicates, next to the SQLite
+    database it mirrors. A symbol's files live in a generation directory which a symlink named after the symbol points
+    to. Bars newer than everything stored are appended to the current generation. Older ones go to a chunk directory
+    inside it, sorted the same way, which readers merge on the fly. Chunks are merged together like a binary counter,
+    so there are only a logarithmic number of them, and into the next generation once they hold as many bars as the
+    generation itself, so a backfill written newest first costs linear I/O. The link to the next generation is swapped
+    with a single rename, so readers never see a half-merged symbol and those which already mapped the old files are
+    unaffected.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+
+    def getLink(self, symbol, barSize):
+        return os.path.join(self.root, barSize.replace(' ', ''), symbol)
+
+    def getDirectory(self, symbol, barSize):
+        """
+        :return: (str) Generation directory the symbol's link points to. Readers resolve it once, so that every column
+                 they map comes from the same generation
+        """
+        return os.path.realpath(self.getLink(symbol, barSize))
+
+    @staticmethod
+    def getPath(directory, field):
+        return os.path.join(directory, field + '.bin')
+
+    @staticmethod
+    def getChunks(directory):
+        """
+        :return: (list of str) Chunk directories of a generation, oldest first. Those still being written end in .tmp
+        """
+        if not os.path.isdir(directory):
+            return []
+        names = [name for name in os.listdir(directory) if name.startswith(CHUNK_PREFIX) and
+                 name[len(CHUNK_PREFIX):].isdigit()]
+        return [os.path.join(directory, name) for name in sorted(names, key=lambda name: int(name[len(CHUNK_PREFIX):]))]
+
+    def getLength(self, directory):
+        # The epoch column is written last, so its length is how many bars are complete in every column
+        path = self.getPath(directory, 'epoch')
+        return os.path.getsize(path) // COLUMN_DTYPES['epoch'].itemsize if os.path.exists(path) else 0
+
+    def open(self, directory, field, length=None):
+        """
+        :return: (np.memmap) Read-only map of a column, or an empty array if nothing is stored
+        """
+        length = self.getLength(directory) if length is None else length
+        if length == 0:
+            return np.empty(0, dtype=COLUMN_DTYPES[field])
+        return np.memmap(self.getPath(directory, field), dtype=COLUMN_DTYPES[field], mode='r', shape=(length,))
+
+    def combine(self, directories, fields, start=None, end=None):
+        """
+        :param directories: (list of str) Directories of sorted columns, newest first, whose bars win over those of
+                            older ones with the same epoch
+        :return: (dict) Epochs between start and end without duplicates, sorted, and the same bars of every field
+        """
+        slices = []
+        for directory in directories:
+            length = self.getLength(directory)
+            epochs = self.open(directory, 'epoch', length)
+            lower = 0 if start is None else np.searchsorted(epochs, start, side='left')
+            upper = length if end is None else np.searchsorted(epochs, end, side='right')
+            slices.append((directory, length, lower, upper))
+
+        # np.unique keeps the first of equal epochs, which is the newest
+        epochs, index = np.unique(np.concatenate(
+            [self.open(directory, 'epoch', length)[lower:upper] for directory, length, lower, upper in slices]),
+            return_index=True)
+        result = {'epoch': epochs}
+        for field in fields:
+            result[field] = np.concatenate(
+                [self.open(directory, field, length)[lower:upper] for directory, length, lower, upper in slices])[index]
+        return result
+
+    def write(self, symbol, barSize, epochs, columns):
+        """
+        :param symbol: (str)
+        :param barSize: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
+        :param epochs: (np.ndarray) Epoch seconds of each bar, in any order
+        :param columns: (dict) One array per field in VALUE_FIELDS
+        :return: Nothing
+        """
+        with self.lock:
+            if not os.path.islink(self.getLink(symbol, barSize)):
+                self.swap(symbol, barSize, 0)
+            directory = self.getDirectory(symbol, barSize)
+            length = self.getLength(directory)
+            stored = self.open(directory, 'epoch', length)
+
+            # Sort the batch, keeping the last of any bars sharing an epoch
+            epochs = np.asarray(epochs, dtype=np.int64)
+            n = len(epochs)
+            epochs, index = np.unique(epochs[::-1], return_index=True)
+            columns = {field: np.asarray(columns[field])[n - 1 - index] for field in VALUE_FIELDS}
+
+            # Bars up to the last one stored go to a chunk of their own, the rest are appended
+            late = np.searchsorted(epochs, stored[-1], side='right') if length else 0
+            if late:
+                self.addChunk(directory, epochs[:late], {field: values[:late] for field, values in columns.items()})
+            if late < len(epochs):
+                self.append(directory, length, epochs[late:],
+                            {field: values[late:] for field, values in columns.items()})
+                length += len(epochs) - late
+
+            chunks = self.getChunks(directory)
+            if chunks and sum(self.getLength(chunk) for chunk in chunks) >= length:
+                self.merge(symbol, barSize, directory)
+
+    def swap(self, symbol, barSize, generation):
+        """
+        Points the symbol's link to a generation directory, creating it if needed
+        :param generation: (int)
+        :return: (str) The generation directory
+        """
+        link = self.getLink(symbol, barSize)
+        name = '%s.%d' % (symbol, generation)
+        directory = os.path.join(os.path.dirname(link), name)
+        os.makedirs(directory, exist_ok=True)
+        if os.path.lexists(link + '.tmp'):
+            os.remove(link + '.tmp')
+        os.symlink(name, link + '.tmp')
+        os.replace(link + '.tmp', link)
+        return directory
+
+    def append(self, directory, length, epochs, columns):
+        for field in VALUE_FIELDS + ['epoch']:
+            values = epochs if field == 'epoch' else columns[field]
+            path = self.getPath(directory, field)
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                # Drops whatever an append interrupted before its epochs were written left behind
+                f.truncate(length * COLUMN_DTYPES[field].itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(np.ascontiguousarray(values, dtype=COLUMN_DTYPES[field]).tobytes())
+
+    def writeColumns(self, directory, columns):
+        """
+        Writes sorted columns to a new directory, in full, under a temporary name which is then renamed
+        :param columns: (dict) One array per field in VALUE_FIELDS and epoch
+        :return: Nothing
+        """
+        if os.path.exists(directory + '.tmp'):
+            # Left behind by a write which did not get to rename it
+            shutil.rmtree(directory + '.tmp')
+        os.makedirs(directory + '.tmp')
+        for field in VALUE_FIELDS + ['epoch']:
+            with open(self.getPath(directory + '.tmp', field), 'wb') as f:
+                f.write(np.ascontiguousarray(columns[field], dtype=COLUMN_DTYPES[field]).tobytes())
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(directory + '.tmp', directory)
+
+    def addChunk(self, directory, epochs, columns):
+        chunks = self.getChunks(directory)
+        number = int(os.path.basename(chunks[-1])[len(CHUNK_PREFIX):]) + 1 if chunks else 0
+        self.writeColumns(os.path.join(directory, CHUNK_PREFIX + str(number)), dict(columns, epoch=epochs))
+        chunks.append(os.path.join(directory, CHUNK_PREFIX + str(number)))
+
+        # Each of the two newest chunks, once no bigger than the one before it, takes its number and is merged into it
+        while len(chunks) > 1 and self.getLength(chunks[-1]) >= self.getLength(chunks[-2]):
+            newer, older = chunks.pop(), chunks.pop()
+            number += 1
+            merged = os.path.join(directory, CHUNK_PREFIX + str(number))
+            self.writeColumns(merged, self.combine([newer, older], VALUE_FIELDS))
+            chunks.append(merged)
+            shutil.rmtree(newer)
+            shutil.rmtree(older)
+
+    def merge(self, symbol, barSize, directory):
+        # Chunks are newer than the generation, and later chunks newer than earlier ones
+        columns = self.combine(self.getChunks(directory)[::-1] + [directory], VALUE_FIELDS)
+        self.replace(symbol, barSize, directory, columns)
+
+    def replace(self, symbol, barSize, directory, columns):
+        """
+        Writes the next generation of a symbol and swaps its link to it
+        :param directory: (str) Current generation directory
+        :param columns: (dict) Every bar of the symbol, one sorted array per field in VALUE_FIELDS and epoch
+        :return: Nothing
+        """
+        generation = int(directory.rsplit('.', 1)[1]) + 1
+        self.writeColumns(os.path.join(os.path.dirname(directory), '%s.%d' % (symbol, generation)), columns)
+        self.swap(symbol, barSize, generation)
+
+        # The previous generation is kept for readers which resolved the link just before the swap
+        previous = os.path.join(os.path.dirname(directory), '%s.%d' % (symbol, generation - 2))
+        if os.path.exists(previous):
+            shutil.rmtree(previous)
+
+    def getVersionPath(self, symbol, barSize):
+        return self.getLink(symbol, barSize) + VERSION_SUFFIX
+
+    def getVersion(self, symbol, barSize):
+        """
+        :return: (int) How many of the writes counted in databases.CREATE_BAR_VERSION_SCRIPT the store followed
+        """
+        path = self.getVersionPath(symbol, barSize)
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return int(f.read() or 0)
+
+    def setVersion(self, symbol, barSize, version):
+        path = self.getVersionPath(symbol, barSize)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(version))
+        os.replace(path + '.tmp', path)
+
+    def onWrite(self, tblName, barSize, epochs, records):
+        """
+        Listener for databases.HistoricalBarWriter, keeping the store in sync with every committed batch
+        """
+        if records:
+            values = list(zip(*records))
+            columns = {field: np.array(values[i + 1], dtype=COLUMN_DTYPES[field])
+                       for i, field in enumerate(VALUE_FIELDS)}
+            self.write(tblName, barSize, epochs, columns)
+        with self.lock:
+            os.makedirs(os.path.dirname(self.getLink(tblName, barSize)), exist_ok=True)
+            self.setVersion(tblName, barSize, self.getVersion(tblName, barSize) + 1)
+
+    def load(self, symbols, barSize, start=None, end=None, fields=('close',)):
+        """
+        :param symbols: (list of str)
+        :param barSize: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
+        :param start: (int) Epoch seconds of the first bar, or None for the earliest
+        :param end: (int) Epoch seconds of the last bar, or None for the latest
+        :param fields: (list of str) Fields besides epoch
+        :return: (dict) {symbol: {field: array}} of zero-copy slices of the mapped files, found by binary search, or
+                 copies merged with the symbol's chunks if it has any
+        """
+        result = {}
+        for symbol in symbols:
+            for attempt in range(LOAD_ATTEMPTS):
+                directory = self.getDirectory(symbol, barSize)
+                try:
+                    result[symbol] = self.read(directory, start, end, fields)
+                    break
+                except FileNotFoundError:
+
+                    # Chunks merged or a generation removed since the link was resolved, so resolve it again
+                    if attempt == LOAD_ATTEMPTS - 1:
+                        raise
+        return result
+
+    def read(self, directory, start, end, fields):
+        chunks = self.getChunks(directory)
+        if chunks:
+            return self.combine(chunks[::-1] + [directory], fields, start, end)
+        length = self.getLength(directory)
+        epochs = self.open(directory, 'epoch', length)
+        lower = 0 if start is None else np.searchsorted(epochs, start, side='left')
+        upper = length if end is None else np.searchsorted(epochs, end, side='right')
+        result = {'epoch': epochs[lower:upper]}
+        for field in fields:
+            result[field] = self.open(directory, field, length)[lower:upper]
+        return result
+
+    def reconcile(self, db):
+        """
+        Rewrites every symbol whose bars were written more often than the store followed, e.g. by another process or
+        by this one just before it crashed, between the commit and the listener
+        :param db: (databases.IBHistoricalDatabase)
+        :return: (int) Number of (symbol, barSize) rewritten
+        """
+        db.connect()
+        count = 0
+        for (symbol, barSize), version in db.getBarVersions().items():
+            if self.getVersion(symbol, barSize) == version:
+                continue
+            logger.info('Columnar store of %s %s is behind, rewriting it', symbol, barSize)
+            self.rewrite(db, symbol, barSize, version)
+            count += 1
+        db.close()
+        return count
+
+    def export(self, db):
+        """
+        Writes everything already in the SQLite database, e.g. after creating the store
+        :param db: (databases.IBHistoricalDatabase)
+        :return: Nothing
+        """
+        db.connect()
+        versions = db.getBarVersions()
+        for tblName in db.getTables() - databases.META_TABLES:
+            db.cursor.execute('SELECT DISTINCT barSize FROM "%s"' % tblName)
+            for (barSize,) in db.cursor.fetchall():
+                self.rewrite(db, tblName, barSize, versions.get((tblName, barSize), 0))
+        db.close()
+
+    def rewrite(self, db, symbol, barSize, version):
+        # Replaces the symbol's generation with what db holds, db being connected
+        bars = db.getBars(symbol, barSize, VALUE_FIELDS)
+        values = list(zip(*bars)) or [()] * (len(VALUE_FIELDS) + 1)
+        columns = {field: np.array(values[i + 1], dtype=COLUMN_DTYPES[field]) for i, field in enumerate(VALUE_FIELDS)}
+        columns['epoch'] = np.array(values[0], dtype=np.int64)
+        with self.lock:
+            if not os.path.islink(self.getLink(symbol, barSize)):
+                self.swap(symbol, barSize, 0)
+            self.replace(symbol, barSize, self.getDirectory(symbol, barSize), columns)
+            self.setVersion(symbol, barSize, version)
+
+
+stores = {}
+storesLock = threading.Lock()
+
+
+def getStore(db):
+    """
+    :param db: (databases.IBHistoricalDatabase)
+    :return: (ColumnarStore) The store next to db's file, which follows every write of db's HistoricalBarWriter and
+             catches up on any other when first got
+    """
+    with storesLock:
+        if db.filePath not in stores:
+            store = ColumnarStore(os.path.splitext(db.filePath)[0] + '.columns')
+            databases.getWriter(db).addListener(store.onWrite)
+
+            # Catches up on whatever was committed without reaching the listener
+            store.reconcile(db)
+            stores[db.filePath] = store
+        return stores[db.filePath]
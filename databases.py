@@ -1,6 +1,128 @@
 import os
 import etc
+import time
+import dates
+import queue
+import atexit
 import sqlite3
+import logging
+import metrics
+import threading
+import volatility
+import aggregators
+import adjustments
+import multiprocessing
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+BAR_COLUMNS = ['barSize', 'epoch', 'date', 'open', 'high', 'low', 'close', 'volume', 'barCount', 'average']
+CREATE_BAR_TABLE_SCRIPT = (
+    'CREATE TABLE IF NOT EXISTS "%s" (barSize TEXT NOT NULL DEFAULT \'\', epoch INTEGER, date TEXT NOT NULL, '
+    'open REAL, high REAL, low REAL, close REAL, volume REAL, barCount INTEGER, average REAL)')
+CREATE_BAR_INDEX_SCRIPT = 'CREATE UNIQUE INDEX IF NOT EXISTS "%s_barSize_date" ON "%s" (barSize, date)'
+CREATE_EPOCH_INDEX_SCRIPT = 'CREATE INDEX IF NOT EXISTS "%s_barSize_epoch" ON "%s" (barSize, epoch)'
+UPSERT_BAR_SCRIPT = (
+    'INSERT INTO "%s" (' + ', '.join(BAR_COLUMNS) + ') VALUES (' + ', '.join(['?'] * len(BAR_COLUMNS)) + ') '
+    'ON CONFLICT (barSize, date) DO UPDATE SET ' +
+    ', '.join('%s = excluded.%s' % (column, column) for column in BAR_COLUMNS[3:]))
+CREATE_COVERAGE_SCRIPTS = [
+    'CREATE TABLE IF NOT EXISTS coverageRanges (symbol TEXT NOT NULL, whatToShow TEXT NOT NULL, '
+    'barSize TEXT NOT NULL, startEpoch INTEGER NOT NULL, endEpoch INTEGER NOT NULL, '
+    'PRIMARY KEY (symbol, whatToShow, barSize, startEpoch))',
+    'CREATE TABLE IF NOT EXISTS coverageMeta (symbol TEXT NOT NULL, whatToShow TEXT NOT NULL, '
+    'barSize TEXT NOT NULL, headTimestamp INTEGER, lastUpdate INTEGER, PRIMARY KEY (symbol, whatToShow, barSize))',
+]
+# Factor of every dividend and split found by comparing ADJUSTED_LAST with TRADES bars, see adjustments
+CREATE_ADJUSTMENT_SCRIPT = (
+    'CREATE TABLE IF NOT EXISTS adjustments (symbol TEXT NOT NULL, exEpoch INTEGER NOT NULL, factor REAL NOT NULL, '
+    'PRIMARY KEY (symbol, exEpoch))')
+# How many times the writers committed bars of each symbol and bar size, so that readers in any process can tell
+# whether what they cached is out of date, see panels.PanelService
+CREATE_BAR_VERSION_SCRIPT = (
+    'CREATE TABLE IF NOT EXISTS barVersions (symbol TEXT NOT NULL, barSize TEXT NOT NULL, version INTEGER NOT NULL, '
+    'PRIMARY KEY (symbol, barSize))')
+# Epochs spanned by each of the last BAR_WRITE_HISTORY versions, so that readers only drop what a write overlaps
+CREATE_BAR_WRITE_SCRIPT = (
+    'CREATE TABLE IF NOT EXISTS barWrites (symbol TEXT NOT NULL, barSize TEXT NOT NULL, version INTEGER NOT NULL, '
+    'minEpoch INTEGER NOT NULL, maxEpoch INTEGER NOT NULL, PRIMARY KEY (symbol, barSize, version))')
+BAR_WRITE_HISTORY = 1000
+# Volume bars of every symbol, keyed by the epoch microseconds of their first trade and their sequence among bars
+# starting at that time, since several can start within the second which the bar tables key time bars by
+CREATE_VOLUME_BAR_SCRIPT = (
+    'CREATE TABLE IF NOT EXISTS volumeBars (symbol TEXT NOT NULL, barSize TEXT NOT NULL, time INTEGER NOT NULL, '
+    'sequence INTEGER NOT NULL, open REAL, high REAL, low REAL, close REAL, volume REAL, barCount INTEGER, '
+    'average REAL, PRIMARY KEY (symbol, barSize, time, sequence))')
+# Tables next to the bar tables of each symbol
+META_TABLES = {'coverageRanges', 'coverageMeta', 'adjustments', 'barVersions', 'barWrites', 'volumeBars'}
+# SQLite's default SQLITE_MAX_COMPOUND_SELECT is 500
+MAX_COMPOUND_SELECT = 400
+CACHE_TTL = 7 * 24 * 60 * 60
+# Seconds a write to the contract cache waits for one of another process, e.g. another shard, to commit
+CACHE_BUSY_TIMEOUT = 30.
+CREATE_CACHE_SCRIPTS = [
+    'CREATE TABLE IF NOT EXISTS headTimestamps (symbol TEXT NOT NULL, secType TEXT NOT NULL, exchange TEXT NOT NULL, '
+    'whatToShow TEXT NOT NULL, headTimestamp INTEGER NOT NULL, updated INTEGER NOT NULL, '
+    'PRIMARY KEY (symbol, secType, exchange, whatToShow))',
+    'CREATE TABLE IF NOT EXISTS contractDetails (symbol TEXT NOT NULL, secType TEXT NOT NULL, exchange TEXT NOT NULL, '
+    'conId INTEGER NOT NULL, primaryExchange TEXT, timeZoneId TEXT, tradingHours TEXT, liquidHours TEXT, '
+    'updated INTEGER NOT NULL, PRIMARY KEY (symbol, secType, exchange))',
+]
+OPTION_YEARS = ['2012', '2013', '2014', '2015', '2016', '2017']
+OPTION_MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+# Columns of the end of day option CSVs, and the dtype each one is parsed with
+OPTION_CSV_DTYPES = {
+    'UnderlyingSymbol': str,
+    'UnderlyingPrice': np.float64,
+    'Type': str,
+    'Expiration': str,
+    'DataDate': str,
+    'Strike': np.float64,
+    'Last': np.float64,
+    'Bid': np.float64,
+    'Ask': np.float64,
+    'Volume': np.float64,
+    'OpenInterest': np.float64,
+    'IV': np.float64,
+    'Delta': np.float64,
+    'Gamma': np.float64,
+    'Theta': np.float64,
+    'Vega': np.float64,
+}
+OPTION_COLUMNS = ['underlying', 'expiry', 'strike', 'right', 'date', 'underlyingPrice', 'last', 'bid', 'ask',
+                  'volume', 'openInterest', 'impliedVol', 'delta', 'gamma', 'theta', 'vega']
+OPTION_CHUNK_SIZE = 200000
+# Parsed chunks per process which may wait for the writer before the workers block
+OPTION_PENDING_CHUNKS = 2
+# Columns declared NOT NULL, without which a row cannot be stored
+OPTION_KEY_COLUMNS = ['underlying', 'expiry', 'strike', 'right', 'date']
+CREATE_OPTION_SCRIPTS = [
+    'CREATE TABLE IF NOT EXISTS options (underlying TEXT NOT NULL, expiry TEXT NOT NULL, strike REAL NOT NULL, '
+    'right TEXT NOT NULL, date TEXT NOT NULL, underlyingPrice REAL, last REAL, bid REAL, ask REAL, volume REAL, '
+    'openInterest REAL, impliedVol REAL, delta REAL, gamma REAL, theta REAL, vega REAL)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS options_contract_date ON options (underlying, expiry, strike, right, date)',
+    'CREATE TABLE IF NOT EXISTS ingestedFiles (path TEXT PRIMARY KEY, size INTEGER NOT NULL, rows INTEGER NOT NULL, '
+    'updated INTEGER NOT NULL)',
+]
+IMPLIED_VOL_COLUMNS = ['underlying', 'expiry', 'strike', 'right', 'date', 'impliedVol', 'delta', 'gamma', 'theta',
+                       'vega']
+IMPLIED_VOL_BATCH_SIZE = 1000000
+CREATE_IMPLIED_VOL_SCRIPTS = [
+    'CREATE TABLE IF NOT EXISTS impliedVols (underlying TEXT NOT NULL, expiry TEXT NOT NULL, strike REAL NOT NULL, '
+    'right TEXT NOT NULL, date TEXT NOT NULL, impliedVol REAL, delta REAL, gamma REAL, theta REAL, vega REAL)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS impliedVols_contract_date ON impliedVols '
+    '(underlying, expiry, strike, right, date)',
+]
+INSERT_IMPLIED_VOL_SCRIPT = (
+    'INSERT OR REPLACE INTO impliedVols (' + ', '.join(IMPLIED_VOL_COLUMNS) + ') VALUES (' +
+    ', '.join(['?'] * len(IMPLIED_VOL_COLUMNS)) + ')')
+INSERT_OPTION_SCRIPT = (
+    'INSERT OR REPLACE INTO options (' + ', '.join(OPTION_COLUMNS) + ') VALUES (' +
+    ', '.join(['?'] * len(OPTION_COLUMNS)) + ')')
 
 
 class Database:
@@ -9,8 +131,13 @@ class Database:
         self.connection = None
         self.cursor = None
 
-    def connect(self):
-        self.connection = sqlite3.connect(self.filePath)
+    def connect(self, checkSameThread=True):
+        """
+        :param checkSameThread: (Boolean) False to share the connection between threads, which then have to take
+                                turns on it
+        :return: Nothing
+        """
+        self.connection = sqlite3.connect(self.filePath, check_same_thread=checkSameThread)
         self.cursor = self.connection.cursor()
 
     def close(self):
@@ -21,6 +148,114 @@ class IBHistoricalDatabase(Database):
     def __init__(self):
         super(IBHistoricalDatabase, self).__init__()
 
+    def connect(self, checkSameThread=True):
+        super(IBHistoricalDatabase, self).connect(checkSameThread)
+        for script in CREATE_COVERAGE_SCRIPTS:
+            self.cursor.execute(script)
+        self.cursor.execute(CREATE_ADJUSTMENT_SCRIPT)
+        self.cursor.execute(CREATE_BAR_VERSION_SCRIPT)
+        self.cursor.execute(CREATE_BAR_WRITE_SCRIPT)
+
+    def getCoverage(self, symbol, whatToShow, barSize):
+        """
+        :param symbol: (str)
+        :param whatToShow: (str) https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_what_to_show
+        :param barSize: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
+        :return: (tuple) headTimestamp and lastUpdate in epoch seconds (None if unknown), and the sorted list of
+                 (startEpoch, endEpoch) ranges already stored
+        """
+        key = (symbol, whatToShow, barSize)
+        self.cursor.execute(
+            'SELECT headTimestamp, lastUpdate FROM coverageMeta WHERE symbol = ? AND whatToShow = ? AND barSize = ?',
+            key)
+        meta = self.cursor.fetchone() or (None, None)
+        self.cursor.execute(
+            'SELECT startEpoch, endEpoch FROM coverageRanges WHERE symbol = ? AND whatToShow = ? AND barSize = ? '
+            'ORDER BY startEpoch', key)
+        return meta[0], meta[1], self.cursor.fetchall()
+
+    def getTables(self):
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        return set(row[0] for row in self.cursor.fetchall())
+
+    def getAdjustments(self, symbol):
+        """
+        :param symbol: (str)
+        :return: (tuple) Epoch seconds of every ex-date of symbol, and its factor, as arrays ordered by ex-date
+        """
+        self.cursor.execute('SELECT exEpoch, factor FROM adjustments WHERE symbol = ? ORDER BY exEpoch', (symbol,))
+        rows = np.array(self.cursor.fetchall(), dtype=np.float64).reshape(-1, 2)
+        return rows[:, 0].astype(np.int64), rows[:, 1]
+
+    def getDataVersion(self):
+        # Changes whenever another connection commits, see https://www.sqlite.org/pragma.html#pragma_data_version
+        self.cursor.execute('PRAGMA data_version')
+        return self.cursor.fetchone()[0]
+
+    def getBarVersions(self):
+        """
+        :return: (dict) {(symbol, barSize): how many times its bars were written to}
+        """
+        self.cursor.execute('SELECT symbol, barSize, version FROM barVersions')
+        return {(symbol, barSize): version for symbol, barSize, version in self.cursor.fetchall()}
+
+    def getBarWrites(self, symbol, barSize, version):
+        """
+        :param version: (int) Version of the bars already seen
+        :return: (list of tuples) (minEpoch, maxEpoch) of every later write still logged, which may be fewer than the
+                 versions since when the oldest were pruned
+        """
+        self.cursor.execute('SELECT minEpoch, maxEpoch FROM barWrites WHERE symbol = ? AND barSize = ? AND version > ?',
+                            (symbol, barSize, version))
+        return self.cursor.fetchall()
+
+    def getBars(self, symbol, barSize, fields, start=None, end=None):
+        """
+        :param symbol: (str)
+        :param barSize: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
+        :param fields: (list of str) Columns to read besides epoch
+        :param start: (int) Epoch seconds of the first bar, or None for the earliest
+        :param end: (int) Epoch seconds of the last bar, or None for the latest
+        :return: (list of tuples) (epoch, *fields) ordered by epoch, using the (barSize, epoch) index
+        """
+        if symbol not in self.getTables():
+            return []
+        self.cursor.execute(
+            'SELECT epoch, %s FROM "%s" WHERE barSize = ? AND epoch BETWEEN ? AND ? ORDER BY epoch' %
+            (', '.join(fields), symbol),
+            (barSize, -2 ** 63 if start is None else start, 2 ** 63 - 1 if end is None else end))
+        return self.cursor.fetchall()
+
+    def getLastBars(self, symbols, barSize, n, fields=('close', 'volume')):
+        """
+        Reads the last n bars of every symbol with as few statements as SQLite's compound select limit allows
+        :param symbols: (list of str)
+        :param barSize: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
+        :param n: (int) Bars per symbol
+        :param fields: (list of str) Columns to read besides epoch
+        :return: (list of tuples) (index in symbols, epoch, *fields), in no particular order. Volume bars are dated by
+                 epoch seconds with their fraction
+        """
+        tables = self.getTables()
+        selects = []
+        args = []
+        for i, symbol in enumerate(symbols):
+            if aggregators.isVolumeBarSize(barSize) and 'volumeBars' in tables:
+                selects.append('SELECT * FROM (SELECT %d, time / 1e6, %s FROM volumeBars WHERE symbol = ? AND '
+                               'barSize = ? ORDER BY time DESC, sequence DESC LIMIT ?)' % (i, ', '.join(fields)))
+                args += [symbol, barSize, n]
+            elif symbol in tables:
+                selects.append('SELECT * FROM (SELECT %d, epoch, %s FROM "%s" WHERE barSize = ? ORDER BY epoch DESC '
+                               'LIMIT ?)' % (i, ', '.join(fields), symbol))
+                args += [barSize, n]
+        rows = []
+        width = len(args) // len(selects) if selects else 0
+        for i in range(0, len(selects), MAX_COMPOUND_SELECT):
+            self.cursor.execute(' UNION ALL '.join(selects[i:i + MAX_COMPOUND_SELECT]),
+                                args[width * i:width * (i + MAX_COMPOUND_SELECT)])
+            rows += self.cursor.fetchall()
+        return rows
+
     def insertDf(self, tblName, df):
         df.to_sql(tblName, self.connection, if_exists='append', index=False)
 
@@ -40,7 +275,415 @@ class IBHistoricalDatabase(Database):
             raise NotImplementedError
 
 
+def inferBarSizes(dateStrs):
+    """
+    :param dateStrs: (list of str) Dates of bars stored without their bar size
+    :return: (list of str) '1 day' for daily dates, and for intraday ones the bar size of the most common interval
+             between them
+    """
+    isDaily = np.array([len(date.strip()) == 8 for date in dateStrs])
+    intraday = np.unique(dates.toEpochs([date for date, daily in zip(dateStrs, isDaily) if not daily]))
+    barSize = '1 min'
+    intervals = np.diff(intraday)
+    if len(intervals):
+        values, counts = np.unique(intervals, return_counts=True)
+        interval = values[np.argmax(counts)]
+        sizes = [size for size, seconds in aggregators.BAR_SIZE_SECONDS.items() if seconds <= interval]
+        barSize = max(sizes, key=aggregators.BAR_SIZE_SECONDS.get) if sizes else '1 secs'
+    return ['1 day' if daily else barSize for daily in isDaily]
+
+
+class HistoricalBarWriter:
+    """
+    Long-lived writer which owns the only write connection to one database file. Batches of bars and coverage
+    updates are handed over through a queue and written by a dedicated thread, so callers never block on disk I/O.
+    Whatever is waiting in the queue when the thread wakes up is written in a single transaction.
+    """
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.queue = queue.Queue()
+        self.tables = set()
+        self.listeners = []
+        self.written = []
+        name = os.path.basename(filePath)
+        self.flushSeconds = metrics.FLUSH_SECONDS.labels(name)
+        self.barsWritten = metrics.BARS_WRITTEN.labels(name)
+        self.thread = threading.Thread(target=self.run, name='HistoricalBarWriter', daemon=True)
+        self.thread.start()
+
+    def upsertBars(self, tblName, barSize, records):
+        """
+        :param tblName: (str) Symbol whose table the bars belong to
+        :param barSize: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
+        :param records: (list of tuples) Bars ordered as buffers.BAR_FIELDS
+        :return: Nothing
+        """
+        self.queue.put((self.writeBars, (tblName, barSize, records)))
+
+    def upsertVolumeBars(self, symbol, barSize, records):
+        """
+        :param symbol: (str)
+        :param barSize: (str) Threshold of the volume bars, e.g. '1000 volume'
+        :param records: (list of tuples) Bars as (epoch microseconds of the first trade, sequence, open, high, low,
+                        close, volume, barCount, average)
+        :return: Nothing
+        """
+        self.queue.put((self.writeVolumeBars, (symbol, barSize, records)))
+
+    def addCoverage(self, symbol, whatToShow, barSize, startEpoch, endEpoch):
+        """
+        Records that [startEpoch, endEpoch] is stored, merging it with any ranges it overlaps or touches
+        :return: Nothing
+        """
+        self.queue.put((self.writeCoverage, (symbol, whatToShow, barSize, startEpoch, endEpoch)))
+
+    def setHeadTimestamp(self, symbol, whatToShow, barSize, headTimestamp):
+        """
+        :param headTimestamp: (int) Epoch seconds of the earliest data point IB has
+        :return: Nothing
+        """
+        self.queue.put((self.writeHeadTimestamp, (symbol, whatToShow, barSize, headTimestamp)))
+
+    def updateAdjustments(self, symbol, records):
+        """
+        Compares ADJUSTED_LAST daily bars with the stored TRADES daily bars of the same days and records the factor
+        of every dividend and split found. Days without TRADES bars yet are left for the next comparison.
+        :param symbol: (str)
+        :param records: (list of tuples) ADJUSTED_LAST bars of adjustments.COMPARISON_BAR_SIZE, ordered as
+                        buffers.BAR_FIELDS
+        :return: Nothing
+        """
+        self.queue.put((self.writeAdjustments, (symbol, records)))
+
+    def addListener(self, listener):
+        """
+        :param listener: (callable) Called from the writer thread after every commit, once per batch of bars, with
+                         (tblName, barSize, epochs, records)
+        :return: Nothing
+        """
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def flush(self):
+        # Blocks until everything queued so far is committed
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        connection = sqlite3.connect(self.filePath, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        for script in CREATE_COVERAGE_SCRIPTS:
+            connection.execute(script)
+        connection.execute(CREATE_ADJUSTMENT_SCRIPT)
+        connection.execute(CREATE_BAR_VERSION_SCRIPT)
+        connection.execute(CREATE_BAR_WRITE_SCRIPT)
+        connection.execute(CREATE_VOLUME_BAR_SCRIPT)
+
+        running = True
+        while running:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            running = None not in items
+            batches = [item for item in items if item is not None]
+            try:
+                self.write(connection, batches)
+            except Exception:
+
+                # One bad batch rolls back the whole transaction, so write them one by one to keep the others
+                logger.warning('Failed to write %d batches to %s, retrying them one by one', len(batches),
+                               self.filePath)
+                for batch in batches:
+                    try:
+                        self.write(connection, [batch])
+                    except Exception:
+                        logger.exception('Dropped %s of %s in %s', batch[0].__name__, batch[1][0], self.filePath)
+            finally:
+                self.written = []
+                for _ in items:
+                    self.queue.task_done()
+
+        connection.close()
+
+    def write(self, connection, batches):
+        # Writes batches in one transaction, then counts the bars and notifies the listeners once it is committed
+        self.written = []
+        tables = set(self.tables)
+        start = time.perf_counter()
+        # An explicit transaction, since sqlite3 would commit the table creations and migrations on their own
+        connection.execute('BEGIN')
+        try:
+            for method, args in batches:
+                method(connection, *args)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            self.tables = tables
+            raise
+        self.flushSeconds.record(time.perf_counter() - start)
+        self.barsWritten.inc(sum(len(batch[3]) for batch in self.written))
+        self.notify()
+
+    def notify(self):
+        for listener in self.listeners:
+            for batch in self.written:
+                try:
+                    listener(*batch)
+                except Exception:
+                    logger.exception('Listener failed on %d bars of %s', len(batch[3]), batch[0])
+
+    def writeBars(self, connection, tblName, barSize, records):
+        if tblName not in self.tables:
+            self.createTable(connection, tblName)
+            self.tables.add(tblName)
+        epochs = dates.toEpochs([record[0] for record in records])
+        connection.executemany(
+            UPSERT_BAR_SCRIPT % tblName,
+            [(barSize, epoch) + tuple(record) for epoch, record in zip(epochs.tolist(), records)])
+        connection.execute(
+            'INSERT INTO barVersions VALUES (?, ?, 1) '
+            'ON CONFLICT (symbol, barSize) DO UPDATE SET version = version + 1',
+            (tblName, barSize))
+        if len(epochs):
+            version = connection.execute('SELECT version FROM barVersions WHERE symbol = ? AND barSize = ?',
+                                         (tblName, barSize)).fetchone()[0]
+            connection.execute('INSERT OR REPLACE INTO barWrites VALUES (?, ?, ?, ?, ?)',
+                               (tblName, barSize, version, int(epochs.min()), int(epochs.max())))
+            connection.execute('DELETE FROM barWrites WHERE symbol = ? AND barSize = ? AND version <= ?',
+                               (tblName, barSize, version - BAR_WRITE_HISTORY))
+        self.written.append((tblName, barSize, epochs, records))
+
+    @staticmethod
+    def writeVolumeBars(connection, symbol, barSize, records):
+        connection.executemany('INSERT OR REPLACE INTO volumeBars VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               [(symbol, barSize) + tuple(record) for record in records])
+
+    @staticmethod
+    def writeCoverage(connection, symbol, whatToShow, barSize, startEpoch, endEpoch):
+        key = (symbol, whatToShow, barSize)
+        overlapping = connection.execute(
+            'SELECT startEpoch, endEpoch FROM coverageRanges WHERE symbol = ? AND whatToShow = ? AND barSize = ? '
+            'AND startEpoch <= ? AND endEpoch >= ?', key + (endEpoch, startEpoch)).fetchall()
+        for start, end in overlapping:
+            startEpoch, endEpoch = min(startEpoch, start), max(endEpoch, end)
+        connection.executemany(
+            'DELETE FROM coverageRanges WHERE symbol = ? AND whatToShow = ? AND barSize = ? AND startEpoch = ?',
+            [key + (start,) for start, _ in overlapping])
+        connection.execute('INSERT INTO coverageRanges VALUES (?, ?, ?, ?, ?)', key + (startEpoch, endEpoch))
+        connection.execute(
+            'INSERT INTO coverageMeta (symbol, whatToShow, barSize, lastUpdate) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (symbol, whatToShow, barSize) DO UPDATE SET lastUpdate = excluded.lastUpdate',
+            key + (int(time.time()),))
+
+    @staticmethod
+    def writeAdjustments(connection, symbol, records):
+        if not records or not connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (symbol,)).fetchone():
+            return
+        epochs = dates.toEpochs([record[0] for record in records])
+        adjustedCloses = np.array([record[4] for record in records], dtype=np.float64)
+        stored = np.array(connection.execute(
+            'SELECT epoch, close FROM "%s" WHERE barSize = ? AND epoch BETWEEN ? AND ? ORDER BY epoch' % symbol,
+            (adjustments.COMPARISON_BAR_SIZE, int(epochs.min()), int(epochs.max()))).fetchall(),
+            dtype=np.float64).reshape(-1, 2)
+        common, adjustedIndex, storedIndex = np.intersect1d(
+            epochs, stored[:, 0].astype(np.int64), assume_unique=True, return_indices=True)
+
+        # Days past a gap in the TRADES bars are left to the next comparison, which starts from the last day compared
+        checked = connection.execute(
+            'SELECT lastUpdate FROM coverageMeta WHERE symbol = ? AND whatToShow = ? AND barSize = ?',
+            (symbol, 'ADJUSTED_LAST', adjustments.COMPARISON_BAR_SIZE)).fetchone()
+        start = int(epochs.min())
+        if checked is not None and checked[0] is not None:
+            start = max(checked[0] - adjustments.COMPARISON_OVERLAP, start)
+        ranges = connection.execute(
+            'SELECT startEpoch, endEpoch FROM coverageRanges WHERE symbol = ? AND whatToShow = ? AND barSize = ? '
+            'ORDER BY startEpoch', (symbol, 'TRADES', adjustments.COMPARISON_BAR_SIZE)).fetchall()
+        until = adjustments.getCoveredUntil(ranges, start)
+        if until is None:
+            logger.warning('Daily TRADES bars of %s are missing from %s, no adjustments compared', symbol,
+                           dates.toIBDate(start))
+            return
+        compared = common <= until
+        common, adjustedIndex, storedIndex = common[compared], adjustedIndex[compared], storedIndex[compared]
+        if not len(common):
+            return
+
+        exEpochs, factors = adjustments.findFactors(common, stored[storedIndex, 1], adjustedCloses[adjustedIndex])
+        connection.executemany('INSERT OR REPLACE INTO adjustments VALUES (?, ?, ?)',
+                               [(symbol, exEpoch, factor) for exEpoch, factor in zip(exEpochs.tolist(),
+                                                                                     factors.tolist())])
+        if len(exEpochs):
+            logger.info('%d corporate actions of %s found', len(exEpochs), symbol)
+        # The last day compared is where the next comparison picks up
+        connection.execute(
+            'INSERT INTO coverageMeta (symbol, whatToShow, barSize, lastUpdate) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (symbol, whatToShow, barSize) DO UPDATE SET lastUpdate = excluded.lastUpdate',
+            (symbol, 'ADJUSTED_LAST', adjustments.COMPARISON_BAR_SIZE, int(common[-1])))
+
+    @staticmethod
+    def writeHeadTimestamp(connection, symbol, whatToShow, barSize, headTimestamp):
+        connection.execute(
+            'INSERT INTO coverageMeta (symbol, whatToShow, barSize, headTimestamp) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (symbol, whatToShow, barSize) DO UPDATE SET headTimestamp = excluded.headTimestamp',
+            (symbol, whatToShow, barSize, headTimestamp))
+
+    @staticmethod
+    def createTable(connection, tblName):
+        connection.execute(CREATE_BAR_TABLE_SCRIPT % tblName)
+        columns = [row[1] for row in connection.execute('PRAGMA table_info("%s")' % tblName)]
+        if 'barSize' not in columns:
+
+            # Tables written by the old insertDf path have neither a bar size nor a key. Their bar size is inferred
+            # from the dates so that new bars replace them, then their duplicates are dropped
+            connection.execute('ALTER TABLE "%s" ADD COLUMN barSize TEXT NOT NULL DEFAULT \'\'' % tblName)
+            rows = connection.execute('SELECT rowid, date FROM "%s"' % tblName).fetchall()
+            if rows:
+                rowids, dateStrs = zip(*rows)
+                connection.executemany('UPDATE "%s" SET barSize = ? WHERE rowid = ?' % tblName,
+                                       zip(inferBarSizes(dateStrs), rowids))
+            connection.execute(
+                'DELETE FROM "%s" WHERE rowid NOT IN (SELECT MAX(rowid) FROM "%s" GROUP BY barSize, date)' %
+                (tblName, tblName))
+        connection.execute(CREATE_BAR_INDEX_SCRIPT % (tblName, tblName))
+
+        if 'epoch' not in columns:
+            connection.execute('ALTER TABLE "%s" ADD COLUMN epoch INTEGER' % tblName)
+            rows = connection.execute('SELECT rowid, date FROM "%s"' % tblName).fetchall()
+            if rows:
+                rowids, dateStrs = zip(*rows)
+                connection.executemany(
+                    'UPDATE "%s" SET epoch = ? WHERE rowid = ?' % tblName,
+                    zip(dates.toEpochs(dateStrs).tolist(), rowids))
+        connection.execute(CREATE_EPOCH_INDEX_SCRIPT % (tblName, tblName))
+
+
+writers = {}
+writersLock = threading.Lock()
+
+
+def getWriter(db):
+    """
+    :param db: (IBHistoricalDatabase) Database whose file the writer should own
+    :return: (HistoricalBarWriter) The one writer for that file, started on first use
+    """
+    with writersLock:
+        if db.filePath not in writers:
+            writers[db.filePath] = HistoricalBarWriter(db.filePath)
+        return writers[db.filePath]
+
+
+@atexit.register
+def closeWriters():
+    with writersLock:
+        while writers:
+            _, writer = writers.popitem()
+            writer.close()
+
+
+class ContractCacheDatabase(Database):
+    """
+    Local cache of headTimestamps and resolved contract details, so that sessions only go to IB on a miss or once an
+    entry is older than its ttl.
+    """
+    def __init__(self, ttl=CACHE_TTL):
+        super(ContractCacheDatabase, self).__init__()
+        self.name = 'ContractCache.db'
+        self.filePath = os.path.join(etc.PATH, self.name)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # Live sessions resolve contracts on the caller's thread and store contract details on the thread running
+        # EClient.run, so the connection is shared between threads and every statement holds the lock
+        self.connection = sqlite3.connect(self.filePath, timeout=CACHE_BUSY_TIMEOUT, check_same_thread=False)
+        self.cursor = self.connection.cursor()
+        with self.lock:
+            # Shards write the cache from several processes at once. WAL lets them read while one of them writes,
+            # and writers queue up for the busy timeout instead of failing with 'database is locked'
+            self.cursor.execute('PRAGMA journal_mode=WAL')
+            for script in CREATE_CACHE_SCRIPTS:
+                self.cursor.execute(script)
+            self.connection.commit()
+
+    @staticmethod
+    def getKey(contract):
+        return contract.symbol or contract.localSymbol, contract.secType, contract.exchange
+
+    def getHeadTimestamp(self, contract, whatToShow):
+        """
+        :param contract: (contracts.Contract) My custom-made Contract object
+        :param whatToShow: (str) https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_what_to_show
+        :return: (int) Epoch seconds of the cached headTimestamp, or None on a miss
+        """
+        with self.lock:
+            self.cursor.execute(
+                'SELECT headTimestamp FROM headTimestamps WHERE symbol = ? AND secType = ? AND exchange = ? '
+                'AND whatToShow = ? AND updated > ?', self.getKey(contract) + (whatToShow, int(time.time()) - self.ttl))
+            row = self.cursor.fetchone()
+            return row[0] if row else None
+
+    def setHeadTimestamp(self, contract, whatToShow, headTimestamp):
+        with self.lock:
+            self.cursor.execute(
+                'INSERT OR REPLACE INTO headTimestamps VALUES (?, ?, ?, ?, ?, ?)',
+                self.getKey(contract) + (whatToShow, headTimestamp, int(time.time())))
+            self.connection.commit()
+
+    def resolveContract(self, contract):
+        """
+        Fills in conId and primaryExchange from the cache, so that TWS does not have to resolve the contract again
+        :param contract: (contracts.Contract) My custom-made Contract object
+        :return: (Boolean) Whether the contract was found
+        """
+        with self.lock:
+            self.cursor.execute(
+                'SELECT conId, primaryExchange FROM contractDetails WHERE symbol = ? AND secType = ? AND exchange = ? '
+                'AND updated > ?', self.getKey(contract) + (int(time.time()) - self.ttl,))
+            row = self.cursor.fetchone()
+            if row is None:
+                return False
+            contract.conId, contract.primaryExchange = row
+            return True
+
+    def getTradingHours(self, contract):
+        """
+        :return: (tuple) timeZoneId, tradingHours and liquidHours as sent in ContractDetails, or None on a miss
+        """
+        with self.lock:
+            self.cursor.execute(
+                'SELECT timeZoneId, tradingHours, liquidHours FROM contractDetails WHERE symbol = ? AND secType = ? '
+                'AND exchange = ?', self.getKey(contract))
+            return self.cursor.fetchone()
+
+    def setContractDetails(self, contract, contractDetails):
+        """
+        :param contract: (contracts.Contract) The contract as it was requested
+        :param contractDetails: (ContractDetails) As received in the contractDetails wrapper
+        :return: Nothing
+        """
+        with self.lock:
+            self.cursor.execute(
+                'INSERT OR REPLACE INTO contractDetails VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                self.getKey(contract) + (contractDetails.contract.conId, contractDetails.contract.primaryExchange,
+                                         contractDetails.timeZoneId, contractDetails.tradingHours,
+                                         contractDetails.liquidHours, int(time.time())))
+            self.connection.commit()
+
+
 class HistoricalAdjustedLastDatabase(IBHistoricalDatabase):
+    """
+    ADJUSTED_LAST bars as IB sends them. Sessions no longer fill it, since adjusted bars are derived from the TRADES
+    bars and their factor table, see adjustments.loadAdjustedBars
+    """
     def __init__(self):
         super(HistoricalAdjustedLastDatabase, self).__init__()
         self.name = 'HistoricalAdjustedLast.db'
@@ -55,25 +698,220 @@ class HistoricalTradesDatabase(IBHistoricalDatabase):
 
 
 class HistoricalOptionImpliedVolDatabase(IBHistoricalDatabase):
+    """
+    IB's OPTION_IMPLIED_VOLATILITY bars per underlying, plus the implied vols and greeks of every option of
+    HistoricalOptionDatabase in the impliedVols table.
+    """
     def __init__(self):
         super(HistoricalOptionImpliedVolDatabase, self).__init__()
         self.name = 'HistoricalOptionImpliedVol.db'
         self.filePath = os.path.join(etc.PATH, self.name)
 
+    def connect(self):
+        super(HistoricalOptionImpliedVolDatabase, self).connect()
+        for script in CREATE_IMPLIED_VOL_SCRIPTS:
+            self.cursor.execute(script)
+        self.connection.commit()
+
+    def create(self, optionDb=None, rate=volatility.RISK_FREE_RATE, batchSize=IMPLIED_VOL_BATCH_SIZE):
+        """
+        Solves the implied vol and greeks of every ingested option, batchSize rows at a time
+        :param optionDb: (HistoricalOptionDatabase) Source of the quotes
+        :param rate: (float) Continuously compounded risk free rate
+        :param batchSize: (int) Rows read, solved and written at once
+        :return: (int) Number of options with an implied vol
+        """
+        optionDb = optionDb or HistoricalOptionDatabase()
+        optionDb.connect()
+        self.connect()
+
+        start = time.perf_counter()
+        nRows = nSolved = 0
+        lastRowId = 0
+        while True:
+            optionDb.cursor.execute(
+                'SELECT rowid, underlying, expiry, strike, right, date, underlyingPrice, last, bid, ask FROM options '
+                'WHERE rowid > ? ORDER BY rowid LIMIT ?', (lastRowId, batchSize))
+            rows = optionDb.cursor.fetchall()
+            if not rows:
+                break
+            lastRowId = rows[-1][0]
+
+            df = pd.DataFrame(rows, columns=['rowid'] + IMPLIED_VOL_COLUMNS[:5] + ['spot', 'last', 'bid', 'ask'])
+            df[['spot', 'last', 'bid', 'ask']] = df[['spot', 'last', 'bid', 'ask']].astype(np.float64)
+            # Mid where both sides are quoted, last trade otherwise
+            quoted = (df['bid'] > 0) & (df['ask'] > df['bid'])
+            prices = np.where(quoted, 0.5 * (df['bid'] + df['ask']), df['last']).astype(np.float64)
+            days = (pd.to_datetime(df['expiry'], format='%Y%m%d') - pd.to_datetime(df['date'], format='%Y%m%d')).dt.days
+            times = days.to_numpy(dtype=np.float64) / volatility.DAYS_PER_YEAR
+            spots = df['spot'].to_numpy()
+            strikes = df['strike'].to_numpy(dtype=np.float64)
+            isCall = (df['right'] == 'C').to_numpy()
+
+            vols = volatility.getImpliedVols(prices, spots, strikes, times, isCall, rate)
+            greeks = volatility.getGreeks(spots, strikes, times, vols, isCall, rate)
+            for column, values in [('impliedVol', vols)] + list(greeks.items()):
+                df[column] = values
+
+            with self.connection:
+                self.connection.executemany(INSERT_IMPLIED_VOL_SCRIPT,
+                                            df[IMPLIED_VOL_COLUMNS].itertuples(index=False, name=None))
+            nRows += len(df)
+            nSolved += int(np.isfinite(vols).sum())
+            logger.info('Solved %d of %d options at %.0f options/sec', nSolved, nRows,
+                        nRows / (time.perf_counter() - start))
+
+        optionDb.close()
+        self.close()
+        return nSolved
+
+
+def toOptionDates(dateStrs):
+    # MM/DD/YYYY to IB's YYYYMMDD, sliced as whole columns rather than parsed row by row
+    return dateStrs.str[6:10] + dateStrs.str[0:2] + dateStrs.str[3:5]
+
 
-class HistoricalOptionDatabase:
+def parseOptionFile(source, path, chunks, chunkSize=OPTION_CHUNK_SIZE):
+    """
+    Runs in a pool worker, so that parsing scales with the number of processes while one coordinator writes. Every
+    chunk goes to the coordinator as soon as it is parsed, so a worker holds a single chunk whatever the file size.
+    :param source: (str) Folder of the archive
+    :param path: (str) CSV of one day of end of day option quotes, relative to source
+    :param chunks: (multiprocessing.Queue) Bounded queue to the coordinator. Gets (path, list of OPTION_COLUMNS
+                   tuples) per chunk, then (path, rows dropped for a missing key column) once the file is parsed, or
+                   (path, exception) if it could not be
+    :param chunkSize: (int) Rows parsed at a time
+    :return: Nothing
+    """
+    dropped = 0
+    try:
+        for df in pd.read_csv(os.path.join(source, path), usecols=list(OPTION_CSV_DTYPES), dtype=OPTION_CSV_DTYPES,
+                              chunksize=chunkSize):
+            df = pd.DataFrame({
+                'underlying': df['UnderlyingSymbol'],
+                'expiry': toOptionDates(df['Expiration']),
+                'strike': df['Strike'],
+                'right': df['Type'].str[0].str.upper(),
+                'date': toOptionDates(df['DataDate']),
+                'underlyingPrice': df['UnderlyingPrice'],
+                'last': df['Last'],
+                'bid': df['Bid'],
+                'ask': df['Ask'],
+                'volume': df['Volume'],
+                'openInterest': df['OpenInterest'],
+                'impliedVol': df['IV'],
+                'delta': df['Delta'],
+                'gamma': df['Gamma'],
+                'theta': df['Theta'],
+                'vega': df['Vega'],
+            })
+            # SQLite stores NaN as NULL, which the key columns do not accept
+            valid = df[OPTION_KEY_COLUMNS].notna().all(axis=1)
+            dropped += int((~valid).sum())
+            chunks.put((path, list(df[valid].itertuples(index=False, name=None))))
+    except Exception as e:
+        chunks.put((path, e))
+        return
+    chunks.put((path, dropped))
+
+
+class HistoricalOptionDatabase(Database):
+    """
+    End of day quotes of US options, one row per (underlying, expiry, strike, right, date), ingested from the CSV
+    archive under etc.PATH/historical us options/<year>/<month>.
+    """
     def __init__(self):
+        super(HistoricalOptionDatabase, self).__init__()
         self.name = 'HistoricalOption.db'
         self.filePath = os.path.join(etc.PATH, self.name)
+        self.source = os.path.join(etc.PATH, 'historical us options')
+
+    def connect(self):
+        super(HistoricalOptionDatabase, self).connect()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for script in CREATE_OPTION_SCRIPTS:
+            self.cursor.execute(script)
+        self.connection.commit()
+
+    def getFiles(self, years=OPTION_YEARS):
+        """
+        :return: (list of tuples) (path relative to the source folder, size in bytes) of every CSV in the archive
+        """
+        if not os.path.isdir(self.source):
+            raise Exception('The path %s cannot be found' % self.source)
+        files = []
+        for year in years:
+            for month in OPTION_MONTHS:
+                folder = os.path.join(year, month)
+                if not os.path.isdir(os.path.join(self.source, folder)):
+                    logger.warning('The path %s cannot be found', os.path.join(self.source, folder))
+                    continue
+                for fileName in sorted(os.listdir(os.path.join(self.source, folder))):
+                    if fileName.lower().endswith('.csv'):
+                        path = os.path.join(folder, fileName)
+                        files.append((path, os.path.getsize(os.path.join(self.source, path))))
+        return files
 
-    def create(self):
-        path = os.path.join(self.filePath, 'historical us options')
-        for folder in ['2012', '2013', '2014', '2015', '2016', '2017']:
-            for month in ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']:
+    def getIngested(self):
+        self.cursor.execute('SELECT path, size FROM ingestedFiles')
+        return dict(self.cursor.fetchall())
+
+    def create(self, years=OPTION_YEARS, processes=None, chunkSize=OPTION_CHUNK_SIZE):
+        """
+        Ingests every CSV of the archive which is not checkpointed yet. Files are sharded across a process pool for
+        parsing, and the coordinator writes their chunks as they arrive. A file is checkpointed once its last chunk
+        is committed, so an interrupted run resumes from the files it had not checkpointed, whose rows written so far
+        are replaced.
+        :param years: (list of str) Year folders to ingest
+        :param processes: (int) Parsing processes, defaults to the number of cores
+        :param chunkSize: (int) Rows each worker parses at a time
+        :return: (tuple) Number of files and rows ingested
+        """
+        self.connect()
+        ingested = self.getIngested()
+        # A file whose size changed since it was checkpointed is ingested again
+        files = dict((path, size) for path, size in self.getFiles(years) if ingested.get(path) != size)
+        logger.info('Ingesting %d files, %d already done', len(files), len(ingested))
+
+        start = time.perf_counter()
+        nFiles = nRows = 0
+        rows = defaultdict(int)
+        processes = processes or os.cpu_count()
+        with multiprocessing.Manager() as manager, ProcessPoolExecutor(processes) as executor:
+            # Workers block once a couple of chunks per process wait for the writer, which bounds memory
+            chunks = manager.Queue(OPTION_PENDING_CHUNKS * processes)
+            futures = [executor.submit(parseOptionFile, self.source, path, chunks, chunkSize) for path in files]
+            remaining = len(files)
+            while remaining:
                 try:
-                    path = '/'.join([self.filePath, 'historical us options', folder, month])
-                    files = os.listdir(path)
-                except:
-                    raise Exception('The path %s cannot be found' % path)
-                else:
-                    pass
+                    path, chunk = chunks.get(timeout=1.)
+                except queue.Empty:
+                    # A worker which died, e.g. killed for memory, never sends the end of its file
+                    for future in futures:
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+                    continue
+
+                if isinstance(chunk, list):
+                    with self.connection:
+                        self.connection.executemany(INSERT_OPTION_SCRIPT, chunk)
+                    rows[path] += len(chunk)
+                    nRows += len(chunk)
+                    continue
+
+                remaining -= 1
+                if isinstance(chunk, Exception):
+                    logger.error('Could not ingest %s, it is retried on the next run: %s', path, chunk)
+                    continue
+                if chunk:
+                    logger.warning('Dropped %d rows of %s without an underlying, expiry, strike, right or date',
+                                   chunk, path)
+                with self.connection:
+                    self.connection.execute('INSERT OR REPLACE INTO ingestedFiles VALUES (?, ?, ?, ?)',
+                                            (path, files[path], rows.pop(path, 0), int(time.time())))
+                nFiles += 1
+                logger.info('Ingested %s, %d rows at %.0f rows/sec', path, nRows, nRows / (time.perf_counter() - start))
+
+        self.close()
+        return nFiles, nRows
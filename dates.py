@@ -0,0 +1,166 @@
+import pytz
+import numpy as np
+import pandas as pd
+from datetime import date, datetime, timedelta
+
+
+TIMEZONE = pytz.timezone('US/Eastern')
+IB_END_DATE_FMT = '%Y%m%d %H:%M:%S'
+IB_BAR_DATE_FMT = '%Y%m%d  %H:%M:%S'
+EPOCH = pd.Timestamp('1970-01-01', tz='UTC')
+
+
+def localize(timestamps):
+    return timestamps.dt.tz_localize(TIMEZONE, ambiguous=False, nonexistent='shift_forward')
+
+
+def toEpochs(dates):
+    """
+    Vectorized conversion of the date strings IB sends with bars and in historicalDataEnd.
+    :param dates: (list of str) 'yyyymmdd' for daily bars, 'yyyymmdd  hh:mm:ss' (optionally followed by a time zone)
+                  for intraday bars when formatDate is 1, or epoch seconds when formatDate is 2
+    :return: (np.ndarray) Epoch seconds as int64, treating local dates as US/Eastern
+    """
+    dates = pd.Series(dates, dtype=object).astype(str).str.strip()
+    epochs = np.zeros(len(dates), dtype=np.int64)
+
+    lengths = dates.str.len()
+    isEpoch = (dates.str.isdigit() & (lengths != 8)).to_numpy()
+    isDaily = (lengths == 8).to_numpy()
+    isIntraday = ~isEpoch & ~isDaily
+
+    if isEpoch.any():
+        epochs[isEpoch] = dates[isEpoch].astype(np.int64).to_numpy()
+    if isDaily.any():
+        timestamps = localize(pd.to_datetime(dates[isDaily], format='%Y%m%d'))
+        epochs[isDaily] = ((timestamps - EPOCH) // pd.Timedelta(seconds=1)).to_numpy()
+    if isIntraday.any():
+        intraday = dates[isIntraday].str.split().str[:2].str.join(' ')
+        timestamps = localize(pd.to_datetime(intraday, format=IB_END_DATE_FMT))
+        epochs[isIntraday] = ((timestamps - EPOCH) // pd.Timedelta(seconds=1)).to_numpy()
+    return epochs
+
+
+def toEpoch(date):
+    return int(toEpochs([date])[0])
+
+
+def toIBDate(epoch):
+    """
+    :param epoch: (int) Epoch seconds
+    :return: (str) US/Eastern date string accepted as an endDateTime by reqHistoricalData
+    """
+    return datetime.fromtimestamp(epoch, TIMEZONE).strftime(IB_END_DATE_FMT)
+
+
+def toIBBarDate(epoch):
+    """
+    :param epoch: (int) Epoch seconds
+    :return: (str) US/Eastern date string formatted like the intraday bars IB sends when formatDate is 1
+    """
+    return datetime.fromtimestamp(epoch, TIMEZONE).strftime(IB_BAR_DATE_FMT)
+
+# Unscheduled full-day NYSE closures on top of the regular holidays
+SPECIAL_CLOSURES = [
+    date(2001, 9, 11), date(2001, 9, 12), date(2001, 9, 13), date(2001, 9, 14), date(2004, 6, 11),
+    date(2007, 1, 2), date(2012, 10, 29), date(2012, 10, 30), date(2018, 12, 5), date(2025, 1, 9),
+]
+
+
+def getEaster(year):
+    # Anonymous Gregorian algorithm
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def getNthWeekday(year, month, weekday, n):
+    # n = -1 gives the last such weekday of the month
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def getObserved(day):
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+
+def getNYSEHolidays(year):
+    holidays = [
+        getNthWeekday(year, 2, 0, 3),
+        getEaster(year) - timedelta(days=2),
+        getNthWeekday(year, 5, 0, -1),
+        getObserved(date(year, 7, 4)),
+        getNthWeekday(year, 9, 0, 1),
+        getNthWeekday(year, 11, 3, 4),
+        getObserved(date(year, 12, 25)),
+    ]
+
+    # New Year's Day falling on a Saturday is not observed on the Friday before
+    if date(year, 1, 1).weekday() != 5:
+        holidays.append(getObserved(date(year, 1, 1)))
+    if year >= 1998:
+        holidays.append(getNthWeekday(year, 1, 0, 3))
+    if year >= 2022:
+        holidays.append(getObserved(date(year, 6, 19)))
+    return holidays
+
+
+class TradingCalendar:
+    """
+    NYSE trading days and session hours in US/Eastern. Early closes are treated as full sessions.
+    """
+    def __init__(self, rthHours=((9, 30), (16, 0)), extendedHours=((4, 0), (20, 0)), closures=SPECIAL_CLOSURES):
+        self.rthHours = rthHours
+        self.extendedHours = extendedHours
+        self.closures = set(closures)
+        self.holidays = {}
+
+    def isTradingDay(self, day):
+        if day.weekday() > 4 or day in self.closures:
+            return False
+        if day.year not in self.holidays:
+            self.holidays[day.year] = set(getNYSEHolidays(day.year))
+        return day not in self.holidays[day.year]
+
+    def getTradingDays(self, start, end):
+        """
+        :param start: (datetime.date)
+        :param end: (datetime.date)
+        :return: (list of datetime.date) Trading days from start to end, both inclusive
+        """
+        days = []
+        day = start
+        while day <= end:
+            if self.isTradingDay(day):
+                days.append(day)
+            day += timedelta(days=1)
+        return days
+
+    def getSession(self, day, useRTH=True):
+        """
+        :param day: (datetime.date)
+        :param useRTH: (Boolean) Regular trading hours only, or including pre and post market
+        :return: (tuple) Epoch seconds of the open and close of that day's session
+        """
+        (openHour, openMinute), (closeHour, closeMinute) = self.rthHours if useRTH else self.extendedHours
+        sessionOpen = TIMEZONE.localize(datetime(day.year, day.month, day.day, openHour, openMinute))
+        sessionClose = TIMEZONE.localize(datetime(day.year, day.month, day.day, closeHour, closeMinute))
+        return int(sessionOpen.timestamp()), int(sessionClose.timestamp())
+
+
+def toDate(epoch):
+    return datetime.fromtimestamp(epoch, TIMEZONE).date()
@@ -1,4 +1,3 @@
-import pandas as pd
 from abc import ABCMeta
 
 
@@ -35,10 +34,7 @@ class HistoricalDataEvent(Event):
             elif key == 'endDateTime':
                 self.endDateTime = arg
             elif key == 'bars':
-                self.bars.append(
-                    pd.DataFrame(
-                        index=['date', 'open', 'high', 'low', 'close', 'volume', 'barCount', 'average'],
-                        data=[arg.date, arg.open, arg.high, arg.low, arg.close, arg.volume, arg.barCount, arg.average]))
+                self.bars.append(arg)
 
 
 class TickEvent(Event):
@@ -51,4 +47,4 @@ class TickEvent(Event):
 
     def edit(self, **kwargs):
         for key, arg in kwargs.items():
-            self[key] = arg
+            setattr(self, key, arg)
@@ -0,0 +1,275 @@
+import time
+import zlib
+import dates
+import socket
+import struct
+import logging
+import threading
+import schedulers
+import aggregators
+import numpy as np
+from ibapi.message import IN, OUT
+from ibapi.ticktype import TickTypeEnum
+from ibapi.server_versions import MAX_CLIENT_VER
+
+
+logger = logging.getLogger(__name__)
+
+BAR_SECONDS = dict(aggregators.BAR_SIZE_SECONDS, **{'1 day': 86400, '1 week': 7 * 86400, '1 month': 30 * 86400})
+DURATION_SECONDS = {'S': 1, 'D': 86400, 'W': 7 * 86400, 'M': 30 * 86400, 'Y': 365 * 86400}
+HEAD_TIMESTAMP = 1104537600
+PACING_VIOLATION = 'Historical Market Data Service error message:API historical data query cancelled: pacing violation'
+MAX_TICKERS = 'Max number of tickers has been reached'
+# Tick types sent by the ticker, with the price tick types carrying their size as IB does
+TICK_PRICE_TYPES = [TickTypeEnum.BID, TickTypeEnum.ASK, TickTypeEnum.LAST]
+
+
+def makeMessage(*fields):
+    text = ''.join('%s\0' % (int(field) if isinstance(field, bool) else field) for field in fields).encode()
+    return struct.pack('!I', len(text)) + text
+
+
+def readMessages(buf):
+    """
+    :param buf: (bytes) Data received so far
+    :return: (tuple) List of messages as lists of str fields, and whatever is left of an incomplete message
+    """
+    messages = []
+    while len(buf) >= 4:
+        size = struct.unpack('!I', buf[:4])[0]
+        if len(buf) < 4 + size:
+            break
+        messages.append(buf[4:4 + size].decode().split('\0')[:-1])
+        buf = buf[4 + size:]
+    return messages, buf
+
+
+def makeBars(symbol, endEpoch, durationString, barSizeSetting, formatDate, maxBars):
+    """
+    Random walk bars ending at endEpoch, seeded by symbol and time so that the same request gets the same bars
+    :return: (list of tuples) (date, open, high, low, close, volume, average, barCount)
+    """
+    n, unit = durationString.split()
+    interval = BAR_SECONDS[barSizeSetting]
+    count = min(int(n) * DURATION_SECONDS[unit] // interval, maxBars)
+    epochs = endEpoch - endEpoch % interval - interval * np.arange(count)[::-1]
+
+    rng = np.random.default_rng([zlib.crc32(symbol.encode()), int(endEpoch), interval])
+    close = 100. * np.exp(np.cumsum(rng.normal(0., 0.001, count)))
+    open = np.concatenate([[100.], close[:-1]])
+    spread = np.abs(rng.normal(0., 0.0005, count)) * close
+    high = np.maximum(open, close) + spread
+    low = np.minimum(open, close) - spread
+    volume = rng.integers(100, 10000, count)
+
+    if formatDate == 2:
+        barDates = [str(epoch) for epoch in epochs.tolist()]
+    elif interval >= 86400:
+        barDates = [dates.toIBBarDate(epoch)[:8] for epoch in epochs.tolist()]
+    else:
+        barDates = [dates.toIBBarDate(epoch) for epoch in epochs.tolist()]
+    return list(zip(barDates, open.round(2).tolist(), high.round(2).tolist(), low.round(2).tolist(),
+                    close.round(2).tolist(), volume.tolist(), ((open + close) / 2).round(3).tolist(),
+                    rng.integers(1, 100, count).tolist()))
+
+
+class FakeTWSConnection:
+    """
+    One client connection: the handshake, then historical and market data requests answered with synthetic data.
+    Historical requests are paced with IB's rules and answered with error 162 when they break them.
+    """
+    def __init__(self, server, sock):
+        self.server = server
+        self.socket = sock
+        self.sendLock = threading.Lock()
+        self.tickers = {}
+        # Held while ticking, so that a cancelled line cannot get its price back from a batch drawn before
+        self.tickersLock = threading.Lock()
+        self.connected = True
+        self.globalLimiter = schedulers.SlidingWindowLimiter(server.maxRequests, server.window)
+        self.contractLimiter = schedulers.SlidingWindowLimiter(
+            schedulers.MAX_CONTRACT_REQUESTS, schedulers.MAX_CONTRACT_REQUESTS_WINDOW)
+        self.lastSent = {}
+        self.rng = np.random.default_rng()
+
+    def send(self, *fields):
+        self.sendAll(makeMessage(*fields))
+
+    def sendAll(self, data):
+        try:
+            with self.sendLock:
+                self.socket.sendall(data)
+        except OSError:
+            self.connected = False
+
+    def run(self):
+        buf = b''
+        # The client opens with 'API\0' and its range of versions
+        while len(buf) < 4:
+            buf += self.socket.recv(4096)
+        buf = buf[4:]
+        messages, buf = readMessages(buf)
+        while not messages:
+            data = self.socket.recv(4096)
+            if not data:
+                return
+            messages, buf = readMessages(buf + data)
+        self.send(self.server.serverVersion, time.strftime('%Y%m%d %H:%M:%S EST'))
+        threading.Thread(target=self.tick, name='FakeTWSTicker', daemon=True).start()
+
+        # Whatever followed the version range is handled with the next messages
+        messages = messages[1:]
+        while self.connected:
+            for fields in messages:
+                self.handle(fields)
+            try:
+                data = self.socket.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            messages, buf = readMessages(buf + data)
+        self.connected = False
+        self.socket.close()
+
+    def handle(self, fields):
+        msgId = int(fields[0])
+        if msgId == OUT.START_API:
+            self.send(IN.NEXT_VALID_ID, 1, 1)
+            self.send(IN.MANAGED_ACCTS, 1, 'DU000000')
+        elif msgId == OUT.REQ_HEAD_TIMESTAMP:
+            reqId, formatDate = int(fields[1]), int(fields[17])
+            headTimestamp = self.server.headTimestamp
+            if not self.pace(reqId, fields[3], tuple(fields[2:])):
+                self.send(IN.HEAD_TIMESTAMP, reqId,
+                          headTimestamp if formatDate == 2 else dates.toIBBarDate(headTimestamp))
+        elif msgId == OUT.REQ_HISTORICAL_DATA:
+            reqId, symbol = int(fields[1]), fields[3]
+            endDateTime, barSizeSetting, durationString = fields[15:18]
+            if not self.pace(reqId, symbol, tuple(fields[2:])):
+                self.sendHistoricalData(reqId, symbol, endDateTime, durationString, barSizeSetting, int(fields[20]))
+        elif msgId == OUT.REQ_MKT_DATA:
+            reqId = int(fields[2])
+            if fields[17] == '1':
+                self.sendSnapshot(reqId)
+            elif len(self.tickers) >= self.server.maxLines:
+                self.send(IN.ERR_MSG, 2, reqId, schedulers.MAX_TICKERS_ERROR_CODE, MAX_TICKERS)
+            else:
+                with self.tickersLock:
+                    self.tickers[reqId] = 100.
+        elif msgId == OUT.CANCEL_MKT_DATA:
+            with self.tickersLock:
+                self.tickers.pop(int(fields[2]), None)
+        elif msgId == OUT.REQ_CONTRACT_DATA:
+            # No details, which leaves the contract as the client sent it
+            self.send(IN.CONTRACT_DATA_END, 1, int(fields[2]))
+
+    def pace(self, reqId, symbol, identicalKey):
+        """
+        :return: (Boolean) Whether the request broke a pacing rule, in which case it was answered with error 162
+        """
+        now = time.monotonic()
+        violation = not self.globalLimiter.allow() or not self.contractLimiter.allow(symbol) or \
+            now - self.lastSent.get(identicalKey, -schedulers.IDENTICAL_REQUEST_INTERVAL) < \
+            schedulers.IDENTICAL_REQUEST_INTERVAL or self.rng.random() < self.server.pacingErrorRate
+        self.globalLimiter.record()
+        self.contractLimiter.record(symbol)
+        self.lastSent[identicalKey] = now
+        if violation:
+            self.send(IN.ERR_MSG, 2, reqId, 162, PACING_VIOLATION)
+        return violation
+
+    def sendHistoricalData(self, reqId, symbol, endDateTime, durationString, barSizeSetting, formatDate):
+        endEpoch = dates.toEpoch(endDateTime) if endDateTime else int(time.time())
+        bars = makeBars(symbol, endEpoch, durationString, barSizeSetting, formatDate, self.server.maxBars)
+        n, unit = durationString.split()
+        startEpoch = endEpoch - int(n) * DURATION_SECONDS[unit]
+        fields = [IN.HISTORICAL_DATA, reqId, dates.toIBDate(startEpoch), dates.toIBDate(endEpoch), len(bars)]
+        for bar in bars:
+            fields.extend(bar)
+        self.sendAll(makeMessage(*fields))
+
+    def sendSnapshot(self, reqId):
+        price = 100. * (1. + self.rng.normal(0., 0.01))
+        self.sendAll(b''.join([makeMessage(IN.TICK_PRICE, 6, reqId, tickType, round(price, 2), 100, 0)
+                               for tickType in TICK_PRICE_TYPES] + [makeMessage(IN.TICK_SNAPSHOT_END, 1, reqId)]))
+
+    def tick(self):
+        # Sends server.tickRate ticks per second, spread over the subscribed lines, in 1 ms batches
+        perBatch = self.server.tickRate / 1000.
+        owed = 0.
+        while self.connected:
+            time.sleep(0.001)
+            reqIds = list(self.tickers)
+            if not reqIds:
+                continue
+            owed += perBatch
+            n = int(owed)
+            owed -= n
+            data = []
+            with self.tickersLock:
+                for reqId in self.rng.choice(reqIds, n).tolist():
+                    if reqId not in self.tickers:
+                        continue
+                    price = self.tickers[reqId] * (1. + self.rng.normal(0., 0.0001))
+                    self.tickers[reqId] = price
+                    tickType = TICK_PRICE_TYPES[int(self.rng.integers(0, 3))]
+                    data.append(makeMessage(IN.TICK_PRICE, 6, reqId, tickType, round(price, 2),
+                                            int(self.rng.integers(1, 500)), 0))
+            if data:
+                self.sendAll(b''.join(data))
+
+
+class FakeTWSServer:
+    """
+    Local stand-in for TWS or IB Gateway which speaks enough of the 9.81 wire protocol for reqHeadTimeStamp,
+    reqHistoricalData, reqContractDetails and reqMktData, so that sessions can be load-tested without a network.
+    """
+    def __init__(self, host='127.0.0.1', port=0, serverVersion=MAX_CLIENT_VER, headTimestamp=HEAD_TIMESTAMP,
+                 maxBars=10000, tickRate=10000, pacingErrorRate=0., maxRequests=schedulers.MAX_REQUESTS,
+                 window=schedulers.MAX_REQUESTS_WINDOW, maxLines=schedulers.MAX_MARKET_DATA_LINES):
+        """
+        :param port: (int) 0 picks a free port, see self.port once started
+        :param headTimestamp: (int) Epoch seconds of the earliest bar of every contract
+        :param maxBars: (int) Most bars in the answer to one historical data request
+        :param tickRate: (float) Ticks per second per connection, across its market data lines
+        :param pacingErrorRate: (float) Probability that a historical request fails with error 162 anyway
+        :param maxRequests: (int) Historical requests allowed per window, as IB's 60 per 10 minutes
+        :param window: (float) Seconds
+        :param maxLines: (int) Streaming market data subscriptions allowed per connection, more fail with error 101
+        """
+        self.serverVersion = serverVersion
+        self.headTimestamp = headTimestamp
+        self.maxBars = maxBars
+        self.tickRate = tickRate
+        self.pacingErrorRate = pacingErrorRate
+        self.maxRequests = maxRequests
+        self.window = window
+        self.maxLines = maxLines
+        self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen()
+        self.port = self.socket.getsockname()[1]
+        self.connections = []
+
+    def serveForever(self):
+        logger.info('FakeTWSServer listening on port %d', self.port)
+        while True:
+            try:
+                sock, _ = self.socket.accept()
+            except OSError:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = FakeTWSConnection(self, sock)
+            self.connections.append(connection)
+            threading.Thread(target=connection.run, name='FakeTWSConnection', daemon=True).start()
+
+    def start(self):
+        threading.Thread(target=self.serveForever, name='FakeTWSServer', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.socket.close()
+        for connection in self.connections:
+            connection.connected = False
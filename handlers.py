@@ -1,6 +1,13 @@
-import etc
+import time
+import dates
+import buffers
+import columnar
+import threading
 import databases
-import pandas as pd
+import indicators
+import volatility
+import aggregators
+import numpy as np
 
 
 class IBHistoricBarHandler:
@@ -21,53 +28,309 @@ class IBHistoricBarHandler:
     def reindexRecord(self, newReqId, oldReqId):
         self.records[newReqId] = self.records.pop(oldReqId)
 
-    def closeRecord(self, reqId):
+    def removeRecord(self, reqId):
+        return self.records.pop(reqId)
+
+    @staticmethod
+    def getDatabase(whatToShow):
+        """
+        :param whatToShow: (str) https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_what_to_show
+        :return: (databases.IBHistoricalDatabase) Database which stores bars of whatToShow. ADJUSTED_LAST bars are
+                 derived from the TRADES bars and the factor table stored next to them, see adjustments
+        """
+        if whatToShow in ('TRADES', 'ADJUSTED_LAST'):
+            return databases.HistoricalTradesDatabase()
+        else:
+            raise NotImplementedError
+
+    @staticmethod
+    def getWriter(whatToShow):
+        """
+        :return: (databases.HistoricalBarWriter) Writer of the database which stores bars of whatToShow
+        """
+        db = IBHistoricBarHandler.getDatabase(whatToShow)
+        columnar.getStore(db)
+        return databases.getWriter(db)
+
+    def saveHeadTimestamp(self, reqId):
+        event = self.records[reqId]
+        writer = self.getWriter(event.whatToShow)
+        writer.setHeadTimestamp(event.contract.symbol, event.whatToShow, event.barSizeSetting,
+                                dates.toEpoch(event.headTimestamp))
+
+    def closeRecord(self, reqId, start, end):
+        """
+        Saves the bars of a finished request, records [start, end] as covered and removes the record
+        :param reqId: (int)
+        :param start: (str) Start of the batch as sent in historicalDataEnd
+        :param end: (str) End of the batch as sent in historicalDataEnd
+        :return: Nothing
+        """
         event = self.records[reqId]
 
         bars = event.bars
-        whatToShow = event.whatToShow
         ticker = event.contract.symbol
 
-        df = pd.concat(bars, axis=1, join='outer').T.iloc[::-1]
+        writer = self.getWriter(event.whatToShow)
+        if event.whatToShow == 'ADJUSTED_LAST':
 
-        if whatToShow == 'ADJUSTED_LAST':
-            db = databases.HistoricalAdjustedLastDatabase()
-        elif whatToShow == 'TRADES':
-            db = databases.HistoricalTradesDatabase()
-        else:
-            raise NotImplementedError
+            # Only ever requested as the comparison window which keeps the factor table current
+            writer.updateAdjustments(ticker, bars.toRecords())
+            del self.records[reqId]
+            return
+        writer.upsertBars(ticker, event.barSizeSetting, bars.toRecords())
+        writer.addCoverage(ticker, event.whatToShow, event.barSizeSetting, dates.toEpoch(start), dates.toEpoch(end))
+
+        del self.records[reqId]
+
+
+class MovingAverageHandler:
+    def __init__(self, capacity, window, barSize=None, span=None):
+        """
+        :param capacity: (int) Most symbols subscribed at the same time
+        :param window: (int) Bars (or trades) the rolling indicators look back
+        :param barSize: (str) Completed bars of this size update the indicators. None updates them on every trade
+        :param span: (int) Span of the EMA, defaults to window
+        """
+        self.engine = indicators.IndicatorEngine(capacity, window, span)
+        self.barSize = barSize
+        self.updates = 0
+
+    def update(self, rows, prices, volumes):
+        self.engine.update(rows, prices, volumes)
+        self.updates += 1
+        if self.updates % (100 * self.engine.window) == 0:
+            self.engine.recompute()
+
+    def onBars(self, bars):
+        if bars.barSize == self.barSize:
+            self.update(bars.rows, bars.close, bars.volume)
+
+    def onTrade(self, row, price, size):
+        if self.barSize is None:
+            self.update([row], [price], [size])
+
+    def warmUp(self, quoteStore, db, barSize=None):
+        """
+        Fills the indicators of every subscribed symbol from stored bars with one bulk read
+        :param quoteStore: (buffers.QuoteStore) Store whose rows the indicators follow
+        :param db: (databases.IBHistoricalDatabase) Database to read bars from
+        :param barSize: (str) Stored bars to warm up from, defaults to self.barSize. Required when the indicators
+                        are updated on every trade, since trades are not stored
+        :return: Nothing
+        """
+        barSize = barSize or self.barSize
+        if barSize is None:
+            raise ValueError('Indicators updated on every trade need a barSize to warm up from')
+        window = self.engine.window
+        rows = np.array(sorted(quoteStore.rows.values()), dtype=np.int64)
+        symbols = [quoteStore.symbols[row] for row in rows]
 
         db.connect()
-        db.insertDf(ticker, df)
+        records = db.getLastBars(symbols, barSize, window)
         db.close()
+        if not records:
+            return
 
-        event.bars = []
-        self.records[reqId] = event
+        # Right-align each symbol's bars, oldest first, in a (time, symbol) matrix
+        records = np.array(records, dtype=np.float64)
+        records = records[np.lexsort((records[:, 1], records[:, 0]))]
+        symbolIndex = records[:, 0].astype(np.int64)
+        counts = np.bincount(symbolIndex, minlength=len(rows))
+        starts = np.cumsum(counts) - counts
+        times = window - counts[symbolIndex] + np.arange(len(records)) - starts[symbolIndex]
+
+        prices = np.full((window, len(rows)), np.nan)
+        volumes = np.zeros((window, len(rows)))
+        prices[times, symbolIndex] = records[:, 2]
+        volumes[times, symbolIndex] = records[:, 3]
+        self.engine.warmUp(rows, prices, volumes)
+
+    def removeRow(self, row):
+        self.engine.reset(row)
+
+
+class ImpliedVolHandler:
+    """
+    Implied vols and greeks of the option rows of a QuoteStore, solved for all of them at once from the latest
+    quotes. Each solve starts from the previous one, so it usually converges in a couple of Newton steps.
+    """
+    def __init__(self, capacity, rate=volatility.RISK_FREE_RATE, dividend=0.):
+        self.rate = rate
+        self.dividend = dividend
+        self.underlyingRows = np.full(capacity, -1, dtype=np.int64)
+        self.strikes = np.full(capacity, np.nan)
+        self.expiries = np.zeros(capacity, dtype=np.int64)
+        self.isCall = np.zeros(capacity, dtype=bool)
+        self.vols = np.full(capacity, np.nan)
+        self.greeks = {greek: np.full(capacity, np.nan) for greek in ['delta', 'gamma', 'theta', 'vega']}
+
+    def addOption(self, row, contract, quoteStore):
+        """
+        :param row: (int) Row of the option in the QuoteStore
+        :param contract: (contracts.Contract) Option contract, whose localSymbol is its OCC symbol
+        :param quoteStore: (buffers.QuoteStore) Store in which the underlying must already be subscribed
+        :return: (Boolean) Whether the underlying was found
+        """
+        underlying, expiry, strike, isCall = volatility.parseOccSymbol(contract.localSymbol)
+        underlyingRows = np.flatnonzero(quoteStore.symbols == underlying)
+        if len(underlyingRows) == 0:
+            return False
+        self.underlyingRows[row] = underlyingRows[0]
+        self.strikes[row] = strike
+        # Options stop trading at the close of their expiry
+        self.expiries[row] = dates.toEpoch(expiry + ' 16:00:00')
+        self.isCall[row] = isCall
+        return True
+
+    def removeRow(self, row):
+        self.underlyingRows[row] = -1
+        self.vols[row] = np.nan
+        for values in self.greeks.values():
+            values[row] = np.nan
+
+    @staticmethod
+    def getPrices(quoteStore, rows):
+        bid = quoteStore.values[buffers.BID, rows]
+        ask = quoteStore.values[buffers.ASK, rows]
+        return np.where((bid > 0) & (ask > bid), 0.5 * (bid + ask), quoteStore.values[buffers.LAST, rows])
+
+    def update(self, quoteStore, epoch):
+        """
+        :param quoteStore: (buffers.QuoteStore)
+        :param epoch: (float) Epoch seconds now
+        :return: (np.ndarray) Option rows which were solved
+        """
+        rows = np.flatnonzero(self.underlyingRows >= 0)
+        if len(rows) == 0:
+            return rows
+        spots = self.getPrices(quoteStore, self.underlyingRows[rows])
+        times = (self.expiries[rows] - epoch) / (volatility.DAYS_PER_YEAR * 24 * 60 * 60)
+        prices = self.getPrices(quoteStore, rows)
+        vols = volatility.getImpliedVols(prices, spots, self.strikes[rows], times, self.isCall[rows], self.rate,
+                                         self.dividend, guesses=self.vols[rows])
+        self.vols[rows] = vols
+        greeks = volatility.getGreeks(spots, self.strikes[rows], times, vols, self.isCall[rows], self.rate,
+                                      self.dividend)
+        for greek, values in greeks.items():
+            self.greeks[greek][rows] = values
+        return rows
 
 
 class IBTickHandler:
-    def __init__(self):
+    def __init__(self, capacity=4096, barSizes=(), volumeThresholds=(), movingAverageHandler=None,
+                 impliedVolHandler=None):
+        """
+        :param capacity: (int) Most symbols subscribed at the same time
+        :param barSizes: (list of str) Time bars to build from trades, e.g. '5 secs' or '1 min'
+        :param volumeThresholds: (list of int) Volume bars to build from trades, in shares per bar
+        :param movingAverageHandler: (MovingAverageHandler) Indicators to keep up to date from trades or bars
+        :param impliedVolHandler: (ImpliedVolHandler) Implied vols to keep up to date for subscribed options
+        """
         self.records = {}
-        # self.movingAverageHandler = MovingAverageHandler()
+        self.quoteStore = buffers.QuoteStore(capacity)
+        # Epoch seconds since which each row streams every trade, as opposed to snapshots or no line at all
+        self.streamingSince = np.full(capacity, np.inf)
+        self.aggregators = [aggregators.TimeBarAggregator(barSize, capacity) for barSize in barSizes] + \
+                           [aggregators.VolumeBarAggregator(threshold, capacity) for threshold in volumeThresholds]
+        self.lock = threading.Lock()
+        self.movingAverageHandler = movingAverageHandler
+        self.impliedVolHandler = impliedVolHandler
 
     def createRecord(self, reqId, event):
         self.records[reqId] = event
+        self.quoteStore.addSymbol(reqId, event.contract.symbol or event.contract.localSymbol)
+        self.streamingSince[self.quoteStore.rows[reqId]] = np.inf
+        if self.impliedVolHandler and event.contract.secType == 'OPT':
+            self.impliedVolHandler.addOption(self.quoteStore.rows[reqId], event.contract, self.quoteStore)
 
-    def refreshRecord(self, reqId, tickType, *args):
-        if tickType == etc.BID_PRICE_TICK_TYPE:
-            self.records[reqId]['bid'] = args[0]
-        elif tickType == etc.ASK_PRICE_TICK_TYPE:
-            self.records[reqId]['ask'] = args[0]
-        elif tickType == etc.LAST_PRICE_TICK_TYPE:
-            self.records[reqId]['last'] = args[0]
-        else:
-            if not self.records[reqId]['last']:
-                if tickType == etc.LAST_RTH_TRADED_PRICE:
-                    self.records[reqId]['last'] = args[0]
+    def setStreaming(self, reqId, epoch):
+        """
+        Only bars of rows which streamed for their whole interval are recorded as coverage. The first bar after a
+        subscription is partial, and snapshots or a cancelled line miss trades.
+        :param reqId: (int)
+        :param epoch: (float) Epoch seconds the stream started, or None when it stopped
+        :return: Nothing
+        """
+        self.streamingSince[self.quoteStore.rows[reqId]] = np.inf if epoch is None else epoch
+
+    def updateImpliedVols(self, epoch):
+        if self.impliedVolHandler:
+            with self.lock:
+                self.impliedVolHandler.update(self.quoteStore, epoch)
+
+    def refreshRecord(self, reqId, tickType, value, receiveTime=None):
+        """
+        :param reqId: (int)
+        :param tickType: (int) See https://interactivebrokers.github.io/tws-api/tick_types.html
+        :param value: (float) Price or size
+        :param receiveTime: (int) Epoch nanoseconds, defaults to now
+        :return: (int) Column of buffers.QUOTE_FIELDS updated, or None if the tick type is not kept
+        """
+        column = self.quoteStore.update(reqId, tickType, value, receiveTime)
+        if column == buffers.LAST_SIZE and (self.aggregators or self.movingAverageHandler):
+            self.addTrade(reqId, value, receiveTime)
+        return column
+
+    def addTrade(self, reqId, size, receiveTime=None):
+        # IB sends the size of a trade right after its price
+        row = self.quoteStore.rows[reqId]
+        price = self.quoteStore.values[buffers.LAST, row]
+        if np.isnan(price) or size <= 0:
+            return
+
+        epoch = receiveTime / 1e9 if receiveTime else time.time()
+        with self.lock:
+            if self.movingAverageHandler:
+                self.movingAverageHandler.onTrade(row, price, size)
+            for aggregator in self.aggregators:
+                completed = aggregator.update(row, price, size, epoch)
+                if completed:
+                    self.saveBars(completed)
+
+    def rollBars(self, epoch):
+        """
+        Closes the time bars whose interval ended before epoch, even if no trade arrived since
+        :param epoch: (float) Epoch seconds now
+        :return: Nothing
+        """
+        with self.lock:
+            for aggregator in self.aggregators:
+                completed = aggregator.roll(epoch)
+                if completed:
+                    self.saveBars(completed)
+
+    def saveBars(self, bars):
+        if self.movingAverageHandler:
+            self.movingAverageHandler.onBars(bars)
+
+        db = databases.HistoricalTradesDatabase()
+        columnar.getStore(db)
+        writer = databases.getWriter(db)
+        if aggregators.isVolumeBarSize(bars.barSize):
+            for i, row in enumerate(bars.rows):
+                writer.upsertVolumeBars(self.quoteStore.symbols[row], bars.barSize, [(
+                    int(round(bars.epochs[i] * 1e6)), int(bars.sequences[i]), bars.open[i], bars.high[i],
+                    bars.low[i], bars.close[i], bars.volume[i], int(bars.barCount[i]), bars.average[i])])
+            return
 
-                if not self.records[reqId]['last']:
-                    if tickType == etc.CLOSE_PRICE_TICK_TYPE:
-                        self.records[reqId]['last'] = args[0]
+        interval = aggregators.BAR_SIZE_SECONDS.get(bars.barSize)
+        for i, row in enumerate(bars.rows):
+            symbol = self.quoteStore.symbols[row]
+            epoch = int(bars.epochs[i])
+            writer.upsertBars(symbol, bars.barSize, [(
+                dates.toIBBarDate(epoch), bars.open[i], bars.high[i], bars.low[i], bars.close[i], bars.volume[i],
+                int(bars.barCount[i]), bars.average[i])])
+            if interval and self.streamingSince[row] <= epoch:
+                writer.addCoverage(symbol, 'TRADES', bars.barSize, epoch, epoch + interval)
 
     def closeRecord(self, reqId):
         del self.records[reqId]
+        with self.lock:
+            for aggregator in self.aggregators:
+                aggregator.reset(self.quoteStore.rows[reqId])
+            if self.movingAverageHandler:
+                self.movingAverageHandler.removeRow(self.quoteStore.rows[reqId])
+            if self.impliedVolHandler:
+                self.impliedVolHandler.removeRow(self.quoteStore.rows[reqId])
+        self.quoteStore.removeSymbol(reqId)
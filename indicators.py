@@ -0,0 +1,100 @@
+import numpy as np
+
+
+class IndicatorEngine:
+    """
+    Rolling SMA, variance and VWAP over the last window updates plus an EMA, for every row of a QuoteStore at once.
+    Prices and volumes are kept in (window, row) ring buffers next to running sums, so an update costs O(1) per row
+    and is a handful of NumPy operations however many rows it touches.
+    """
+    def __init__(self, capacity, window, span=None):
+        """
+        :param capacity: (int) Number of rows, as in the QuoteStore
+        :param window: (int) Number of updates the rolling indicators look back
+        :param span: (int) Span of the EMA, defaults to window
+        """
+        self.window = window
+        self.alpha = 2. / ((span or window) + 1.)
+        self.prices = np.zeros((window, capacity))
+        self.volumes = np.zeros((window, capacity))
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.sum = np.zeros(capacity)
+        self.sumSq = np.zeros(capacity)
+        self.notional = np.zeros(capacity)
+        self.volume = np.zeros(capacity)
+        self.ema = np.full(capacity, np.nan)
+
+    def update(self, rows, prices, volumes):
+        """
+        :param rows: (np.ndarray) Rows to update, each at most once
+        :param prices: (np.ndarray) New price per row
+        :param volumes: (np.ndarray) New volume per row
+        :return: Nothing
+        """
+        rows = np.asarray(rows)
+        prices = np.asarray(prices, dtype=np.float64)
+        volumes = np.asarray(volumes, dtype=np.float64)
+        positions = self.counts[rows] % self.window
+
+        # Whatever falls out of the window leaves the running sums; the buffers start at zero so nothing does at first
+        oldPrices = self.prices[positions, rows]
+        oldVolumes = self.volumes[positions, rows]
+        self.sum[rows] += prices - oldPrices
+        self.sumSq[rows] += prices * prices - oldPrices * oldPrices
+        self.notional[rows] += prices * volumes - oldPrices * oldVolumes
+        self.volume[rows] += volumes - oldVolumes
+        self.prices[positions, rows] = prices
+        self.volumes[positions, rows] = volumes
+
+        ema = self.ema[rows]
+        self.ema[rows] = np.where(np.isnan(ema), prices, ema + self.alpha * (prices - ema))
+        self.counts[rows] += 1
+
+    def reset(self, row):
+        self.prices[:, row] = 0.
+        self.volumes[:, row] = 0.
+        self.counts[row] = 0
+        self.sum[row] = self.sumSq[row] = self.notional[row] = self.volume[row] = 0.
+        self.ema[row] = np.nan
+
+    def recompute(self):
+        # Running sums slowly pick up rounding errors, so rebuild them from the buffers every so often
+        self.sum = self.prices.sum(axis=0)
+        self.sumSq = (self.prices * self.prices).sum(axis=0)
+        self.notional = (self.prices * self.volumes).sum(axis=0)
+        self.volume = self.volumes.sum(axis=0)
+
+    def getN(self):
+        n = np.minimum(self.counts, self.window).astype(np.float64)
+        n[n == 0] = np.nan
+        return n
+
+    def getSMA(self):
+        return self.sum / self.getN()
+
+    def getVariance(self):
+        n = self.getN()
+        mean = self.sum / n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.maximum(self.sumSq / n - mean * mean, 0.) * n / (n - 1)
+
+    def getEMA(self):
+        return self.ema
+
+    def getVWAP(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.volume > 0, self.notional / self.volume, np.nan)
+
+    def warmUp(self, rows, prices, volumes):
+        """
+        Replays history into the engine, one vectorized update per time step
+        :param rows: (np.ndarray) Rows the columns belong to
+        :param prices: (np.ndarray) (time, row) prices, oldest first, NaN where a row has no bar
+        :param volumes: (np.ndarray) (time, row) volumes, oldest first
+        :return: Nothing
+        """
+        rows = np.asarray(rows)
+        for t in range(len(prices)):
+            mask = ~np.isnan(prices[t])
+            if mask.any():
+                self.update(rows[mask], prices[t, mask], volumes[t, mask])
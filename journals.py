@@ -0,0 +1,363 @@
+import os
+import csv
+import etc
+import mmap
+import time
+import dates
+import struct
+import logging
+import contracts
+import numpy as np
+from datetime import datetime, timedelta
+from ibapi.common import BarData, TickAttrib
+
+
+logger = logging.getLogger(__name__)
+
+# Receive time in epoch nanoseconds, reqId, tick type, kind, flags and two values
+RECORD = struct.Struct('<qihBBdd')
+RECORD_DTYPE = np.dtype([('time', '<i8'), ('reqId', '<i4'), ('tickType', '<i2'), ('kind', 'u1'), ('flags', 'u1'),
+                         ('a', '<f8'), ('b', '<f8')])
+RECORD_SIZE = RECORD.size
+SEGMENT_RECORDS = 1 << 20
+SEGMENT_SUFFIX = '.ticks'
+CONTRACTS_FILE = 'contracts.csv'
+RUN_PREFIX = 'run-'
+CONTRACT_FIELDS = ['reqId', 'secType', 'symbol', 'exchange', 'currency', 'conId', 'primaryExchange']
+
+# Kinds of record. A bar takes one BAR record with its date and open, then BAR_VALUES records with high and low,
+# close and volume, average and barCount
+TICK_PRICE = 1
+TICK_SIZE = 2
+TICK_GENERIC = 3
+BAR = 4
+BAR_VALUES = 5
+BAR_END = 6
+BAR_RECORDS = 4
+
+# Flags of TICK_PRICE records, from its TickAttrib
+CAN_AUTO_EXECUTE = 1
+PAST_LIMIT = 2
+PRE_OPEN = 4
+# Flags of BAR records, from the format of the bar's date
+DAILY_DATE = 1
+EPOCH_DATE = 2
+
+
+def packDate(date):
+    """
+    :param date: (str) IB date such as '20180104  09:30:00', '20180104 09:30:00', '20180104' or epoch seconds
+    :return: (int) Its digits, e.g. 20180104093000, which a float holds exactly and which is quicker than parsing
+    """
+    return int(date[:8] + date[-8:-6] + date[-5:-3] + date[-2:]) if len(date) > 10 else int(date)
+
+
+def unpackDate(value, separator='  '):
+    digits = '%014d' % value
+    return '%s%s%s:%s:%s' % (digits[:8], separator, digits[8:10], digits[10:12], digits[12:])
+
+
+def getSegmentPath(dayPath, segment):
+    return os.path.join(dayPath, 'segment-%06d%s' % (segment, SEGMENT_SUFFIX))
+
+
+def getRotation(epoch):
+    """
+    :return: (tuple) Trading date of epoch in US/Eastern, and the epoch nanoseconds of the midnight which ends it
+    """
+    day = dates.toDate(epoch)
+    midnight = dates.TIMEZONE.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    return day, int(midnight.timestamp()) * 10 ** 9
+
+
+def getRunPaths(dayPath):
+    """
+    :return: (list of str) Directory of every run which journaled the day, in the order they started. A day written
+             before runs had their own directory is a run of its own.
+    """
+    names = sorted(name for name in os.listdir(dayPath) if name.startswith(RUN_PREFIX))
+    legacy = [dayPath] if os.path.exists(os.path.join(dayPath, CONTRACTS_FILE)) else []
+    return legacy + [os.path.join(dayPath, name) for name in names]
+
+
+def toContract(row):
+    # Options and futures are identified by their localSymbol, see contracts.Contract
+    contract = contracts.Contract(row['secType'], row['symbol'], row['exchange'], row['currency'])
+    contract.conId = int(row['conId'] or 0)
+    contract.primaryExchange = row['primaryExchange']
+    return contract
+
+
+class TickJournal:
+    """
+    Append-only journal of every tick and bar callback, as fixed 32 byte records in memory-mapped segment files of
+    directory/YYYYMMDD/run-N/, a new directory every day at midnight US/Eastern and for every run, N being when the
+    run started in epoch nanoseconds. The market data subscriptions live in contracts.csv next to the segments, so that
+    every day can be replayed on its own, and a restart, whose reqIds start over, never maps earlier ticks to its
+    contracts.
+    Not thread-safe: it is written from the thread which runs the EClient's message loop.
+    """
+    def __init__(self, directory=None, segmentRecords=SEGMENT_RECORDS):
+        """
+        :param directory: (str) Defaults to etc.PATH/journal
+        :param segmentRecords: (int) Records per segment file
+        """
+        self.directory = directory or os.path.join(etc.PATH, 'journal')
+        self.segmentSize = segmentRecords * RECORD_SIZE
+        self.contracts = {}
+        self.run = RUN_PREFIX + str(time.time_ns())
+        self.day = None
+        self.dayPath = None
+        self.file = None
+        self.mmap = None
+        self.offset = 0
+        self.segmentEnd = 0
+        self.rotateAt = 0
+        # The hot path writes one record at a time, so it skips the lookups of RECORD.pack_into and reserve
+        self.pack = RECORD.pack_into
+
+    def open(self, receiveTime):
+        self.close()
+        if receiveTime >= self.rotateAt:
+            self.day, self.rotateAt = getRotation(receiveTime // 10 ** 9)
+            self.dayPath = os.path.join(self.directory, self.day.strftime('%Y%m%d'), self.run)
+            os.makedirs(self.dayPath, exist_ok=True)
+            self.writeContracts()
+
+        segment = sum(name.endswith(SEGMENT_SUFFIX) for name in os.listdir(self.dayPath))
+        path = getSegmentPath(self.dayPath, segment)
+        self.file = open(path, 'w+b')
+        self.file.truncate(self.segmentSize)
+        self.mmap = mmap.mmap(self.file.fileno(), self.segmentSize)
+        self.offset = 0
+        self.segmentEnd = self.segmentSize
+        logger.info('Journaling to %s', path)
+
+    def close(self):
+        # Trims the unused end of the segment, which a reader would otherwise take for its end
+        if self.mmap is not None:
+            self.mmap.flush()
+            self.mmap.close()
+            self.file.truncate(self.offset)
+            self.file.close()
+            self.mmap = None
+            self.file = None
+            self.segmentEnd = 0
+
+    def reserve(self, receiveTime, n):
+        # Byte offset of n consecutive records, in a new segment if they do not fit in this one or the day is over
+        if receiveTime >= self.rotateAt or self.offset + n * RECORD_SIZE > self.segmentEnd:
+            self.open(receiveTime)
+        offset = self.offset
+        self.offset += n * RECORD_SIZE
+        return offset
+
+    def writeContracts(self):
+        with open(os.path.join(self.dayPath, CONTRACTS_FILE), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(CONTRACT_FIELDS)
+            for reqId, contract in self.contracts.items():
+                writer.writerow(self.getContractRow(reqId, contract))
+
+    @staticmethod
+    def getContractRow(reqId, contract):
+        symbol = contract.localSymbol if contract.secType in ['OPT', 'FUT'] else contract.symbol
+        return [reqId, contract.secType, symbol, contract.exchange, contract.currency, contract.conId,
+                contract.primaryExchange]
+
+    def subscribe(self, reqId, contract):
+        """
+        Records a market data subscription, whose ticks follow under reqId
+        :param reqId: (int)
+        :param contract: (contracts.Contract)
+        :return: Nothing
+        """
+        if reqId in self.contracts:
+            raise ValueError('reqId %d is already journaled for %s' % (reqId, self.contracts[reqId].symbol))
+        self.contracts[reqId] = contract
+        now = time.time_ns()
+        if now >= self.rotateAt:
+            # Starting a day writes every subscription, this one included
+            self.open(now)
+        else:
+            with open(os.path.join(self.dayPath, CONTRACTS_FILE), 'a', newline='') as f:
+                csv.writer(f).writerow(self.getContractRow(reqId, contract))
+
+    def unsubscribe(self, reqId):
+        # Takes effect from the next day, since the ticks already journaled still need the contract
+        self.contracts.pop(reqId, None)
+
+    def tickPrice(self, reqId, tickType, price, attrib, receiveTime=None):
+        receiveTime = receiveTime or time.time_ns()
+        flags = attrib.canAutoExecute | attrib.pastLimit << 1 | attrib.preOpen << 2
+        offset = self.offset
+        if offset >= self.segmentEnd or receiveTime >= self.rotateAt:
+            offset = self.reserve(receiveTime, 1)
+        else:
+            self.offset = offset + RECORD_SIZE
+        self.pack(self.mmap, offset, receiveTime, reqId, tickType, TICK_PRICE, flags, price, 0.)
+
+    def tickSize(self, reqId, tickType, size, receiveTime=None):
+        receiveTime = receiveTime or time.time_ns()
+        offset = self.offset
+        if offset >= self.segmentEnd or receiveTime >= self.rotateAt:
+            offset = self.reserve(receiveTime, 1)
+        else:
+            self.offset = offset + RECORD_SIZE
+        self.pack(self.mmap, offset, receiveTime, reqId, tickType, TICK_SIZE, 0, size, 0.)
+
+    def tickGeneric(self, reqId, tickType, value, receiveTime=None):
+        receiveTime = receiveTime or time.time_ns()
+        offset = self.offset
+        if offset >= self.segmentEnd or receiveTime >= self.rotateAt:
+            offset = self.reserve(receiveTime, 1)
+        else:
+            self.offset = offset + RECORD_SIZE
+        self.pack(self.mmap, offset, receiveTime, reqId, tickType, TICK_GENERIC, 0, value, 0.)
+
+    def historicalData(self, reqId, bar, receiveTime=None):
+        receiveTime = receiveTime or time.time_ns()
+        flags = 0 if len(bar.date) > 10 else DAILY_DATE if len(bar.date) == 8 else EPOCH_DATE
+        offset = self.reserve(receiveTime, BAR_RECORDS)
+        for kind, flag, a, b in [(BAR, flags, packDate(bar.date), bar.open), (BAR_VALUES, 0, bar.high, bar.low),
+                                 (BAR_VALUES, 0, bar.close, bar.volume), (BAR_VALUES, 0, bar.average, bar.barCount)]:
+            RECORD.pack_into(self.mmap, offset, receiveTime, reqId, 0, kind, flag, a, b)
+            offset += RECORD_SIZE
+
+    def historicalDataEnd(self, reqId, start, end, receiveTime=None):
+        receiveTime = receiveTime or time.time_ns()
+        RECORD.pack_into(self.mmap, self.reserve(receiveTime, 1), receiveTime, reqId, 0, BAR_END, 0,
+                         packDate(start), packDate(end))
+
+
+def readSegment(path):
+    """
+    :return: (np.ndarray) Records of RECORD_DTYPE, up to the first unwritten one of a segment which was not closed
+    """
+    records = np.fromfile(path, dtype=RECORD_DTYPE)
+    unwritten = np.flatnonzero(records['time'] == 0)
+    return records[:unwritten[0]] if len(unwritten) else records
+
+
+def readContracts(dayPath):
+    """
+    :return: (dict) contracts.Contract subscribed per reqId
+    """
+    path = os.path.join(dayPath, CONTRACTS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline='') as f:
+        return {int(row['reqId']): toContract(row) for row in csv.DictReader(f)}
+
+
+class JournalReplayer:
+    """
+    Feeds a TickJournal back through the EWrapper callbacks which wrote it, in order, at the original pace, faster or
+    as fast as possible. A wrapper with a clock attribute, e.g. sessions.IBLiveSession, is given the journaled receive
+    times, so that a replay builds the same bars as the live session did.
+    """
+    def __init__(self, directory=None, speed=None, days=None):
+        """
+        :param directory: (str) Defaults to etc.PATH/journal
+        :param speed: (float) 1 replays at the original pace, 10 ten times faster, None as fast as possible
+        :param days: (list of str) Days to replay as YYYYMMDD, defaults to every day in the journal
+        """
+        self.directory = directory or os.path.join(etc.PATH, 'journal')
+        self.speed = speed
+        self.days = days
+        self.receiveTime = 0
+
+    def getDays(self):
+        return sorted(day for day in os.listdir(self.directory) if day.isdigit()) if self.days is None else self.days
+
+    def read(self):
+        """
+        :return: (generator) Name of the run, contracts it subscribed per reqId and records of each of its segments, in
+                 the order written
+        """
+        for day in self.getDays():
+            dayPath = os.path.join(self.directory, day)
+            for runPath in getRunPaths(dayPath):
+                # Days journaled without runs share their reqIds, like a single run
+                run = '' if runPath == dayPath else os.path.basename(runPath)
+                subscriptions = readContracts(runPath)
+                for name in sorted(os.listdir(runPath)):
+                    if name.endswith(SEGMENT_SUFFIX):
+                        yield run, subscriptions, readSegment(os.path.join(runPath, name))
+
+    def replay(self, wrapper, subscribe=None):
+        """
+        :param wrapper: (ibapi.wrapper.EWrapper) Receives tickPrice, tickSize, tickGeneric, historicalData and
+                        historicalDataEnd
+        :param subscribe: (callable) Called with (reqId, contract) for each subscription before its first tick, e.g. to
+                          create the record of a handler
+        :return: (int) Callbacks replayed
+        """
+        clock = getattr(wrapper, 'clock', None)
+        if clock is not None:
+            wrapper.clock = lambda: self.receiveTime
+
+        # Each run numbers its reqIds from scratch, so a contract is replayed under the reqId it first had, and a
+        # reqId which an earlier run used for another contract under a new one
+        replayIds = {}
+        keys = {}
+        used = set()
+        count = 0
+        start = None
+        bar = None
+        try:
+            for run, subscriptions, records in self.read():
+                for reqId, contract in subscriptions.items():
+                    if (run, reqId) in replayIds:
+                        continue
+                    key = tuple(TickJournal.getContractRow(0, contract)[1:])
+                    replayId = keys.get(key)
+                    if replayId is None:
+                        replayId = max(used) + 1 if reqId in used else reqId
+                        keys[key] = replayId
+                        used.add(replayId)
+                        if subscribe is not None:
+                            subscribe(replayId, contract)
+                    replayIds[run, reqId] = replayId
+                runIds = {reqId: replayId for (name, reqId), replayId in replayIds.items()
+                          if name == run and reqId != replayId}
+
+                for receiveTime, reqId, tickType, kind, flags, a, b in records.tolist():
+                    if self.speed is not None:
+                        if start is None:
+                            start = (receiveTime, time.perf_counter())
+                        wait = start[1] + (receiveTime - start[0]) / 1e9 / self.speed - time.perf_counter()
+                        if wait > 0.001:
+                            time.sleep(wait)
+                    self.receiveTime = receiveTime
+                    if runIds:
+                        reqId = runIds.get(reqId, reqId)
+
+                    if kind == TICK_PRICE:
+                        attrib = TickAttrib()
+                        attrib.canAutoExecute = bool(flags & CAN_AUTO_EXECUTE)
+                        attrib.pastLimit = bool(flags & PAST_LIMIT)
+                        attrib.preOpen = bool(flags & PRE_OPEN)
+                        wrapper.tickPrice(reqId, tickType, a, attrib)
+                    elif kind == TICK_SIZE:
+                        wrapper.tickSize(reqId, tickType, int(a))
+                    elif kind == TICK_GENERIC:
+                        wrapper.tickGeneric(reqId, tickType, a)
+                    elif kind == BAR:
+                        bar, values = BarData(), [b]
+                        bar.date = str(int(a)) if flags & (EPOCH_DATE | DAILY_DATE) else unpackDate(int(a))
+                        continue
+                    elif kind == BAR_VALUES:
+                        values.extend((a, b))
+                        if len(values) < 2 * BAR_RECORDS - 1:
+                            continue
+                        bar.open, bar.high, bar.low, bar.close, bar.volume, bar.average, barCount = values
+                        bar.barCount = int(barCount)
+                        wrapper.historicalData(reqId, bar)
+                    elif kind == BAR_END:
+                        wrapper.historicalDataEnd(reqId, unpackDate(int(a), ' '), unpackDate(int(b), ' '))
+                    count += 1
+        finally:
+            if clock is not None:
+                wrapper.clock = clock
+        return count
@@ -1,5 +1,6 @@
 import etc
 import sessions
+import backtests
 import contracts
 
 
@@ -12,7 +13,6 @@ def extractHistoricalData(whatToShow):
     formatDate = 1
     chartOptions = []
     keepUpToDate = False
-    durationString = '1 Y'
     barSizeSetting = '1 day'
 
     secTypes = ['STK'] * len(etc.SPDR_SECTOR_UNIVERSE)
@@ -24,7 +24,15 @@ def extractHistoricalData(whatToShow):
     ]
 
     session = sessions.IBHistoricalDataSession(host, port, clientId)
-    session.start(ibContracts, durationString, barSizeSetting, whatToShow, useRTH, formatDate, keepUpToDate, chartOptions)
+    session.start(ibContracts, barSizeSetting, whatToShow, useRTH, formatDate, keepUpToDate, chartOptions)
+
+
+def backtestSectors():
+    session = sessions.BacktestSession(etc.SPDR_SECTOR_UNIVERSE, '1 day')
+    grid = [{'fast': fast, 'slow': slow} for fast in range(5, 55, 5) for slow in range(20, 220, 20) if fast < slow]
+    results = session.sweep(backtests.movingAverageCrossover, grid, cost=0.0005)
+    for params, stats in sorted(results, key=lambda result: -result[1]['sharpe'])[:10]:
+        print(params, stats)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,354 @@
+import os
+import math
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+# Sub-buckets per power of two, as 2 ** SIGNIFICANT_BITS, which bounds the relative error of a quantile to 1 / 2 ** 8
+SIGNIFICANT_BITS = 7
+ZERO_INDEX = -2 ** 31
+QUANTILES = [0.5, 0.9, 0.99, 0.999]
+EXPORT_INTERVAL = 15.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def formatLabels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0.
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def get(self):
+        return self.value
+
+
+class GaugeChild:
+    def __init__(self):
+        self.value = 0.
+        self.function = None
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def setFunction(self, function):
+        """
+        :param function: (callable) Called for the value on every export instead of tracking it, e.g. a queue length
+        :return: Nothing
+        """
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class HistogramChild:
+    """
+    HDR-style histogram: values fall into 2 ** SIGNIFICANT_BITS linear sub-buckets per power of two, so that any value
+    from nanoseconds to hours is recorded in O(1) with a bounded relative error and only occupied buckets are stored
+    """
+    def __init__(self):
+        self.subBuckets = 1 << SIGNIFICANT_BITS
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.
+        self.min = math.inf
+        self.max = -math.inf
+        self.lock = threading.Lock()
+
+    def getIndex(self, value):
+        if value <= 0:
+            return ZERO_INDEX
+        mantissa, exponent = math.frexp(value)
+        return exponent * self.subBuckets + int((mantissa - 0.5) * 2 * self.subBuckets)
+
+    def getValue(self, index):
+        # Midpoint of the bucket
+        if index == ZERO_INDEX:
+            return 0.
+        exponent, subBucket = divmod(index, self.subBuckets)
+        return math.ldexp(0.5 + (subBucket + 0.5) / (2 * self.subBuckets), exponent)
+
+    def record(self, value):
+        index = self.getIndex(value)
+        with self.lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+
+    def getQuantiles(self, quantiles=QUANTILES):
+        """
+        :param quantiles: (list of float) Between 0 and 1
+        :return: (list of float) NaN while nothing has been recorded
+        """
+        with self.lock:
+            if not self.count:
+                return [math.nan] * len(quantiles)
+            indices = sorted(self.counts)
+            counts = [self.counts[index] for index in indices]
+            low, high, count = self.min, self.max, self.count
+
+        values = []
+        for quantile in quantiles:
+            rank = max(1, math.ceil(quantile * count))
+            seen = 0
+            for index, n in zip(indices, counts):
+                seen += n
+                if seen >= rank:
+                    break
+            values.append(min(max(self.getValue(index), low), high))
+        return values
+
+
+class Metric:
+    """
+    Family of one metric, with one child per combination of label values
+    """
+    kind = None
+    childClass = None
+
+    def __init__(self, name, documentation, labelNames=()):
+        """
+        :param name: (str) Prometheus metric name
+        :param documentation: (str)
+        :param labelNames: (list of str)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        :return: The child for these label values, created on first use. Hot paths should keep it rather than look
+                 it up every time
+        """
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelNames):
+                raise ValueError('%s takes labels %s' % (self.name, self.labelNames))
+            with self.lock:
+                child = self.children.setdefault(values, self.childClass())
+        return child
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        for values, child in list(self.children.items()):
+            lines.append('%s%s %r' % (self.name, formatLabels(self.labelNames, values), float(child.get())))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+    childClass = CounterChild
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+    childClass = GaugeChild
+
+
+class Histogram(Metric):
+    # Exported as a Prometheus summary, since the quantiles are exact to the bucket and the buckets too many to list
+    kind = 'summary'
+    childClass = HistogramChild
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        for values, child in list(self.children.items()):
+            for quantile, value in zip(QUANTILES, child.getQuantiles()):
+                lines.append('%s%s %r' % (self.name, formatLabels(self.labelNames, values, [('quantile', quantile)]),
+                                          value))
+            labels = formatLabels(self.labelNames, values)
+            lines.append('%s_sum%s %r' % (self.name, labels, child.sum))
+            lines.append('%s_count%s %d' % (self.name, labels, child.count))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metricClass, name, documentation, labelNames):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metricClass(name, documentation, labelNames)
+            metric = self.metrics[name]
+        if not isinstance(metric, metricClass) or metric.labelNames != tuple(labelNames):
+            raise ValueError('%s is already registered as another metric' % name)
+        return metric
+
+    def counter(self, name, documentation, labelNames=()):
+        return self.register(Counter, name, documentation, labelNames)
+
+    def gauge(self, name, documentation, labelNames=()):
+        return self.register(Gauge, name, documentation, labelNames)
+
+    def histogram(self, name, documentation, labelNames=()):
+        return self.register(Histogram, name, documentation, labelNames)
+
+    def render(self):
+        """
+        :return: (str) Every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class TextFileExporter:
+    """
+    Writes the registry every interval seconds to a .prom file, e.g. in node_exporter's textfile collector directory.
+    The file is replaced atomically so that it is never read half written.
+    """
+    def __init__(self, filePath, registry=registry, interval=EXPORT_INTERVAL):
+        self.filePath = filePath
+        self.registry = registry
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='TextFileExporter', daemon=True)
+
+    def export(self):
+        with open(self.filePath + '.tmp', 'w') as f:
+            f.write(self.registry.render())
+        os.replace(self.filePath + '.tmp', self.filePath)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.export()
+            except OSError:
+                logger.exception('Failed to export metrics to %s', self.filePath)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.export()
+
+
+class HttpExporter:
+    """
+    Serves the registry on http://host:port/metrics for Prometheus to scrape
+    """
+    def __init__(self, host='127.0.0.1', port=9108, registry=registry):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.registry = registry
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='HttpExporter', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Instruments shared by the sessions and the database writers
+REQUESTS = registry.counter('ib_requests_total', 'Requests sent to IB', ['request'])
+ERRORS = registry.counter('ib_errors_total', 'Errors received from IB', ['code'])
+FIRST_ANSWER_SECONDS = registry.histogram(
+    'ib_request_first_answer_seconds', 'Seconds from sending a request to its first answer', ['request', 'symbol'])
+REQUEST_SECONDS = registry.histogram(
+    'ib_request_seconds', 'Seconds from sending a request to its end', ['request', 'symbol'])
+BATCH_BARS = registry.histogram('ib_batch_bars', 'Bars per historical data batch', ['symbol'])
+# Session gauges are labelled by clientId, since every connection runs its own session
+IN_FLIGHT = registry.gauge('ib_requests_in_flight', 'Requests sent and not answered yet', ['client'])
+QUEUED = registry.gauge('ib_requests_queued', 'Requests waiting for the pacing rules', ['client'])
+MARKET_DATA_LINES = registry.gauge('ib_market_data_lines', 'Market data lines in use', ['client', 'mode'])
+QUOTE_STALENESS = registry.gauge(
+    'ib_quote_staleness_seconds', 'Seconds since the stalest quote was updated', ['client'])
+FLUSH_SECONDS = registry.histogram('db_flush_seconds', 'Seconds per transaction of a database writer', ['database'])
+BARS_WRITTEN = registry.counter('db_bars_written_total', 'Bars committed by a database writer', ['database'])
+PANEL_CACHE = registry.counter(
+    'panel_cache_lookups_total', 'Lookups of resampled series in the panel cache', ['result'])
+
+
+class RequestTimer:
+    """
+    Times requests from being sent to their first answer and to their end, per request type and symbol
+    """
+    def __init__(self):
+        self.sent = {}
+        self.waiting = set()
+
+    def start(self, reqId, requestType, symbol):
+        # A request resent after a pacing violation starts over
+        self.sent[reqId] = (time.perf_counter(), requestType, symbol)
+        self.waiting.add(reqId)
+        REQUESTS.labels(requestType).inc()
+
+    def answer(self, reqId):
+        # Called on every answer, e.g. every bar, so it only does work on the first
+        if reqId in self.waiting:
+            self.waiting.discard(reqId)
+            sent, requestType, symbol = self.sent[reqId]
+            FIRST_ANSWER_SECONDS.labels(requestType, symbol).record(time.perf_counter() - sent)
+
+    def end(self, reqId, bars=None):
+        """
+        :param bars: (int) Bars the request was answered with, if any
+        :return: Nothing
+        """
+        self.answer(reqId)
+        if reqId in self.sent:
+            sent, requestType, symbol = self.sent.pop(reqId)
+            REQUEST_SECONDS.labels(requestType, symbol).record(time.perf_counter() - sent)
+            if bars is not None:
+                BATCH_BARS.labels(symbol).record(bars)
+
+    def discard(self, reqId):
+        self.sent.pop(reqId, None)
+        self.waiting.discard(reqId)
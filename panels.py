@@ -0,0 +1,205 @@
+import dates
+import metrics
+import threading
+import databases
+import backtests
+import aggregators
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+
+PANEL_FIELDS = ['open', 'high', 'low', 'close', 'volume', 'barCount', 'average']
+DAILY_BAR_SIZE = '1 day'
+CACHE_BYTES = 256 * 2 ** 20
+
+
+def getBuckets(epochs, barSize):
+    """
+    :param epochs: (np.ndarray) Epoch seconds of each bar
+    :param barSize: (str) A key of aggregators.BAR_SIZE_SECONDS, or '1 day'
+    :return: (np.ndarray) Epoch seconds of the start of the bar each one falls into, where days start at US/Eastern
+             midnight as the daily bars IB sends
+    """
+    if barSize == DAILY_BAR_SIZE:
+        timestamps = pd.DatetimeIndex(pd.to_datetime(epochs, unit='s', utc=True)).tz_convert(dates.TIMEZONE)
+        return ((timestamps.normalize() - dates.EPOCH) // pd.Timedelta(seconds=1)).to_numpy(dtype=np.int64)
+    interval = aggregators.BAR_SIZE_SECONDS[barSize]
+    return epochs // interval * interval
+
+
+def resample(epochs, values, barSize):
+    """
+    Aggregates bars into coarser ones with one pass of reductions over the boundaries between buckets
+    :param epochs: (np.ndarray) Epoch seconds of each bar, sorted
+    :param values: (dict) One array per field in PANEL_FIELDS
+    :param barSize: (str) See getBuckets
+    :return: (tuple) Epoch seconds of each coarser bar, and one array per field in PANEL_FIELDS
+    """
+    if len(epochs) == 0:
+        return epochs, values
+    buckets = getBuckets(epochs, barSize)
+    starts = np.flatnonzero(np.concatenate([[True], buckets[1:] != buckets[:-1]]))
+    ends = np.append(starts[1:], len(epochs)) - 1
+    volume = np.add.reduceat(values['volume'], starts)
+    weighted = np.add.reduceat(values['average'] * values['volume'], starts)
+    # Buckets without volume fall back to the plain mean of their averages
+    mean = np.add.reduceat(values['average'], starts) / np.diff(np.append(starts, len(epochs)))
+    return buckets[starts], {
+        'open': values['open'][starts],
+        'high': np.maximum.reduceat(values['high'], starts),
+        'low': np.minimum.reduceat(values['low'], starts),
+        'close': values['close'][ends],
+        'volume': volume,
+        'barCount': np.add.reduceat(values['barCount'], starts),
+        'average': np.divide(weighted, volume, out=mean, where=volume > 0),
+    }
+
+
+def overlaps(start, end, minEpoch, maxEpoch):
+    """
+    :param start: (int) Epoch seconds of the first bar of a panel, or None for the earliest
+    :param end: (int) Epoch seconds of the last bar of a panel, or None for the latest
+    :return: (Boolean) Whether a write spanning [minEpoch, maxEpoch] changed bars of the panel
+    """
+    return (start is None or maxEpoch >= start) and (end is None or minEpoch <= end)
+
+
+class PanelService:
+    """
+    Read side of an IBHistoricalDatabase for dashboards and research: panels of several symbols, resampled on the fly
+    from a stored bar size. Each symbol's resampled series is kept in an LRU bounded by its size in bytes, together
+    with the version of its bars it was read at. Whenever PRAGMA data_version shows that another connection
+    committed, whether a writer of this process or of any other, the entries of symbols written to since are dropped
+    if the epochs written overlap theirs, and otherwise carried over to the new version.
+    """
+    def __init__(self, db=None, maxBytes=CACHE_BYTES):
+        """
+        :param db: (databases.IBHistoricalDatabase) HistoricalTradesDatabase if None, which the service keeps
+                   connected until close
+        :param maxBytes: (int) Bound on the arrays held by the cache
+        """
+        self.db = db if db is not None else databases.HistoricalTradesDatabase()
+        self.maxBytes = maxBytes
+        self.cache = OrderedDict()
+        self.nbytes = 0
+        # Versions of the bars of every (symbol, source barSize) as of the last commit seen
+        self.versions = {}
+        self.dataVersion = None
+        self.lock = threading.Lock()
+        # One connection stays open for PRAGMA data_version, so reads from SQLite take turns on it
+        self.readLock = threading.Lock()
+        self.hits = metrics.PANEL_CACHE.labels('hit')
+        self.misses = metrics.PANEL_CACHE.labels('miss')
+
+    def getPanel(self, symbols, barSize, start=None, end=None, fields=('close',), sourceBarSize='1 min'):
+        """
+        :param symbols: (list of str)
+        :param barSize: (str) sourceBarSize or any coarser size of aggregators.BAR_SIZE_SECONDS, or '1 day'
+        :param start: (int) Epoch seconds of the first source bar, or None for the earliest
+        :param end: (int) Epoch seconds of the last source bar, or None for the latest
+        :param fields: (list of str) Fields of PANEL_FIELDS
+        :param sourceBarSize: (str) Stored bar size to resample from
+        :return: (tuple) Union of all epochs, and {field: (time, symbol) array} with NaN where a symbol has no bar,
+                 see backtests.alignPanel
+        """
+        if barSize != DAILY_BAR_SIZE and (
+                barSize not in aggregators.BAR_SIZE_SECONDS or sourceBarSize not in aggregators.BAR_SIZE_SECONDS or
+                aggregators.BAR_SIZE_SECONDS[barSize] % aggregators.BAR_SIZE_SECONDS[sourceBarSize]):
+            raise NotImplementedError('Cannot resample %s bars to %s' % (sourceBarSize, barSize))
+
+        series = {}
+        missing = []
+        with self.readLock:
+            self.validate()
+            with self.lock:
+                versions = self.versions
+                for symbol in symbols:
+                    key = (symbol, sourceBarSize, barSize, start, end)
+                    if key in self.cache:
+                        self.cache.move_to_end(key)
+                        series[symbol] = self.cache[key][0]
+                        self.hits.inc()
+                    else:
+                        missing.append(symbol)
+                        self.misses.inc()
+
+            # Bars committed from now on bump data_version, so the next lookup drops them if they are read here
+            bars = {symbol: self.db.getBars(symbol, sourceBarSize, PANEL_FIELDS, start, end) for symbol in missing}
+
+        for symbol in missing:
+            series[symbol] = self.load(bars[symbol], barSize, sourceBarSize)
+            self.put((symbol, sourceBarSize, barSize, start, end), series[symbol],
+                     versions.get((symbol, sourceBarSize), 0))
+
+        return backtests.alignPanel([series[symbol] for symbol in symbols], fields)
+
+    def validate(self):
+        """
+        Drops the entries whose bars were written to since they were read, if anything was committed since the last
+        lookup. Called with self.readLock held
+        :return: Nothing
+        """
+        if self.db.connection is None:
+            self.db.connect(checkSameThread=False)
+        dataVersion = self.db.getDataVersion()
+        if dataVersion == self.dataVersion:
+            return
+        versions = self.db.getBarVersions()
+        with self.lock:
+            changed = {key: self.versions.get(key, 0) for key, version in versions.items()
+                       if version != self.versions.get(key, 0)}
+        writes = {key: self.db.getBarWrites(key[0], key[1], version) for key, version in changed.items()}
+
+        with self.lock:
+            self.dataVersion = dataVersion
+            self.versions = versions
+            for key, (series, nbytes, version) in list(self.cache.items()):
+                symbolKey = key[:2]
+                if symbolKey not in changed:
+                    continue
+                # Entries are all at the version seen last, unless writes since were pruned from the log
+                if version != changed[symbolKey] or \
+                        len(writes[symbolKey]) < versions[symbolKey] - version or \
+                        any(overlaps(key[3], key[4], minEpoch, maxEpoch) for minEpoch, maxEpoch in writes[symbolKey]):
+                    self.evict(key)
+                else:
+                    self.cache[key] = (series, nbytes, versions[symbolKey])
+
+    @staticmethod
+    def load(bars, barSize, sourceBarSize):
+        columns = list(zip(*bars)) or [()] * (len(PANEL_FIELDS) + 1)
+        epochs = np.array(columns[0], dtype=np.int64)
+        values = {field: np.array(columns[i + 1], dtype=np.float64) for i, field in enumerate(PANEL_FIELDS)}
+        if barSize != sourceBarSize:
+            epochs, values = resample(epochs, values, barSize)
+        return epochs, values
+
+    def put(self, key, series, version):
+        nbytes = series[0].nbytes + sum(values.nbytes for values in series[1].values())
+        with self.lock:
+            # Another lookup saw newer bars while these were resampled
+            if self.versions.get(key[:2], 0) != version or nbytes > self.maxBytes:
+                return
+            if key in self.cache:
+                self.evict(key)
+            self.cache[key] = (series, nbytes, version)
+            self.nbytes += nbytes
+            while self.nbytes > self.maxBytes:
+                self.evict(next(iter(self.cache)))
+
+    def evict(self, key):
+        # Called with self.lock held
+        _, nbytes, _ = self.cache.pop(key)
+        self.nbytes -= nbytes
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.nbytes = 0
+
+    def close(self):
+        with self.readLock:
+            if self.db.connection is not None:
+                self.db.close()
+                self.db.connection = None
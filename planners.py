@@ -0,0 +1,135 @@
+import math
+import dates
+
+
+# Longest durationString IB accepts for each barSizeSetting, see
+# https://interactivebrokers.github.io/tws-api/historical_limitations.html#hd_step_sizes
+MAX_DURATIONS = {
+    '1 secs': (1800, 'S'),
+    '5 secs': (3600, 'S'),
+    '10 secs': (14400, 'S'),
+    '15 secs': (14400, 'S'),
+    '30 secs': (28800, 'S'),
+    '1 min': (1, 'D'),
+    '2 mins': (2, 'D'),
+    '3 mins': (1, 'W'),
+    '5 mins': (1, 'W'),
+    '10 mins': (1, 'W'),
+    '15 mins': (1, 'W'),
+    '20 mins': (1, 'W'),
+    '30 mins': (1, 'M'),
+    '1 hour': (1, 'M'),
+    '2 hours': (1, 'M'),
+    '3 hours': (1, 'M'),
+    '4 hours': (1, 'M'),
+    '8 hours': (1, 'M'),
+    '1 day': (None, 'Y'),
+    '1 week': (None, 'Y'),
+    '1 month': (None, 'Y'),
+}
+# Calendar days a W or M duration is guaranteed to reach back
+CALENDAR_DAYS = {'W': 7, 'M': 28}
+SECONDS_PER_DAY = 86400
+
+
+def getSessions(lower, upper, useRTH, calendar):
+    """
+    :return: (list of tuples) (day, start, end) of each trading session clipped to [lower, upper], most recent first
+    """
+    sessions = []
+    for day in calendar.getTradingDays(dates.toDate(lower), dates.toDate(upper)):
+        sessionOpen, sessionClose = calendar.getSession(day, useRTH)
+        if sessionOpen < upper and sessionClose > lower:
+            sessions.append((day, max(sessionOpen, lower), min(sessionClose, upper)))
+    return sessions[::-1]
+
+
+def planSeconds(sessions, maxSeconds):
+    requests = []
+    for _, start, end in sessions:
+        while end > start:
+            seconds = min(maxSeconds, end - start)
+            requests.append((end, '%d S' % seconds))
+            end -= seconds
+    return requests
+
+
+def planDays(sessions, maxDays):
+    # Only consecutive calendar days share a request, so that it does not matter whether IB counts D in trading or
+    # calendar days
+    requests = []
+    group = []
+    for day, start, end in sessions:
+        if group and (len(group) == maxDays or (group[-1][0] - day).days != 1):
+            requests.append((group[0][2], '%d D' % len(group)))
+            group = []
+        group.append((day, start, end))
+    if group:
+        requests.append((group[0][2], '%d D' % len(group)))
+    return requests
+
+
+def planCalendar(sessions, maxDuration, unit):
+    requests = []
+    chunkStart = None
+    for _, start, end in sessions:
+        if chunkStart is None or start < chunkStart:
+            requests.append((end, '%d %s' % (maxDuration, unit)))
+            chunkStart = end - maxDuration * CALENDAR_DAYS[unit] * SECONDS_PER_DAY
+    return requests
+
+
+def planYears(sessions, lower, upper):
+    if not sessions:
+        return []
+    days = math.ceil((upper - lower) / SECONDS_PER_DAY)
+    if days <= 365:
+        return [(upper, '%d D' % days)]
+    return [(upper, '%d Y' % math.ceil(days / 365))]
+
+
+def findGaps(ranges, lower, upper):
+    """
+    :param ranges: (list of tuples) Sorted, non-overlapping (startEpoch, endEpoch) ranges already covered
+    :param lower: (int) Epoch seconds from which data should exist, usually the headTimestamp
+    :param upper: (int) Epoch seconds up to which data should exist, usually now
+    :return: (list of tuples) (startEpoch, endEpoch) ranges within [lower, upper] which are not covered
+    """
+    gaps = []
+    for start, end in ranges:
+        if start > lower:
+            gaps.append((lower, min(start, upper)))
+        lower = max(lower, end)
+        if lower >= upper:
+            break
+    if lower < upper:
+        gaps.append((lower, upper))
+    return [(start, end) for start, end in gaps if start < end]
+
+
+def plan(lower, upper, barSizeSetting, now, useRTH=True, calendar=None):
+    """
+    Splits [lower, upper] into the fewest reqHistoricalData calls IB allows for the bar size. Time outside trading
+    sessions never costs a request.
+    :param lower: (int) Epoch seconds to fetch from, e.g. the headTimestamp or the start of a coverage gap
+    :param upper: (int) Epoch seconds to fetch up to, e.g. the end of a coverage gap
+    :param barSizeSetting: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
+    :param now: (int) Epoch seconds, upper is capped at it
+    :param useRTH: (Boolean) Whether only regular trading hours need to be covered
+    :param calendar: (dates.TradingCalendar) Defaults to the NYSE calendar
+    :return: (list of tuples) (endDateTime, durationString) requests, most recent first
+    """
+    calendar = calendar or dates.TradingCalendar()
+    maxDuration, unit = MAX_DURATIONS[barSizeSetting]
+    upper = min(upper, now)
+    sessions = getSessions(lower, upper, useRTH, calendar)
+
+    if unit == 'S':
+        requests = planSeconds(sessions, maxDuration)
+    elif unit == 'D':
+        requests = planDays(sessions, maxDuration)
+    elif unit in CALENDAR_DAYS:
+        requests = planCalendar(sessions, maxDuration, unit)
+    else:
+        requests = planYears(sessions, lower, upper)
+    return [(dates.toIBDate(end), durationString) for end, durationString in requests]
@@ -0,0 +1,567 @@
+import math
+import time
+import heapq
+import itertools
+import threading
+import multiprocessing
+from collections import deque, defaultdict
+
+
+# See https://interactivebrokers.github.io/tws-api/historical_limitations.html
+MAX_REQUESTS = 60
+MAX_REQUESTS_WINDOW = 600
+IDENTICAL_REQUEST_INTERVAL = 15
+# Six or more requests for the same contract, exchange and tick type within two seconds is a violation
+MAX_CONTRACT_REQUESTS = 5
+MAX_CONTRACT_REQUESTS_WINDOW = 2
+MAX_IN_FLIGHT = 50
+# See https://interactivebrokers.github.io/tws-api/introduction.html#fifty_messages
+MAX_MESSAGES_PER_SECOND = 50
+PACING_ERROR_CODES = [162, 366]
+# Error codes which are only notices and leave the request they belong to running, e.g. 2104 'Market data farm
+# connection is OK', 165 'Historical Market Data Service query message' or 10167 'Displaying delayed market data'
+NOTICE_ERROR_CODES = frozenset(range(2100, 2200)) | {165, 10090, 10167}
+# See https://interactivebrokers.github.io/tws-api/market_data.html#market_lines
+MAX_MARKET_DATA_LINES = 100
+# Lines kept free for snapshots, which hold a line until tickSnapshotEnd, at the latest after 11 seconds
+SNAPSHOT_LINES = 10
+SNAPSHOT_TIMEOUT = 11
+SNAPSHOT_REFRESH_INTERVAL = 60
+# 'Max number of tickers has been reached'
+MAX_TICKERS_ERROR_CODE = 101
+
+
+def contractKey(contract, whatToShow):
+    """
+    :param contract: (contracts.Contract) My custom-made Contract object
+    :param whatToShow: (str) https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_what_to_show
+    :return: (tuple) What IB considers the same contract for pacing purposes
+    """
+    return contract.symbol or contract.localSymbol, contract.secType, contract.exchange, whatToShow
+
+
+def isPacingError(errorCode, errorString):
+    # 162 is also used for e.g. queries which returned no data, which should not be retried
+    if errorCode == 162:
+        return 'pacing' in errorString.lower()
+    return errorCode in PACING_ERROR_CODES
+
+
+def isTerminalError(errorCode, errorString):
+    # Whether an error ends its request for good, as opposed to a notice or a pacing violation to retry
+    return errorCode not in NOTICE_ERROR_CODES and not isPacingError(errorCode, errorString)
+
+
+class TokenBucket:
+    """
+    Holds up to capacity tokens which refill continuously at refillRate tokens per second.
+    """
+    def __init__(self, capacity, refillRate, clock=time.monotonic):
+        self.capacity = capacity
+        self.refillRate = refillRate
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refillRate)
+        self.updated = now
+
+    def consume(self, n=1):
+        self.refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def waitTime(self, n=1):
+        self.refill()
+        return max(0., (n - self.tokens) / self.refillRate)
+
+
+class SlidingWindowLimiter:
+    """
+    Allows at most maxRequests per key within any window of the given number of seconds.
+    """
+    def __init__(self, maxRequests, window, clock=time.monotonic):
+        self.maxRequests = maxRequests
+        self.window = window
+        self.clock = clock
+        self.sent = defaultdict(deque)
+
+    def expire(self, key):
+        sent = self.sent[key]
+        now = self.clock()
+        while sent and sent[0] <= now - self.window:
+            sent.popleft()
+        return sent
+
+    def allow(self, key=None):
+        return len(self.expire(key)) < self.maxRequests
+
+    def record(self, key=None):
+        self.sent[key].append(self.clock())
+
+    def tryAcquire(self, key=None):
+        """
+        :return: (Boolean) Whether another request fits in the window, in which case it is recorded
+        """
+        if not self.allow(key):
+            return False
+        self.record(key)
+        return True
+
+    def waitTime(self, key=None):
+        sent = self.expire(key)
+        if len(sent) < self.maxRequests:
+            return 0.
+        return sent[-self.maxRequests] + self.window - self.clock()
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    TokenBucket kept in shared memory, so that every process it is passed to draws from the same budget.
+    """
+    def __init__(self, capacity, refillRate, clock=time.monotonic, context=multiprocessing):
+        self.capacity = capacity
+        self.refillRate = refillRate
+        self.clock = clock
+        # tokens and updated
+        self.state = context.Array('d', [capacity, clock()])
+
+    @property
+    def tokens(self):
+        return self.state[0]
+
+    @tokens.setter
+    def tokens(self, tokens):
+        self.state[0] = tokens
+
+    @property
+    def updated(self):
+        return self.state[1]
+
+    @updated.setter
+    def updated(self, updated):
+        self.state[1] = updated
+
+    def consume(self, n=1):
+        with self.state.get_lock():
+            return super(SharedTokenBucket, self).consume(n)
+
+    def waitTime(self, n=1):
+        with self.state.get_lock():
+            return super(SharedTokenBucket, self).waitTime(n)
+
+
+class SharedSlidingWindowLimiter:
+    """
+    SlidingWindowLimiter over a single key kept in shared memory, for limits such as IB's 60 requests per 10 minutes
+    which hold across all connections. The send times live in a ring of maxRequests slots, the oldest of which
+    decides whether another request fits in the window.
+    """
+    def __init__(self, maxRequests, window, clock=time.monotonic, context=multiprocessing):
+        self.maxRequests = maxRequests
+        self.window = window
+        self.clock = clock
+        self.sent = context.Array('d', [float('-inf')] * maxRequests)
+        self.index = context.Value('i', 0, lock=False)
+
+    def allow(self, key=None):
+        return self.waitTime(key) <= 0
+
+    def record(self, key=None):
+        with self.sent.get_lock():
+            self.sent[self.index.value] = self.clock()
+            self.index.value = (self.index.value + 1) % self.maxRequests
+
+    def waitTime(self, key=None):
+        with self.sent.get_lock():
+            return max(0., self.sent[self.index.value] + self.window - self.clock())
+
+    def tryAcquire(self, key=None):
+        """
+        Checks and records under the shared lock, so that processes racing for the last slot cannot both take it
+        :return: (Boolean) Whether another request fits in the window, in which case it is recorded
+        """
+        with self.sent.get_lock():
+            now = self.clock()
+            if self.sent[self.index.value] + self.window > now:
+                return False
+            self.sent[self.index.value] = now
+            self.index.value = (self.index.value + 1) % self.maxRequests
+            return True
+
+
+class ScheduledRequest:
+    def __init__(self, reqId, contractKey, identicalKey, send, priority):
+        self.reqId = reqId
+        self.contractKey = contractKey
+        self.identicalKey = identicalKey
+        self.send = send
+        self.priority = priority
+        self.notBefore = 0.
+
+
+class MessageQueue:
+    """
+    Sends the requests which no other pacing rule covers, such as reqContractDetails or reqMktData, in the order they
+    were submitted and no faster than the outbound message bucket allows.
+    """
+    def __init__(self, clock=time.monotonic, messageBucket=None):
+        """
+        :param messageBucket: (TokenBucket) Outbound message budget, e.g. shared with a PacingScheduler
+        """
+        self.messageBucket = messageBucket or TokenBucket(MAX_MESSAGES_PER_SECOND, MAX_MESSAGES_PER_SECOND, clock)
+        self.queue = deque()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def submit(self, send):
+        """
+        :param send: (callable) Sends the message to IB's server when called without arguments
+        :return: Nothing
+        """
+        with self.lock:
+            self.queue.append(send)
+
+    def dispatch(self):
+        """
+        :return: (int) Messages sent
+        """
+        sent = 0
+        with self.lock:
+            while self.queue and self.messageBucket.consume():
+                self.queue.popleft()()
+                sent += 1
+        return sent
+
+    def nextWakeup(self):
+        """
+        :return: (float) Seconds until dispatch could send something, or None when nothing is queued
+        """
+        with self.lock:
+            return self.messageBucket.waitTime() if self.queue else None
+
+
+class PacingScheduler:
+    """
+    Keeps as many historical data requests in flight as IB's pacing rules allow. Requests are queued by priority;
+    by default a contract's nth request gets priority n, so contracts take turns instead of the first symbol
+    hogging the budget. A request is only sent when the global window, the per-contract window, the identical
+    request interval, the in-flight window and the outbound message rate all have room for it. Other messages, e.g.
+    reqContractDetails, are submitted with submitMessage and only take from the message rate, ahead of the queue.
+    """
+    def __init__(self, clock=time.monotonic, maxInFlight=MAX_IN_FLIGHT, globalLimiter=None, contractLimiter=None,
+                 messageBucket=None):
+        self.clock = clock
+        self.maxInFlight = maxInFlight
+        self.globalLimiter = globalLimiter or SlidingWindowLimiter(MAX_REQUESTS, MAX_REQUESTS_WINDOW, clock)
+        self.contractLimiter = contractLimiter or SlidingWindowLimiter(
+            MAX_CONTRACT_REQUESTS, MAX_CONTRACT_REQUESTS_WINDOW, clock)
+        self.messageBucket = messageBucket or TokenBucket(MAX_MESSAGES_PER_SECOND, MAX_MESSAGES_PER_SECOND, clock)
+        self.messages = MessageQueue(clock, self.messageBucket)
+
+        self.queue = []
+        self.inFlight = {}
+        self.lastSent = {}
+        self.submitted = defaultdict(int)
+        self.counter = itertools.count()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def push(self, request):
+        heapq.heappush(self.queue, (request.priority, next(self.counter), request))
+
+    def submit(self, reqId, contractKey, identicalKey, send, priority=None):
+        """
+        :param reqId: (int)
+        :param contractKey: (tuple) See schedulers.contractKey
+        :param identicalKey: (tuple) Every parameter of the request, to detect identical requests
+        :param send: (callable) Sends the request to IB's server when called without arguments
+        :param priority: (int) Lower goes first. Defaults to how many requests this contract already submitted
+        :return: Nothing
+        """
+        with self.lock:
+            if priority is None:
+                priority = self.submitted[contractKey]
+            self.submitted[contractKey] += 1
+            self.push(ScheduledRequest(reqId, contractKey, identicalKey, send, priority))
+
+    def submitMessage(self, send):
+        """
+        :param send: (callable) Sends a request which is not a historical data request, e.g. reqContractDetails
+        :return: Nothing
+        """
+        self.messages.submit(send)
+
+    def waitTime(self, request):
+        now = self.clock()
+        waits = [request.notBefore - now, self.contractLimiter.waitTime(request.contractKey)]
+        if request.identicalKey in self.lastSent:
+            waits.append(self.lastSent[request.identicalKey] + IDENTICAL_REQUEST_INTERVAL - now)
+        return max(waits)
+
+    def dispatch(self):
+        """
+        Sends the queued messages, then every queued request the pacing rules currently allow
+        :return: (list of int) reqIds of the historical data requests which were sent
+        """
+        sent = []
+        blocked = []
+        with self.lock:
+            self.messages.dispatch()
+            while self.queue and len(self.inFlight) < self.maxInFlight:
+                if not self.globalLimiter.allow() or self.messageBucket.waitTime() > 0:
+                    break
+
+                _, _, request = heapq.heappop(self.queue)
+                if self.waitTime(request) > 0:
+                    blocked.append(request)
+                    continue
+
+                # Other processes may have taken the budget since it was checked, so it is only spent if it is still
+                # there. A message token taken for a request the global window then refuses costs 1/50 s at most
+                if not self.messageBucket.consume() or not self.globalLimiter.tryAcquire():
+                    blocked.append(request)
+                    break
+                self.contractLimiter.record(request.contractKey)
+                self.lastSent[request.identicalKey] = self.clock()
+                self.inFlight[request.reqId] = request
+                request.send()
+                sent.append(request.reqId)
+
+            for request in blocked:
+                self.push(request)
+        return sent
+
+    def complete(self, reqId):
+        with self.lock:
+            return self.inFlight.pop(reqId, None)
+
+    def cancel(self, reqId):
+        """
+        Drops a request whether it is still queued or already in flight
+        :param reqId: (int)
+        :return: (Boolean) Whether reqId was in flight, in which case IB has to be told to cancel it too
+        """
+        with self.lock:
+            if self.inFlight.pop(reqId, None) is not None:
+                return True
+            self.queue = [item for item in self.queue if item[2].reqId != reqId]
+            heapq.heapify(self.queue)
+            return False
+
+    def retry(self, reqId, delay=IDENTICAL_REQUEST_INTERVAL):
+        """
+        Puts an in-flight request back in the queue, e.g. after a pacing violation
+        :param reqId: (int)
+        :param delay: (float) Seconds to wait before sending it again
+        :return: (Boolean) Whether reqId was in flight
+        """
+        with self.lock:
+            request = self.inFlight.pop(reqId, None)
+            if request is None:
+                return False
+            request.notBefore = self.clock() + delay
+            self.push(request)
+            return True
+
+    def nextWakeup(self):
+        """
+        :return: (float) Seconds until dispatch could send something, or None when nothing is queued
+        """
+        with self.lock:
+            message = self.messages.nextWakeup()
+            if not self.queue or len(self.inFlight) >= self.maxInFlight:
+                return message
+            waits = [self.globalLimiter.waitTime(), self.messageBucket.waitTime()]
+            waits.append(min(self.waitTime(request) for _, _, request in self.queue))
+            wait = max(0., max(waits))
+            return wait if message is None else min(wait, message)
+
+
+class MarketDataLineManager:
+    """
+    Keeps the subscriptions of highest priority streaming on IB's market data lines and refreshes the rest with
+    snapshots on the lines left over, the longest unrefreshed first, so that a universe larger than the line cap is
+    monitored with bounded staleness. Every request and cancellation takes a token of the outbound message bucket.
+    """
+    def __init__(self, clock=time.monotonic, maxLines=MAX_MARKET_DATA_LINES, snapshotLines=SNAPSHOT_LINES,
+                 refreshInterval=SNAPSHOT_REFRESH_INTERVAL, messageBucket=None):
+        """
+        :param maxLines: (int) Concurrent market data lines of the account
+        :param snapshotLines: (int) Of which are kept for snapshots
+        :param refreshInterval: (float) Seconds before a snapshot of the same subscription is taken again
+        :param messageBucket: (TokenBucket) Outbound message budget, e.g. shared with a PacingScheduler
+        """
+        self.clock = clock
+        self.streamLines = maxLines - snapshotLines
+        self.snapshotLines = snapshotLines
+        self.refreshInterval = refreshInterval
+        self.messageBucket = messageBucket or TokenBucket(MAX_MESSAGES_PER_SECOND, MAX_MESSAGES_PER_SECOND, clock)
+
+        self.priorities = {}
+        self.requests = {}
+        self.streaming = set()
+        self.wanted = set()
+        self.snapshots = {}
+        self.refreshed = {}
+        self.due = []
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.priorities)
+
+    def add(self, reqId, priority, stream, snapshot, cancel):
+        """
+        :param reqId: (int) Kept by the subscription for every stream and snapshot request, so that its ticks always
+                      arrive under the same reqId
+        :param priority: (float) Lower streams first
+        :param stream: (callable) Sends a streaming reqMktData
+        :param snapshot: (callable) Sends a snapshot reqMktData
+        :param cancel: (callable) Sends cancelMktData
+        :return: Nothing
+        """
+        with self.lock:
+            self.priorities[reqId] = priority
+            self.requests[reqId] = (stream, snapshot, cancel)
+            self.refreshed[reqId] = -math.inf
+            heapq.heappush(self.due, (-math.inf, reqId))
+            self.dirty = True
+
+    def setPriority(self, reqId, priority):
+        with self.lock:
+            self.priorities[reqId] = priority
+            self.dirty = True
+
+    def remove(self, reqId):
+        """
+        Forgets a subscription, cancelling it at once if it is streaming
+        :return: Nothing
+        """
+        with self.lock:
+            if reqId in self.streaming:
+                self.messageBucket.consume()
+                self.requests[reqId][2]()
+                self.streaming.discard(reqId)
+            for state in (self.priorities, self.requests, self.snapshots, self.refreshed):
+                state.pop(reqId, None)
+            self.wanted.discard(reqId)
+            self.dirty = True
+
+    def complete(self, reqId):
+        # tickSnapshotEnd, which frees the snapshot's line
+        with self.lock:
+            if self.snapshots.pop(reqId, None) is not None:
+                self.schedule(reqId, self.clock())
+
+    def reject(self, reqId):
+        """
+        A stream refused with MAX_TICKERS_ERROR_CODE: the account has fewer lines than assumed, so streaming is
+        capped at what already streams and reqId goes back to snapshots
+        :return: Nothing
+        """
+        with self.lock:
+            if reqId in self.streaming:
+                self.streaming.discard(reqId)
+                self.streamLines = len(self.streaming)
+                self.schedule(reqId, -math.inf)
+                self.dirty = True
+            elif self.snapshots.pop(reqId, None) is not None:
+                self.snapshotLines = max(1, len(self.snapshots))
+                self.schedule(reqId, -math.inf)
+
+    def schedule(self, reqId, refreshed):
+        self.refreshed[reqId] = refreshed
+        heapq.heappush(self.due, (refreshed, reqId))
+
+    def getWanted(self):
+        if self.dirty:
+            self.wanted = set(heapq.nsmallest(self.streamLines, self.priorities, key=self.priorities.get))
+            self.dirty = False
+        return self.wanted
+
+    def dispatch(self):
+        """
+        Cancels streams which lost their line, starts the streams which won one, then fills the free snapshot lines,
+        for as long as the message bucket has tokens
+        :return: (int) Messages sent
+        """
+        sent = 0
+        with self.lock:
+            now = self.clock()
+            for reqId, sentAt in list(self.snapshots.items()):
+                if now - sentAt > SNAPSHOT_TIMEOUT:
+                    # IB may still be working on it, and a reqId requested again before it is cancelled is error 322
+                    if not self.messageBucket.consume():
+                        return sent
+                    self.requests[reqId][2]()
+                    del self.snapshots[reqId]
+                    self.schedule(reqId, sentAt)
+                    sent += 1
+
+            wanted = self.getWanted()
+            for reqId in list(self.streaming - wanted):
+                if not self.messageBucket.consume():
+                    return sent
+                self.requests[reqId][2]()
+                self.streaming.discard(reqId)
+                # Its quotes are current as of now
+                self.schedule(reqId, now)
+                sent += 1
+
+            for reqId in wanted - self.streaming:
+                if len(self.streaming) >= self.streamLines:
+                    break
+                if reqId in self.snapshots:
+                    continue
+                if not self.messageBucket.consume():
+                    return sent
+                self.requests[reqId][0]()
+                self.streaming.add(reqId)
+                # Drops it from the snapshot rotation
+                self.refreshed[reqId] = None
+                sent += 1
+
+            while self.due and len(self.snapshots) < self.snapshotLines:
+                refreshed, reqId = self.due[0]
+                if self.refreshed.get(reqId) != refreshed:
+                    heapq.heappop(self.due)
+                    continue
+                if now - refreshed < self.refreshInterval or not self.messageBucket.consume():
+                    break
+                heapq.heappop(self.due)
+                self.requests[reqId][1]()
+                self.snapshots[reqId] = now
+                sent += 1
+        return sent
+
+    def nextWakeup(self):
+        """
+        :return: (float) Seconds until dispatch could send something
+        """
+        with self.lock:
+            now = self.clock()
+            waits = [min(sentAt + SNAPSHOT_TIMEOUT - now for sentAt in self.snapshots.values())] \
+                if self.snapshots else []
+            while self.due and self.refreshed.get(self.due[0][1]) != self.due[0][0]:
+                heapq.heappop(self.due)
+            if self.due and len(self.snapshots) < self.snapshotLines:
+                waits.append(self.due[0][0] + self.refreshInterval - now)
+            starting = len(self.streaming) < self.streamLines and any(
+                reqId not in self.streaming and reqId not in self.snapshots for reqId in self.wanted)
+            if self.dirty or self.streaming - self.wanted or starting:
+                waits.append(0.)
+            wait = max(0., min(waits)) if waits else SNAPSHOT_REFRESH_INTERVAL
+            return max(wait, self.messageBucket.waitTime())
+
+    def getStreaming(self):
+        with self.lock:
+            return set(self.streaming)
@@ -1,33 +1,173 @@
-import etc
-import pytz
+import time
+import dates
 import events
+import buffers
 import logging
+import metrics
 import handlers
+import planners
+import threading
 import databases
+import backtests
+import adjustments
+import schedulers
+import aggregators
+import numpy as np
 from ibapi.client import EClient
 from ibapi.utils import iswrapper
 from ibapi.wrapper import EWrapper
-from datetime import datetime, timedelta
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
 
-
-def getPrevWeekday(date):
-    date -= timedelta(days=1)
-    while date.weekday() > 4: # Mon-Fri are 0-4
-        date -= timedelta(days=1)
-    return date
+BACKTEST_FIELDS = ['open', 'high', 'low', 'close', 'volume']
 
 
 class BacktestSession:
-    def __init__(self):
-        raise NotImplementedError
+    def __init__(self, symbols, barSize, start=None, end=None, db=None, fields=BACKTEST_FIELDS):
+        """
+        Loads stored bars of every symbol into (time, symbol) arrays aligned on the union of their dates
+        :param symbols: (list of str)
+        :param barSize: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
+        :param start: (int) Epoch seconds of the first bar, or None for the earliest
+        :param end: (int) Epoch seconds of the last bar, or None for the latest
+        :param db: (databases.IBHistoricalDatabase) Defaults to databases.HistoricalTradesDatabase
+        :param fields: (list of str) Bar fields to load, must include close
+        """
+        self.symbols = list(symbols)
+        self.barSize = barSize
+        self.fields = list(fields)
+
+        db = db or databases.HistoricalTradesDatabase()
+        db.connect()
+        series = []
+        for symbol in self.symbols:
+            bars = np.array(db.getBars(symbol, barSize, self.fields, start, end), dtype=np.float64)
+            bars = bars.reshape(-1, len(self.fields) + 1)
+            series.append((bars[:, 0].astype(np.int64), {field: bars[:, i + 1] for i, field in enumerate(self.fields)}))
+        db.close()
+
+        self.epochs, self.panel = backtests.alignPanel(series, self.fields)
+        self.prices = np.ascontiguousarray(backtests.fillForward(self.panel['close']))
+        self.periodsPerYear = backtests.TRADING_PERIODS.get(barSize, 252)
+        logger.info('BacktestSession loaded %d bars of %d symbols', len(self.epochs), len(self.symbols))
+
+    def run(self, strategy, cost=0.0005, targetVol=None, **params):
+        """
+        :param strategy: (callable) Maps (time, symbol) closes and params to (time, symbol) signals in [-1, 1]
+        :param cost: (float) Cost per unit of weight traded
+        :param targetVol: (float) Per period volatility each position aims for, or None for equal weights
+        :return: (tuple) Stats and the portfolio return per period
+        """
+        signals = strategy(self.prices, **params)
+        positions = backtests.getPositions(signals, self.prices, targetVol)
+        pnl = backtests.evaluate(self.prices, positions, cost)
+        return backtests.getStats(pnl, self.periodsPerYear), pnl
+
+    def sweep(self, strategy, grid, cost=0.0005, targetVol=None, processes=None, chunkSize=16):
+        """
+        Runs strategy over a parameter grid in a process pool. The prices are put in shared memory once instead of
+        being pickled for every task.
+        :param strategy: (callable) Module level function, see run
+        :param grid: (list of dicts) Parameters of each run
+        :param processes: (int) Pool size, defaults to the number of CPUs
+        :param chunkSize: (int) Parameter sets per task
+        :return: (list of tuples) (params, stats) in grid order
+        """
+        memory = shared_memory.SharedMemory(create=True, size=max(self.prices.nbytes, 1))
+        shared = np.ndarray(self.prices.shape, dtype=self.prices.dtype, buffer=memory.buf)
+        shared[:] = self.prices
+        try:
+            with ProcessPoolExecutor(processes) as pool:
+                futures = [
+                    pool.submit(backtests.runSweepChunk, memory.name, self.prices.shape, self.prices.dtype.str,
+                                strategy, grid[i:i + chunkSize], cost, targetVol, self.periodsPerYear)
+                    for i in range(0, len(grid), chunkSize)]
+                results = [stats for future in futures for stats in future.result()]
+        finally:
+            del shared
+            memory.close()
+            memory.unlink()
+        return list(zip(grid, results))
+
+    def replay(self, handler):
+        """
+        Feeds the stored bars period by period into a handler with the onBars interface the live session uses,
+        e.g. handlers.MovingAverageHandler, with the symbol index as row
+        :param handler: Anything with an onBars(aggregators.CompletedBars) method
+        :return: Nothing
+        """
+        rows = np.arange(len(self.symbols))
+        close = self.panel['close']
+        for t, epoch in enumerate(self.epochs):
+            mask = ~np.isnan(close[t])
+            if not mask.any():
+                continue
+            values = {field: self.panel[field][t, mask] if field in self.panel else close[t, mask]
+                      for field in ['open', 'high', 'low', 'close', 'volume', 'barCount', 'average']}
+            handler.onBars(aggregators.CompletedBars(
+                self.barSize, np.full(mask.sum(), epoch), rows[mask], values['open'], values['high'], values['low'],
+                values['close'], values['volume'], values['barCount'], values['average']))
+
+
+class ContractCacheMixin:
+    """
+    Resolves contracts from databases.ContractCacheDatabase and only asks IB for contract details on a miss.
+    Expects self.cache, self.contractRequests, self.getNextId and self.sendMessage to be set up by the session.
+    """
+    def resolveContract(self, contract, resolved=None):
+        """
+        :param resolved: (callable) Called without arguments once the contract has its conId, at once on a cache hit
+                         and on contractDetailsEnd otherwise, so that nothing is requested for it before then
+        :return: Nothing
+        """
+        if self.cache.resolveContract(contract):
+            if resolved is not None:
+                resolved()
+        else:
+            self.getContractDetails(contract, resolved)
 
+    def getContractDetails(self, contract, resolved=None):
+        reqId = self.getNextId()
+        self.contractRequests[reqId] = (contract, resolved)
+        logger.info('#Request %d: Requesting contractDetails for %s', reqId, contract.symbol)
+        self.sendMessage(lambda: self.reqContractDetails(reqId, contract))
+
+    @iswrapper
+    def contractDetails(self, reqId, contractDetails):
+        super().contractDetails(reqId, contractDetails)
+
+        # Later requests for this contract pick up the conId since they share the same object
+        contract, _ = self.contractRequests[reqId]
+        self.cache.setContractDetails(contract, contractDetails)
+        contract.conId = contractDetails.contract.conId
+        contract.primaryExchange = contractDetails.contract.primaryExchange
+
+    @iswrapper
+    def contractDetailsEnd(self, reqId):
+        super().contractDetailsEnd(reqId)
+        _, resolved = self.contractRequests.pop(reqId, (None, None))
+        if resolved is not None:
+            resolved()
 
-class IBHistoricalDataSession(EWrapper, EClient):
-    def __init__(self, host, port, clientId):
+    def dropContractRequest(self, reqId):
+        """
+        Gives up on a contract IB has no details for, along with everything waiting for it to resolve
+        :return: Nothing
+        """
+        contract, _ = self.contractRequests.pop(reqId, (None, None))
+        if contract is not None:
+            logger.warning('#Request %d: No contractDetails for %s, nothing is requested for it', reqId,
+                           contract.symbol)
+
+
+class IBHistoricalDataSession(ContractCacheMixin, EWrapper, EClient):
+    def __init__(self, host, port, clientId, journal=None):
+        """
+        :param journal: (journals.TickJournal) Records every bar as it is received
+        """
         EWrapper.__init__(self)
         EClient.__init__(self, wrapper=self)
         self.connect(host, port, clientId)
@@ -35,16 +175,52 @@ class IBHistoricalDataSession(EWrapper, EClient):
 
         self.reqId = 0
         self.historicBarHandler = handlers.IBHistoricBarHandler()
+        self.cache = databases.ContractCacheDatabase()
+        self.contractRequests = {}
+        self.scheduler = schedulers.PacingScheduler()
+        self.wakeup = threading.Event()
+        self.timer = metrics.RequestTimer()
+        metrics.IN_FLIGHT.labels(str(clientId)).setFunction(lambda: len(self.scheduler.inFlight))
+        metrics.QUEUED.labels(str(clientId)).setFunction(lambda: len(self.scheduler))
+        self.journal = journal
+        self.adjust = False
+        # ADJUSTED_LAST requests waiting for daily TRADES requests, by reqId of the latter
+        self.comparisons = {}
 
     def getNextId(self):
         self.reqId += 1
         return self.reqId
 
-    def start(self, contracts, durationString, barSizeSetting, whatToShow, useRTH, formatDate, keepUpToDate, chartOptions):
+    def submit(self, reqId, contract, whatToShow, identicalKey, send, requestType):
+        key = schedulers.contractKey(contract, whatToShow)
+
+        def sendTimed():
+            self.timer.start(reqId, requestType, contract.symbol)
+            send()
+
+        self.scheduler.submit(reqId, key, (key,) + identicalKey, sendTimed)
+        self.wakeup.set()
+
+    def sendMessage(self, send):
+        # Requests other than historical data only count against the message rate
+        self.scheduler.submitMessage(send)
+        self.wakeup.set()
+
+    def pump(self):
+        """
+        Sends queued requests as soon as IB's pacing rules allow. Runs in its own thread alongside self.run()
+        :return: Nothing
+        """
+        while self.isConnected():
+            self.scheduler.dispatch()
+            wait = self.scheduler.nextWakeup()
+            self.wakeup.wait(1. if wait is None else min(wait, 1.))
+            self.wakeup.clear()
+
+    def start(self, contracts, barSizeSetting, whatToShow, useRTH, formatDate, keepUpToDate, chartOptions):
         """
 
         :param contracts: (list of contracts.Contract)
-        :param durationString: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_duration
         :param barSizeSetting: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
         :param whatToShow: (str) https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_what_to_show
         :param useRTH: (Boolean) True or False
@@ -55,60 +231,76 @@ class IBHistoricalDataSession(EWrapper, EClient):
         """
         logger.info('HistoricalDataSession started.')
 
-        # Initializing databases to check what existing historical data we already have
-        if whatToShow == 'ADJUSTED_LAST':
-            db = databases.HistoricalAdjustedLastDatabase()
-        elif whatToShow == 'TRADES':
-            db = databases.HistoricalTradesDatabase()
-        else:
-            raise NotImplementedError
+        self.adjust = whatToShow == 'ADJUSTED_LAST'
+        if self.adjust:
 
-        db.connect()
-        endDateTime = ''
+            # Adjusted bars are derived from TRADES bars, so only those are backfilled, plus one short ADJUSTED_LAST
+            # request per symbol which keeps the factor table current
+            whatToShow = 'TRADES'
 
+        self.cache.connect()
         for contract in contracts:
-            script = "SELECT date FROM %s DESC LIMIT 1" % contract.symbol
-            selected = db.select(script)
-            if not selected:
-
-                # If no existing table, search IB for the earliest data point
-                logger.debug('No existing sqlite table for %s' % contract.symbol)
-                self.getHeadTimeStamp(contract, endDateTime, durationString, barSizeSetting, whatToShow,
-                                      useRTH, formatDate, keepUpToDate, chartOptions)
-            else:
-
-                # Else, iterate over the headTimestamps (although there is only one)
-                for headTimestamp in db.select(script):
-                    logger.debug('Symbol %s headTimestamp %s' % (contract.symbol, headTimestamp))
-
-                    easternDateTime = datetime.now(pytz.timezone('US/Eastern'))
-                    prevEasternWeekday = getPrevWeekday(easternDateTime)
-                    easternHeadTimestamp = pytz.timezone('US/Eastern').localize(
-                        datetime.strptime(headTimestamp, etc.IB_BAR_DATE_FMT))
-                    daysDiff = (prevEasternWeekday - easternHeadTimestamp).days
-                    if daysDiff > 0:
-                        daysDiffStr = str(daysDiff)
-                        logger.info(
-                            'Most recent historicalData for %s is %s. Parsing %s days of historicalData' %
-                            (contract.symbol, easternHeadTimestamp.strftime(etc.IB_BAR_DATE_FMT), daysDiffStr))
-                        self.getHistoricalData(contract, endDateTime, daysDiffStr + ' D', barSizeSetting, whatToShow,
-                                               useRTH, formatDate, keepUpToDate, chartOptions)
-                    else:
-                        logger.info(
-                            'Most recent historicalData for %s is %s. No historicalData to be parsed' %
-                            (contract.symbol, easternHeadTimestamp.strftime(etc.IB_BAR_DATE_FMT)))
-
-        # Either way, close the database and start the event loop in IB
-        db.close()
+
+            # Nothing goes out for a contract missing from the cache until IB has sent its conId
+            self.resolveContract(contract, lambda contract=contract: self.planContract(
+                contract, barSizeSetting, whatToShow, useRTH, formatDate, keepUpToDate, chartOptions))
+
+        # Contracts still resolving are planned from the event loop in IB
+        threading.Thread(target=self.pump, name='PacingScheduler', daemon=True).start()
         self.run()
 
-    def getHeadTimeStamp(self, contract, endDateTime, durationString, barSizeSetting, whatToShow,
-                         useRTH, formatDate, keepUpToDate, chartOptions):
+    def planContract(self, contract, barSizeSetting, whatToShow, useRTH, formatDate, keepUpToDate, chartOptions):
+        """
+        Plans the requests of a resolved contract: its headTimestamp if it is unknown, or else what its coverage lacks
+        :param contract: (contracts.Contract) My custom-made Contract object
+        :return: Nothing
+        """
+        db = self.historicBarHandler.getDatabase(whatToShow)
+        db.connect()
+        headTimestamp = self.cache.getHeadTimestamp(contract, whatToShow)
+        if headTimestamp is None:
+
+            # The cached headTimestamp expires, the one saved along with the coverage does not
+            headTimestamp, _, _ = db.getCoverage(contract.symbol, whatToShow, barSizeSetting)
+        if headTimestamp is None:
+
+            # Search IB for the earliest data point
+            logger.debug('No headTimestamp for %s', contract.symbol)
+            self.getHeadTimeStamp(contract, barSizeSetting, whatToShow, useRTH, formatDate, keepUpToDate,
+                                  chartOptions)
+        else:
+            self.planGaps(contract, db, headTimestamp, barSizeSetting, whatToShow, useRTH, formatDate,
+                          keepUpToDate, chartOptions)
+        db.close()
+
+    def planGaps(self, contract, db, headTimestamp, barSizeSetting, whatToShow, useRTH, formatDate, keepUpToDate,
+                 chartOptions):
+        """
+        Queues requests for whatever is missing between headTimestamp and now, and the adjustments if needed
+        :param db: (databases.IBHistoricalDatabase) Connected database of whatToShow
+        :param headTimestamp: (int) Epoch seconds of the earliest data point IB has
+        :return: Nothing
+        """
+        now = int(time.time())
+        if self.adjust:
+            self.planAdjustments(contract, db, headTimestamp, now, useRTH, chartOptions)
+
+        # One indexed lookup per symbol tells us which ranges are already stored
+        _, _, ranges = db.getCoverage(contract.symbol, whatToShow, barSizeSetting)
+        gaps = planners.findGaps(ranges, headTimestamp, now)
+        if not gaps:
+            logger.info('historicalData for %s is up to date. No historicalData to be parsed', contract.symbol)
+
+        for gapStart, gapEnd in gaps:
+            logger.info('historicalData for %s is missing from %s to %s',
+                        contract.symbol, dates.toIBDate(gapStart), dates.toIBDate(gapEnd))
+            self.planHistoricalData(contract, gapStart, gapEnd, now, barSizeSetting, whatToShow,
+                                    useRTH, formatDate, keepUpToDate, chartOptions)
+
+    def getHeadTimeStamp(self, contract, barSizeSetting, whatToShow, useRTH, formatDate, keepUpToDate, chartOptions):
         """
         Calls the reqHeadTimeStamp method which makes a request to IB's server
         :param contract: (contracts.Contract) My custom-made Contract object
-        :param endDateTime: (str) Can be an empty string or date string in IB's accepted date format
-        :param durationString: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_duration
         :param barSizeSetting: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
         :param whatToShow: (str) https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_what_to_show
         :param useRTH: (Boolean) True or False
@@ -122,39 +314,102 @@ class IBHistoricalDataSession(EWrapper, EClient):
         # Create a HistoricalDataEvent object
         logger.debug('Creating historicalDataEvent')
         historicalDataEvent = events.HistoricalDataEvent(
-            contract, endDateTime, durationString, barSizeSetting, whatToShow,
-            useRTH, formatDate, keepUpToDate, chartOptions, None, [])
+            contract, '', '', barSizeSetting, whatToShow,
+            useRTH, formatDate, keepUpToDate, chartOptions, None, buffers.BarBuffer())
         logger.debug('historicalDataEvent created')
 
         # Creating record in the handler
-        logger.debug('#Request %d: Creating historicalDataEvent record for %s' % (reqId, contract.symbol))
+        logger.debug('#Request %d: Creating historicalDataEvent record for %s', reqId, contract.symbol)
         self.historicBarHandler.createRecord(reqId, historicalDataEvent)
-        logger.debug('#Request %d: historicalDataEvent record for %s created' % (reqId, contract.symbol))
+        logger.debug('#Request %d: historicalDataEvent record for %s created', reqId, contract.symbol)
 
-        logger.info('#Request %d: Requesting headTimestamp for %s' % (reqId, contract.symbol))
-        self.reqHeadTimeStamp(reqId, contract, whatToShow, useRTH, formatDate)
+        logger.info('#Request %d: Queueing headTimestamp request for %s', reqId, contract.symbol)
+        self.submit(reqId, contract, whatToShow, ('headTimestamp', useRTH, formatDate),
+                    lambda: self.reqHeadTimeStamp(reqId, contract, whatToShow, useRTH, formatDate), 'headTimestamp')
 
     @iswrapper
     def headTimestamp(self, reqId, headTimestamp):
         super().headTimestamp(reqId, headTimestamp)
+        self.scheduler.complete(reqId)
+        self.timer.end(reqId)
+        self.wakeup.set()
 
         # Edit the HistoricalDataEvent with the new value obtained
         logger.debug('Editing historicalDataEvent record with new headTimestamp')
         self.historicBarHandler.editRecord(reqId, headTimestamp=headTimestamp)
+        self.historicBarHandler.saveHeadTimestamp(reqId)
         logger.debug('historicalDataEvent record with new headTimestamp edited')
 
         # Get event object which holds information on required params for calling reqHistoricalData
-        logger.debug('#Request %d: Getting historicalDataEvent record' % reqId)
-        event = self.historicBarHandler.getRecord(reqId)
-        logger.debug('#Request %d: historicalDataEvent record gotten' % reqId)
+        logger.debug('#Request %d: Getting historicalDataEvent record', reqId)
+        event = self.historicBarHandler.removeRecord(reqId)
+        self.cache.setHeadTimestamp(event.contract, event.whatToShow, dates.toEpoch(headTimestamp))
+        logger.debug('#Request %d: historicalDataEvent record gotten', reqId)
 
-        logger.info('#Request %d: Requesting historicalData for %s' % (reqId, event.contract.symbol))
-        self.getHistoricalData(event.contract, event.endDateTime, event.durationString, event.barSizeSetting,
-                               event.whatToShow, event.useRTH, event.formatDate, event.keepUpToDate,
-                               event.chartOptions, reqId)
+        logger.info('#Request %d: Planning historicalData requests for %s', reqId, event.contract.symbol)
+        db = self.historicBarHandler.getDatabase(event.whatToShow)
+        db.connect()
+        self.planGaps(event.contract, db, dates.toEpoch(headTimestamp), event.barSizeSetting, event.whatToShow,
+                      event.useRTH, event.formatDate, event.keepUpToDate, event.chartOptions)
+        db.close()
+
+    def planAdjustments(self, contract, db, headTimestamp, now, useRTH, chartOptions):
+        """
+        Queues the daily TRADES bars missing since the last comparison, then one ADJUSTED_LAST request over the same
+        days, which the writer compares to find new dividends and splits. As in asyncsessions, the ADJUSTED_LAST
+        request only goes out once every daily TRADES request is over, so that their bars are written first.
+        :param db: (databases.IBHistoricalDatabase) Connected database of the TRADES bars
+        :param headTimestamp: (int) Epoch seconds of the earliest TRADES data point IB has
+        :return: Nothing
+        """
+        lower = adjustments.getComparisonStart(db, contract.symbol, headTimestamp)
+        _, _, ranges = db.getCoverage(contract.symbol, 'TRADES', adjustments.COMPARISON_BAR_SIZE)
+        reqIds = []
+        for gapStart, gapEnd in planners.findGaps(ranges, lower, now):
+            reqIds += self.planHistoricalData(contract, gapStart, gapEnd, now, adjustments.COMPARISON_BAR_SIZE,
+                                              'TRADES', useRTH, 1, False, chartOptions)
+
+        # ADJUSTED_LAST requests cannot have an endDateTime
+        def compare():
+            self.getHistoricalData(contract, '', adjustments.getDurationString(lower, now),
+                                   adjustments.COMPARISON_BAR_SIZE, 'ADJUSTED_LAST', useRTH, 1, False, chartOptions)
+
+        if not reqIds:
+            compare()
+        waiting = (set(reqIds), compare)
+        for reqId in reqIds:
+            self.comparisons[reqId] = waiting
+
+    def releaseComparison(self, reqId):
+        """
+        Queues the ADJUSTED_LAST request waiting for reqId once it is the last of its daily TRADES requests to end
+        :param reqId: (int) Request which is over, answered or not
+        :return: Nothing
+        """
+        pending, compare = self.comparisons.pop(reqId, (None, None))
+        if pending is not None:
+            pending.discard(reqId)
+            if not pending:
+                compare()
+
+    def planHistoricalData(self, contract, lower, upper, now, barSizeSetting, whatToShow,
+                           useRTH, formatDate, keepUpToDate, chartOptions):
+        """
+        Queues the fewest historical data requests which cover [lower, upper], as worked out by planners.plan
+        :param contract: (contracts.Contract) My custom-made Contract object
+        :param lower: (int) Epoch seconds to fetch from
+        :param upper: (int) Epoch seconds to fetch up to
+        :param now: (int) Epoch seconds
+        :return: (list of int) reqId of each request
+        """
+        requests = planners.plan(lower, upper, barSizeSetting, now, useRTH)
+        logger.info('%d historicalData requests planned for %s', len(requests), contract.symbol)
+        return [self.getHistoricalData(contract, endDateTime, durationString, barSizeSetting, whatToShow,
+                                       useRTH, formatDate, keepUpToDate, chartOptions)
+                for endDateTime, durationString in requests]
 
     def getHistoricalData(self, contract, endDateTime, durationString, barSizeSetting, whatToShow,
-                          useRTH, formatDate, keepUpToDate, chartOptions, oldReqId=None):
+                          useRTH, formatDate, keepUpToDate, chartOptions):
         """
         Sends a historical data request to IB's server
         :param contract: (contracts.Contract) My custom-made Contract object
@@ -166,34 +421,28 @@ class IBHistoricalDataSession(EWrapper, EClient):
         :param formatDate: (int) 1 or 2
         :param keepUpToDate: (boolean) True or False
         :param chartOptions: (list)
-        :param oldReqId:
-        :return:
+        :return: (int) reqId
         """
         reqId = self.getNextId()
-        if oldReqId:
 
-            # Means my handler already has an existing event
-            logger.debug('Reindexing historicalDataEvent record')
-            self.historicBarHandler.reindexRecord(reqId, oldReqId)
-            logger.debug('historicalDataEvent record reindexed')
-
-        else:
-
-            # Create a HistoricalDataEvent object
-            logger.debug('Creating a historicalDataEvent')
-            historicalDataEvent = events.HistoricalDataEvent(
-                contract, endDateTime, durationString, barSizeSetting, whatToShow,
-                useRTH, formatDate, keepUpToDate, chartOptions, None, [])
-            logger.debug('historicalDataEvent created')
+        # Create a HistoricalDataEvent object
+        logger.debug('Creating a historicalDataEvent')
+        historicalDataEvent = events.HistoricalDataEvent(
+            contract, endDateTime, durationString, barSizeSetting, whatToShow,
+            useRTH, formatDate, keepUpToDate, chartOptions, None, buffers.BarBuffer())
+        logger.debug('historicalDataEvent created')
 
-            # Creating a new event in our handler
-            logger.debug('#Request %d: Creating historicalDataEvent record for %s' % (reqId, contract.symbol))
-            self.historicBarHandler.createRecord(reqId, historicalDataEvent)
-            logger.debug('#Request %d: historicalDataEvent record for %s created' % (reqId, contract.symbol))
+        # Creating a new event in our handler
+        logger.debug('#Request %d: Creating historicalDataEvent record for %s', reqId, contract.symbol)
+        self.historicBarHandler.createRecord(reqId, historicalDataEvent)
+        logger.debug('#Request %d: historicalDataEvent record for %s created', reqId, contract.symbol)
 
-        logger.info('#Request %d: Requesting historicalData for %s' % (reqId, contract.symbol))
-        self.reqHistoricalData(reqId, contract, endDateTime, durationString, barSizeSetting,
-                               whatToShow, useRTH, formatDate, keepUpToDate, chartOptions)
+        logger.info('#Request %d: Queueing historicalData request for %s', reqId, contract.symbol)
+        self.submit(reqId, contract, whatToShow, (endDateTime, durationString, barSizeSetting, useRTH, formatDate),
+                    lambda: self.reqHistoricalData(reqId, contract, endDateTime, durationString, barSizeSetting,
+                                                   whatToShow, useRTH, formatDate, keepUpToDate, chartOptions),
+                    'historicalData')
+        return reqId
 
     @iswrapper
     def historicalData(self, reqId, bar):
@@ -204,81 +453,219 @@ class IBHistoricalDataSession(EWrapper, EClient):
         :return: Nothing
         """
         super().historicalData(reqId, bar)
-
-        logger.debug('#Request %d: historicalData bar received. Editing historicalDataEvent record' % reqId)
+        self.timer.answer(reqId)
+        if self.journal:
+            self.journal.historicalData(reqId, bar)
+
+        # Called once per bar, so skip even the logging calls unless they are wanted
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug('#Request %d: historicalData bar received. Editing historicalDataEvent record', reqId)
         self.historicBarHandler.editRecord(reqId, bars=bar)
-        logger.debug('#Request %d: historicalDataEvent record edited' % reqId)
+        if debug:
+            logger.debug('#Request %d: historicalDataEvent record edited', reqId)
 
     @iswrapper
     def historicalDataEnd(self, reqId, start, end):
         """
-        Signifies the end of a batch of data. However, it will check the earliest data point it should parse.
-        If the next batch will be prior to this earliest data point, then stop. Else call getHistoricalData again.
+        Signifies the end of one planned request. Its bars are saved and [start, end] is recorded as covered.
         :param reqId: (int)
         :param start: (str)
         :param end: (str)
         :return: Nothing
         """
         super().historicalDataEnd(reqId, start, end)
-        logger.info('#Request %d: One batch of historicalData from %s to %s received' % (reqId, start, end))
-
-        logger.debug('#Request %d: Saving new batch of historicalData bars' % reqId)
-        self.historicBarHandler.closeRecord(reqId)
-        logger.debug('#Request %d: New batch of historicalData bars saved' % reqId)
-
-        event = self.historicBarHandler.getRecord(reqId)
-        headTimestampStr = event.headTimestamp
-        headTimestamp = datetime.strptime(headTimestampStr, etc.IB_DATE_FMT)
-        nextEndDatetime = datetime.strptime(start, etc.IB_DATE_FMT) - timedelta(days=1)
-        nextEndDatetimeStr = nextEndDatetime.strftime(etc.IB_DATE_FMT)
-        self.historicBarHandler.editRecord(reqId, endDateTime=nextEndDatetimeStr)
-
-        if nextEndDatetime > headTimestamp:
-            logger.info(
-                'Continuing to getHistoricalData for %s with new nextEndDateTimeStr = %s since headTimestamp = %s' %
-                (event.contract.symbol, nextEndDatetimeStr, headTimestampStr)
-            )
-
-            self.getHistoricalData(
-                event.contract, nextEndDatetimeStr, event.durationString,
-                event.barSizeSetting, event.whatToShow, event.useRTH, event.formatDate,
-                event.keepUpToDate, event.chartOptions, reqId)
-        else:
-            logger.info(
-                'No more historicalData for %s since new nextEndDateTimeStr = %s and headTimestamp = %s ' %
-                (event.contract.symbol, nextEndDatetimeStr, headTimestampStr)
-            )
+        self.scheduler.complete(reqId)
+        if self.journal:
+            self.journal.historicalDataEnd(reqId, start, end)
+        self.timer.end(reqId, len(self.historicBarHandler.getRecord(reqId).bars))
+        self.wakeup.set()
+        logger.info('#Request %d: One batch of historicalData from %s to %s received', reqId, start, end)
+
+        logger.debug('#Request %d: Saving new batch of historicalData bars', reqId)
+        self.historicBarHandler.closeRecord(reqId, start, end)
+        logger.debug('#Request %d: New batch of historicalData bars saved', reqId)
+        self.releaseComparison(reqId)
 
-
-class IBLiveSession(EClient, EWrapper):
-    def __init__(self, host, port, clientId):
+    @iswrapper
+    def error(self, reqId, errorCode, errorString):
+        super().error(reqId, errorCode, errorString)
+        metrics.ERRORS.labels(str(errorCode)).inc()
+
+        if schedulers.isPacingError(errorCode, errorString):
+            if self.scheduler.retry(reqId):
+                logger.warning('#Request %d: Pacing violation, request requeued', reqId)
+        elif schedulers.isTerminalError(errorCode, errorString):
+
+            # The request is over, so free up its in-flight slot. Notices leave it running and in flight
+            self.scheduler.complete(reqId)
+            self.timer.discard(reqId)
+            self.dropContractRequest(reqId)
+            self.releaseComparison(reqId)
+        self.wakeup.set()
+
+
+class IBLiveSession(ContractCacheMixin, EClient, EWrapper):
+    def __init__(self, host, port, clientId, barSizes=(), volumeThresholds=(), movingAverageHandler=None,
+                 impliedVolHandler=None, journal=None, lineManager=None):
+        """
+        :param barSizes: (list of str) Time bars to build from the tick stream and save, e.g. '5 secs' or '1 min'
+        :param volumeThresholds: (list of int) Volume bars to build from the tick stream and save, in shares per bar
+        :param movingAverageHandler: (handlers.MovingAverageHandler) Indicators to keep up to date from the stream
+        :param impliedVolHandler: (handlers.ImpliedVolHandler) Implied vols to solve every second for subscribed
+                                  options
+        :param journal: (journals.TickJournal) Records every tick, e.g. to replay them with journals.JournalReplayer
+        :param lineManager: (schedulers.MarketDataLineManager) Shares IB's market data lines between subscriptions,
+                            streaming some and taking snapshots of the rest, instead of requesting every one
+        """
         EWrapper.__init__(self)
         EClient.__init__(self, wrapper=self)
         self.connect(host, port, clientId)
 
         self.reqId = 0
-        self.tickHandler = handlers.IBTickHandler()
+        self.tickHandler = handlers.IBTickHandler(barSizes=barSizes, volumeThresholds=volumeThresholds,
+                                                  movingAverageHandler=movingAverageHandler,
+                                                  impliedVolHandler=impliedVolHandler)
+        self.cache = databases.ContractCacheDatabase()
+        self.cache.connect()
+        self.contractRequests = {}
+        self.journal = journal
+        # Receive times of ticks in epoch nanoseconds, which a journal replay substitutes with the journaled ones
+        self.clock = time.time_ns
+        self.lineManager = lineManager
+        self.messages = schedulers.MessageQueue(
+            messageBucket=lineManager.messageBucket if lineManager is not None else None)
+        self.wakeup = threading.Event()
+
+        if barSizes or impliedVolHandler:
+            threading.Thread(target=self.rollBars, name='BarAggregator', daemon=True).start()
+        if lineManager is not None:
+            quoteStore = self.tickHandler.quoteStore
+            client = str(clientId)
+            metrics.MARKET_DATA_LINES.labels(client, 'stream').setFunction(lambda: len(lineManager.streaming))
+            metrics.MARKET_DATA_LINES.labels(client, 'snapshot').setFunction(lambda: len(lineManager.snapshots))
+            metrics.QUOTE_STALENESS.labels(client).setFunction(
+                lambda: np.nanmax(quoteStore.getStaleness(), initial=0.))
+        threading.Thread(target=self.pump, name='MessagePump', daemon=True).start()
 
     def getNextId(self):
         self.reqId += 1
         return self.reqId
 
-    def getMktData(self, contract, genericTickList, snapshot, regulatorySnapshot, mktDataOptions):
+    def rollBars(self):
+        # Closes time bars on their boundary even when a symbol stops trading, and solves implied vols in one batch
+        while self.isConnected():
+            time.sleep(1. - time.time() % 1.)
+            self.tickHandler.rollBars(time.time())
+            self.tickHandler.updateImpliedVols(time.time())
+
+    def sendMessage(self, send):
+        self.messages.submit(send)
+        self.wakeup.set()
+
+    def pump(self):
+        # Sends queued messages, then the line manager's requests, as its schedule and the message rate allow
+        while self.isConnected():
+            self.messages.dispatch()
+            waits = [1.]
+            if self.lineManager is not None:
+                self.lineManager.dispatch()
+                waits.append(self.lineManager.nextWakeup())
+            if self.messages:
+                waits.append(self.messages.nextWakeup())
+            self.wakeup.wait(min(waits))
+            self.wakeup.clear()
+
+    def getMktData(self, contract, genericTickList, snapshot, regulatorySnapshot, mktDataOptions, priority=0):
+        """
+        :param priority: (float) With a line manager, lower priorities get streaming lines first and the rest are
+                         refreshed with snapshots
+        :return: (int) reqId whose ticks refresh the contract
+        """
         reqId = self.getNextId()
+        self.subscribe(reqId, contract, genericTickList, snapshot, regulatorySnapshot, mktDataOptions)
+
+        # Market data for a contract missing from the cache waits for its conId
+        self.resolveContract(contract, lambda: self.requestMktData(
+            reqId, contract, genericTickList, snapshot, regulatorySnapshot, mktDataOptions, priority))
+        return reqId
+
+    def requestMktData(self, reqId, contract, genericTickList, snapshot, regulatorySnapshot, mktDataOptions,
+                       priority):
+        if snapshot:
+            self.sendMessage(
+                lambda: self.reqMktData(reqId, contract, genericTickList, True, regulatorySnapshot, mktDataOptions))
+        elif self.lineManager is None:
+            self.sendMessage(lambda: self.stream(reqId, contract, genericTickList, regulatorySnapshot, mktDataOptions))
+        else:
+            # Snapshots take no generic ticks, see error 321
+            self.lineManager.add(
+                reqId, priority,
+                lambda: self.stream(reqId, contract, genericTickList, regulatorySnapshot, mktDataOptions),
+                lambda: self.reqMktData(reqId, contract, '', True, regulatorySnapshot, mktDataOptions),
+                lambda: self.cancelStream(reqId))
+            self.wakeup.set()
+
+    def stream(self, reqId, contract, genericTickList, regulatorySnapshot, mktDataOptions):
+        self.reqMktData(reqId, contract, genericTickList, False, regulatorySnapshot, mktDataOptions)
+        # Bars starting from now on see every trade, so they count as coverage
+        self.tickHandler.setStreaming(reqId, self.clock() / 1e9)
+
+    def cancelStream(self, reqId):
+        self.tickHandler.setStreaming(reqId, None)
+        self.cancelMktData(reqId)
+
+    def subscribe(self, reqId, contract, genericTickList='', snapshot=False, regulatorySnapshot=False,
+                  mktDataOptions=()):
+        """
+        Gets ready for the ticks of reqId, without requesting them, e.g. when replaying a journal
+        :return: Nothing
+        """
         tickEvent = events.TickEvent(contract=contract, genericTickList=genericTickList, snapshot=snapshot,
                                      regulatorySnapshot=regulatorySnapshot, mktDataOptions=mktDataOptions)
         self.tickHandler.createRecord(reqId, tickEvent)
-        self.reqMktData(reqId, contract, genericTickList, snapshot, regulatorySnapshot, mktDataOptions)
+        if self.journal:
+            self.journal.subscribe(reqId, contract)
 
     @iswrapper
     def tickPrice(self, reqId, tickType, price, attrib):
         super().tickPrice(reqId, tickType, price, attrib)
-
+        receiveTime = self.clock()
+        if self.journal:
+            self.journal.tickPrice(reqId, tickType, price, attrib, receiveTime)
+        self.tickHandler.refreshRecord(reqId, tickType, price, receiveTime)
 
     @iswrapper
     def tickSize(self, reqId, tickType, size):
         super().tickSize(reqId, tickType, size)
+        receiveTime = self.clock()
+        if self.journal:
+            self.journal.tickSize(reqId, tickType, size, receiveTime)
+        self.tickHandler.refreshRecord(reqId, tickType, size, receiveTime)
 
     @iswrapper
     def tickGeneric(self, reqId, tickType, value):
         super().tickGeneric(reqId, tickType, value)
+        receiveTime = self.clock()
+        if self.journal:
+            self.journal.tickGeneric(reqId, tickType, value, receiveTime)
+        self.tickHandler.refreshRecord(reqId, tickType, value, receiveTime)
+
+    @iswrapper
+    def tickSnapshotEnd(self, reqId):
+        super().tickSnapshotEnd(reqId)
+        if self.lineManager is not None:
+            self.lineManager.complete(reqId)
+            self.wakeup.set()
+
+    @iswrapper
+    def error(self, reqId, errorCode, errorString):
+        super().error(reqId, errorCode, errorString)
+        metrics.ERRORS.labels(str(errorCode)).inc()
+        if schedulers.isTerminalError(errorCode, errorString):
+            self.dropContractRequest(reqId)
+        if self.lineManager is not None and errorCode == schedulers.MAX_TICKERS_ERROR_CODE:
+            logger.warning('#Request %d: No market data line left, fewer lines than assumed', reqId)
+            self.tickHandler.setStreaming(reqId, None)
+            self.lineManager.reject(reqId)
+            self.wakeup.set()
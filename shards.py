@@ -0,0 +1,182 @@
+import queue
+import asyncio
+import logging
+import handlers
+import databases
+import schedulers
+import asyncsessions
+import multiprocessing
+
+
+logger = logging.getLogger(__name__)
+
+MAX_RESTARTS = 3
+
+
+class QueueWriter:
+    """
+    Stands in for databases.HistoricalBarWriter in a worker process, handing every write to the coordinator, whose
+    writer is the only one which touches the database.
+    """
+    def __init__(self, outbox):
+        self.outbox = outbox
+
+    def upsertBars(self, tblName, barSize, records):
+        self.outbox.put(('upsertBars', (tblName, barSize, records)))
+
+    def addCoverage(self, symbol, whatToShow, barSize, startEpoch, endEpoch):
+        self.outbox.put(('addCoverage', (symbol, whatToShow, barSize, startEpoch, endEpoch)))
+
+    def updateAdjustments(self, symbol, records):
+        self.outbox.put(('updateAdjustments', (symbol, records)))
+
+
+def runWorker(shardId, host, port, clientId, inbox, outbox, maxInFlight, globalLimiter, messageBucket, barSizeSetting,
+              whatToShow, useRTH, formatDate):
+    # Entry point of a worker process
+    logging.basicConfig(level=logging.INFO)
+    scheduler = schedulers.PacingScheduler(maxInFlight=maxInFlight, globalLimiter=globalLimiter,
+                                           messageBucket=messageBucket)
+    asyncio.run(work(shardId, host, port, clientId, inbox, outbox, scheduler, barSizeSetting, whatToShow, useRTH,
+                     formatDate))
+
+
+async def work(shardId, host, port, clientId, inbox, outbox, scheduler, barSizeSetting, whatToShow, useRTH,
+               formatDate):
+    """
+    Backfills every contract the coordinator puts in inbox, concurrently, until it puts None
+    """
+    session = asyncsessions.IBAsyncSession(scheduler)
+    await session.connectAsync(host, port, clientId)
+    writer = QueueWriter(outbox)
+    loop = asyncio.get_running_loop()
+
+    def report(task, key):
+        error = task.exception() if not task.cancelled() else asyncio.CancelledError()
+        outbox.put(('done', (shardId, key, None if error else task.result(), repr(error) if error else None)))
+
+    tasks = []
+    while True:
+        contract = await loop.run_in_executor(None, inbox.get)
+        if contract is None:
+            break
+        task = loop.create_task(session.updateContract(contract, barSizeSetting, whatToShow, useRTH, formatDate,
+                                                       writer))
+        task.add_done_callback(lambda task, key=databases.ContractCacheDatabase.getKey(contract): report(task, key))
+        tasks.append(task)
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await session.disconnectAsync()
+
+
+class ShardCoordinator:
+    """
+    Spreads backfills over one worker process per clientId, so that decoding and bar handling use every core.
+    The workers pace their requests against one shared budget of IB's global limits, and send their bars back
+    over a queue to the coordinator, which writes them with the single databases.HistoricalBarWriter. The contracts
+    of a worker which dies are handed to the ones still alive.
+    """
+    def __init__(self, host, port, clientIds):
+        """
+        :param host: (str)
+        :param port: (int)
+        :param clientIds: (list of int) One worker process per clientId
+        """
+        self.host = host
+        self.port = port
+        self.clientIds = list(clientIds)
+        self.context = multiprocessing.get_context('spawn')
+        self.globalLimiter = schedulers.SharedSlidingWindowLimiter(
+            schedulers.MAX_REQUESTS, schedulers.MAX_REQUESTS_WINDOW, context=self.context)
+        self.messageBucket = schedulers.SharedTokenBucket(
+            schedulers.MAX_MESSAGES_PER_SECOND, schedulers.MAX_MESSAGES_PER_SECOND, context=self.context)
+        self.outbox = self.context.Queue()
+        self.workers = {}
+        self.inboxes = {}
+        self.restarts = 0
+
+    def startWorker(self, shardId, args):
+        # IB's in-flight limit is split evenly, the other global limits are shared
+        maxInFlight = max(1, schedulers.MAX_IN_FLIGHT // len(self.clientIds))
+        self.inboxes[shardId] = self.context.Queue()
+        self.workers[shardId] = self.context.Process(
+            target=runWorker, name='IBShard-%d' % shardId, daemon=True,
+            args=(shardId, self.host, self.port, self.clientIds[shardId], self.inboxes[shardId], self.outbox,
+                  maxInFlight, self.globalLimiter, self.messageBucket) + args)
+        self.workers[shardId].start()
+
+    def assign(self, contract, shardId, assigned):
+        assigned[databases.ContractCacheDatabase.getKey(contract)] = (contract, shardId)
+        self.inboxes[shardId].put(contract)
+
+    def run(self, contracts, barSizeSetting, whatToShow, useRTH=True, formatDate=1):
+        """
+        :param contracts: (list of contracts.Contract)
+        :param barSizeSetting: (str) See https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_barsize
+        :param whatToShow: (str) https://interactivebrokers.github.io/tws-api/historical_bars.html#hd_what_to_show
+        :param useRTH: (Boolean) True or False
+        :param formatDate: (int) 1 or 2
+        :return: (dict) Bars saved per contract key, see databases.ContractCacheDatabase.getKey
+        """
+        args = (barSizeSetting, whatToShow, useRTH, formatDate)
+        writer = handlers.IBHistoricBarHandler.getWriter(whatToShow)
+        for shardId in range(len(self.clientIds)):
+            self.startWorker(shardId, args)
+
+        # Contracts still waiting for a worker to finish them, and which worker has them
+        assigned = {}
+        for i, contract in enumerate(contracts):
+            self.assign(contract, i % len(self.clientIds), assigned)
+
+        counts = {}
+        while assigned:
+            self.rebalance(assigned, args)
+            try:
+                kind, message = self.outbox.get(timeout=1.)
+            except queue.Empty:
+                continue
+
+            if kind == 'done':
+                shardId, key, count, error = message
+                assigned.pop(key, None)
+                if error:
+                    logger.error('Shard %d failed on %s: %s', shardId, key[0], error)
+                else:
+                    counts[key] = count
+                    logger.info('Shard %d saved %d bars of %s, %d contracts left', shardId, count, key[0],
+                                len(assigned))
+            else:
+                getattr(writer, kind)(*message)
+
+        for shardId, process in self.workers.items():
+            if process.is_alive():
+                self.inboxes[shardId].put(None)
+        for process in self.workers.values():
+            process.join()
+        writer.flush()
+        return counts
+
+    def rebalance(self, assigned, args):
+        dead = [shardId for shardId, process in self.workers.items() if not process.is_alive()]
+        if not dead:
+            return
+        alive = [shardId for shardId in self.workers if shardId not in dead]
+        orphans = [contract for contract, shardId in assigned.values() if shardId in dead]
+        if not alive:
+            if self.restarts == MAX_RESTARTS:
+                raise Exception('Every worker died %d times, giving up on %d contracts' %
+                                (MAX_RESTARTS + 1, len(assigned)))
+            # Reconnecting with the first clientId is all that can be done
+            self.restarts += 1
+            logger.warning('Every worker died, restarting shard %d', dead[0])
+            self.startWorker(dead[0], args)
+            alive = [dead.pop(0)]
+
+        for shardId in dead:
+            logger.warning('Shard %d died with exit code %s, rebalancing its contracts',
+                           shardId, self.workers[shardId].exitcode)
+            del self.workers[shardId]
+            del self.inboxes[shardId]
+
+        for i, contract in enumerate(orphans):
+            self.assign(contract, alive[i % len(alive)], assigned)
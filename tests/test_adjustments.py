@@ -0,0 +1,41 @@
+import numpy as np
+import adjustments
+
+
+def makeCloses(days, seed=0):
+    rng = np.random.default_rng(seed)
+    epochs = np.arange(days, dtype=np.int64) * adjustments.SECONDS_PER_DAY
+    closes = np.round(20. * np.exp(np.cumsum(rng.normal(0., 0.02, days))), 2)
+    return epochs, closes
+
+
+def testFindsASplit():
+    epochs, closes = makeCloses(250)
+    closes[100:] = np.round(closes[100:] / 2., 2)
+    # Before the ex-date, adjusted closes are the raw ones halved
+    adjustedCloses = np.round(np.where(epochs < epochs[100], closes / 2., closes), 2)
+    exEpochs, factors = adjustments.findFactors(epochs, closes, adjustedCloses)
+    assert exEpochs.tolist() == [epochs[100]]
+    assert abs(factors[0] - 0.5) < 1e-3
+
+
+def testRoundingOfSmallAdjustedClosesIsNoEvent():
+    epochs, closes = makeCloses(250)
+    # Adjusted closes of a stock which split 224 for 1 since are a few cents, rounded to the cent
+    adjustedCloses = np.round(closes / 224., 2)
+    exEpochs, factors = adjustments.findFactors(epochs, closes, adjustedCloses)
+    assert len(exEpochs) == 0
+
+
+def testCumulativeFactorsApplyBeforeEachExDate():
+    epochs = np.array([0, 10, 20, 30])
+    factors = adjustments.getCumulativeFactors(epochs, np.array([25, 15]), np.array([0.5, 0.9]))
+    assert np.allclose(factors, [0.45, 0.45, 0.5, 1.])
+
+
+def testComparisonStopsAtTheFirstGap():
+    day = adjustments.SECONDS_PER_DAY
+    ranges = [(-3600, 90 * day), (250 * day, 300 * day)]
+    assert adjustments.getCoveredUntil(ranges, 0) == 90 * day
+    # Only the later part of the window has landed, so nothing can be compared yet
+    assert adjustments.getCoveredUntil(ranges[1:], 0) is None
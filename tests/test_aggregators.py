@@ -0,0 +1,30 @@
+import numpy as np
+import aggregators
+
+
+def testTimeBarsCloseOnTheirBoundary():
+    aggregator = aggregators.TimeBarAggregator('5 secs', 4)
+    assert aggregator.update(0, 10., 100, 1000.5) is None
+    assert aggregator.update(1, 20., 100, 1001.) is None
+    assert aggregator.update(0, 11., 100, 1004.9) is None
+    bars = aggregator.update(0, 12., 100, 1005.)
+    assert bars.rows.tolist() == [0, 1]
+    assert bars.epochs.tolist() == [1000, 1000]
+    assert bars.open.tolist() == [10., 20.] and bars.close.tolist() == [11., 20.]
+    assert aggregator.roll(1009.) is None
+    assert aggregator.roll(1010.).close.tolist() == [12.]
+
+
+def testVolumeBarsInTheSameSecondKeepTheirOwnTimes():
+    aggregator = aggregators.VolumeBarAggregator(100, 2)
+    epochs = []
+    for epoch in [1000.1, 1000.2, 1000.3, 1002.]:
+        bars = aggregator.update(0, 10., 100, epoch)
+        epochs.extend(bars.epochs.tolist())
+    assert epochs == [1000.1, 1000.2, 1000.3, 1002.]
+    assert aggregators.isVolumeBarSize(bars.barSize)
+
+    # Trades received at once are told apart by their sequence instead
+    assert aggregator.update(0, 10., 100, 1002.).sequences.tolist() == [1]
+    aggregator.update(1, 10., 60, 1003.5)
+    assert aggregator.update(1, 10., 60, 1004.).epochs.tolist() == [1003.5]
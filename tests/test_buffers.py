@@ -0,0 +1,15 @@
+import numpy as np
+import buffers
+from ibapi.ticktype import TickTypeEnum
+
+
+def testStalenessCountsFromSubscriptionUntilTheFirstUpdate():
+    store = buffers.QuoteStore(4)
+    store.addSymbol(1, 'A', now=1000 * 10 ** 9)
+    store.addSymbol(2, 'B', now=1000 * 10 ** 9)
+    store.addSymbol(3, 'C', now=1000 * 10 ** 9)
+    store.update(1, TickTypeEnum.BID, 10., 1005 * 10 ** 9)
+    store.removeSymbol(3)
+    staleness = store.getStaleness(now=1010 * 10 ** 9)
+    assert staleness[:2].tolist() == [5., 10.]
+    assert np.isnan(staleness[2])
@@ -0,0 +1,103 @@
+import dates
+import planners
+import aggregators
+from datetime import date
+
+
+def epoch(dateStr):
+    return dates.toEpoch(dateStr)
+
+
+def testEveryBarSizeHasAStep():
+    for barSize in list(aggregators.BAR_SIZE_SECONDS) + ['1 day', '1 week', '1 month']:
+        assert barSize in planners.MAX_DURATIONS
+    for barSize, (maxDuration, unit) in planners.MAX_DURATIONS.items():
+        if unit == 'S':
+            assert maxDuration % aggregators.BAR_SIZE_SECONDS[barSize] == 0
+
+
+def testSecondsStepsSplitASession():
+    requests = planners.plan(epoch('20240102 09:30:00'), epoch('20240102 16:00:00'), '1 secs', epoch('20240103'))
+    assert len(requests) == 23400 // 1800
+    assert requests[0] == ('20240102 16:00:00', '1800 S')
+    assert requests[-1] == ('20240102 10:00:00', '1800 S')
+
+
+def testDayStepsSkipHolidays():
+    # New Year's Day
+    requests = planners.plan(epoch('20240101'), epoch('20240105 16:00:00'), '1 min', epoch('20240106'))
+    assert requests == [('20240105 16:00:00', '1 D'), ('20240104 16:00:00', '1 D'), ('20240103 16:00:00', '1 D'),
+                        ('20240102 16:00:00', '1 D')]
+
+
+def testDayStepsOnlyJoinConsecutiveDays():
+    # Thursday to Tuesday, over a weekend
+    requests = planners.plan(epoch('20240104'), epoch('20240109 16:00:00'), '2 mins', epoch('20240110'))
+    assert requests == [('20240109 16:00:00', '2 D'), ('20240105 16:00:00', '2 D')]
+
+
+def testNoRequestsOutsideSessions():
+    assert planners.plan(epoch('20240106'), epoch('20240107 23:00:00'), '1 min', epoch('20240110')) == []
+    # Good Friday
+    assert planners.plan(epoch('20240329'), epoch('20240329 23:00:00'), '1 min', epoch('20240401')) == []
+    assert planners.plan(epoch('20240102 16:00:00'), epoch('20240103 09:30:00'), '1 min', epoch('20240104')) == []
+
+
+def testExtendedHours():
+    requests = planners.plan(epoch('20240102'), epoch('20240102 23:00:00'), '30 secs', epoch('20240103'), False)
+    assert requests[0] == ('20240102 20:00:00', '28800 S')
+    assert len(requests) == 2
+
+
+def testWeekStepsCoverCalendarWeeks():
+    # Martin Luther King Day falls in the second week
+    requests = planners.plan(epoch('20240102'), epoch('20240119 16:00:00'), '5 mins', epoch('20240120'))
+    assert requests == [('20240119 16:00:00', '1 W'), ('20240112 16:00:00', '1 W'), ('20240105 16:00:00', '1 W')]
+
+
+def testYearStepsTakeOneRequest():
+    assert planners.plan(epoch('20231201'), epoch('20231231'), '1 day', epoch('20240101')) == \
+        [('20231231 00:00:00', '30 D')]
+    assert planners.plan(epoch('20220102'), epoch('20240102'), '1 day', epoch('20240103')) == \
+        [('20240102 00:00:00', '2 Y')]
+
+
+def testUpperIsCappedAtNow():
+    requests = planners.plan(epoch('20240102'), epoch('20240105'), '1 min', epoch('20240103 12:00:00'))
+    assert requests == [('20240103 12:00:00', '1 D'), ('20240102 16:00:00', '1 D')]
+
+
+def testPlansAreDeterministic():
+    args = (epoch('20230101'), epoch('20240101'), '1 hour', epoch('20240101'))
+    assert planners.plan(*args) == planners.plan(*args)
+
+
+def testNYSEHolidays():
+    calendar = dates.TradingCalendar()
+    # Independence Day 2026 is a Saturday, observed on the Friday
+    assert not calendar.isTradingDay(date(2026, 7, 3))
+    # New Year's Day 2022 is a Saturday, which is not observed on the Friday before
+    assert calendar.isTradingDay(date(2021, 12, 31))
+    assert not calendar.isTradingDay(date(2024, 11, 28))
+    assert not calendar.isTradingDay(date(2012, 10, 29))
+    assert not calendar.isTradingDay(date(2024, 6, 19))
+    assert calendar.isTradingDay(date(2021, 6, 18))
+
+
+def testGapsBetweenCoveredRanges():
+    ranges = [(100, 200), (300, 400)]
+    assert planners.findGaps([], 0, 500) == [(0, 500)]
+    assert planners.findGaps(ranges, 0, 500) == [(0, 100), (200, 300), (400, 500)]
+    assert planners.findGaps(ranges, 150, 350) == [(200, 300)]
+    assert planners.findGaps(ranges, 100, 400) == [(200, 300)]
+    assert planners.findGaps([(0, 500)], 100, 400) == []
+
+
+def testGapPlansOnlyRequestMissingSessions():
+    # Tuesday and Thursday stored, Wednesday and Friday missing
+    ranges = [(epoch('20240102 09:30:00'), epoch('20240102 16:00:00')),
+              (epoch('20240104 09:30:00'), epoch('20240104 16:00:00'))]
+    now = epoch('20240106')
+    requests = [request for gapStart, gapEnd in planners.findGaps(ranges, epoch('20240102'), epoch('20240105 23:00:00'))
+                for request in planners.plan(gapStart, gapEnd, '1 min', now)]
+    assert requests == [('20240103 16:00:00', '1 D'), ('20240105 16:00:00', '1 D')]
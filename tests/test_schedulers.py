@@ -0,0 +1,181 @@
+import schedulers
+
+
+class FakeClock:
+    def __init__(self, now=1000.):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def makeScheduler(clock, **kwargs):
+    sent = []
+    scheduler = schedulers.PacingScheduler(clock=clock, **kwargs)
+
+    def submit(reqId, symbol, identicalKey=None, priority=None):
+        key = (symbol, 'STK', 'SMART', 'TRADES')
+        scheduler.submit(reqId, key, (key, identicalKey or reqId), lambda: sent.append(reqId), priority)
+
+    return scheduler, submit, sent
+
+
+def testTokenBucketRefillsContinuously():
+    clock = FakeClock()
+    bucket = schedulers.TokenBucket(2, 2., clock)
+    assert bucket.consume() and bucket.consume()
+    assert not bucket.consume()
+    assert bucket.waitTime() == 0.5
+    clock.advance(0.5)
+    assert bucket.consume()
+    clock.advance(10.)
+    bucket.refill()
+    assert bucket.tokens == 2
+
+
+def testSlidingWindowLimiterExpiresOldRequests():
+    clock = FakeClock()
+    limiter = schedulers.SlidingWindowLimiter(2, 10., clock)
+    limiter.record('A')
+    clock.advance(4.)
+    limiter.record('A')
+    assert not limiter.allow('A')
+    assert limiter.allow('B')
+    assert limiter.waitTime('A') == 6.
+    clock.advance(6.)
+    assert limiter.allow('A')
+    assert limiter.waitTime('A') == 0.
+
+
+def testSchedulerKeepsToTheGlobalWindow():
+    clock = FakeClock()
+    scheduler, submit, sent = makeScheduler(clock, globalLimiter=schedulers.SlidingWindowLimiter(3, 600., clock))
+    for reqId in range(5):
+        submit(reqId, 'SYM%d' % reqId)
+    assert scheduler.dispatch() == [0, 1, 2]
+    assert scheduler.nextWakeup() == 600.
+    clock.advance(600.)
+    assert scheduler.dispatch() == [3, 4]
+
+
+def testSchedulerTakesContractsInTurn():
+    clock = FakeClock()
+    scheduler, submit, sent = makeScheduler(clock)
+    for reqId, symbol in enumerate(['A', 'A', 'A', 'B']):
+        submit(reqId, symbol)
+    scheduler.dispatch()
+    assert sent == [0, 3, 1, 2]
+
+
+def testSchedulerPacesTheSameContract():
+    clock = FakeClock()
+    scheduler, submit, sent = makeScheduler(clock)
+    for reqId in range(7):
+        submit(reqId, 'A')
+    assert len(scheduler.dispatch()) == schedulers.MAX_CONTRACT_REQUESTS
+    assert scheduler.nextWakeup() == schedulers.MAX_CONTRACT_REQUESTS_WINDOW
+    clock.advance(schedulers.MAX_CONTRACT_REQUESTS_WINDOW)
+    assert scheduler.dispatch() == [5, 6]
+
+
+def testSchedulerWaitsBeforeIdenticalRequests():
+    clock = FakeClock()
+    scheduler, submit, sent = makeScheduler(clock)
+    submit(0, 'A', 'same')
+    submit(1, 'A', 'same')
+    assert scheduler.dispatch() == [0]
+    clock.advance(schedulers.IDENTICAL_REQUEST_INTERVAL - 1)
+    assert scheduler.dispatch() == []
+    clock.advance(1)
+    assert scheduler.dispatch() == [1]
+
+
+def testSchedulerLimitsRequestsInFlight():
+    clock = FakeClock()
+    scheduler, submit, sent = makeScheduler(clock, maxInFlight=2)
+    for reqId in range(3):
+        submit(reqId, 'SYM%d' % reqId)
+    assert scheduler.dispatch() == [0, 1]
+    assert scheduler.nextWakeup() is None
+    scheduler.complete(0)
+    assert scheduler.dispatch() == [2]
+
+
+def testSchedulerKeepsToTheMessageRate():
+    clock = FakeClock()
+    scheduler, submit, sent = makeScheduler(clock, messageBucket=schedulers.TokenBucket(2, 2., clock))
+    for reqId in range(3):
+        submit(reqId, 'SYM%d' % reqId)
+    assert scheduler.dispatch() == [0, 1]
+    assert scheduler.nextWakeup() == 0.5
+    clock.advance(0.5)
+    assert scheduler.dispatch() == [2]
+
+
+def testMessagesShareTheMessageRate():
+    clock = FakeClock()
+    scheduler, submit, sent = makeScheduler(clock, messageBucket=schedulers.TokenBucket(2, 2., clock))
+    submit(0, 'A')
+    for name in ['details A', 'details B']:
+        scheduler.submitMessage(lambda name=name: sent.append(name))
+    assert scheduler.dispatch() == []
+    assert sent == ['details A', 'details B']
+    assert scheduler.nextWakeup() == 0.5
+    clock.advance(0.5)
+    assert scheduler.dispatch() == [0]
+
+
+def testSharedWindowIsOnlyTakenOnce():
+    clock = FakeClock()
+    limiter = schedulers.SharedSlidingWindowLimiter(2, 10., clock)
+    assert limiter.allow()
+    assert limiter.tryAcquire() and limiter.tryAcquire()
+    assert not limiter.tryAcquire()
+    first, submitFirst, sentFirst = makeScheduler(clock, globalLimiter=limiter)
+    submitFirst(0, 'A')
+    assert first.dispatch() == []
+    clock.advance(10.)
+    second, submitSecond, sentSecond = makeScheduler(clock, globalLimiter=limiter)
+    submitSecond(1, 'B')
+    assert second.dispatch() == [1] and first.dispatch() == [0]
+    submitSecond(2, 'C')
+    assert second.dispatch() == []
+
+
+def testSchedulerRetriesAfterADelay():
+    clock = FakeClock()
+    scheduler, submit, sent = makeScheduler(clock)
+    submit(0, 'A')
+    scheduler.dispatch()
+    assert scheduler.retry(0, delay=5.)
+    assert scheduler.dispatch() == []
+    clock.advance(schedulers.IDENTICAL_REQUEST_INTERVAL)
+    assert scheduler.dispatch() == [0]
+    assert sent == [0, 0]
+
+
+def testNoticesDoNotEndRequests():
+    assert not schedulers.isTerminalError(2104, 'Market data farm connection is OK')
+    assert not schedulers.isTerminalError(165, 'Historical Market Data Service query message')
+    assert not schedulers.isTerminalError(162, 'Historical Market Data Service error message:API historical data '
+                                               'query cancelled: pacing violation')
+    assert schedulers.isTerminalError(162, 'Historical Market Data Service error message:HMDS query returned no data')
+    assert schedulers.isTerminalError(200, 'No security definition has been found for the request')
+
+
+def testTimedOutSnapshotsAreCancelledBeforeTheirNextRequest():
+    clock = FakeClock()
+    manager = schedulers.MarketDataLineManager(clock, maxLines=2, snapshotLines=1, refreshInterval=0.)
+    sent = []
+    for reqId in range(2):
+        manager.add(reqId, reqId, lambda reqId=reqId: sent.append(('stream', reqId)),
+                    lambda reqId=reqId: sent.append(('snapshot', reqId)),
+                    lambda reqId=reqId: sent.append(('cancel', reqId)))
+    manager.dispatch()
+    assert sent == [('stream', 0), ('snapshot', 1)]
+    clock.advance(schedulers.SNAPSHOT_TIMEOUT + 1)
+    manager.dispatch()
+    assert sent[2:] == [('cancel', 1), ('snapshot', 1)]
@@ -0,0 +1,18 @@
+import numpy as np
+import volatility
+
+
+def testImpliedVolsRecoverTheVolatility():
+    strikes = np.array([80., 100., 120., 100.])
+    isCall = np.array([True, True, False, False])
+    vols = np.array([0.2, 0.35, 0.5, 1.5])
+    prices = volatility.getPrices(100., strikes, 0.5, vols, isCall)
+    solved = volatility.getImpliedVols(prices, 100., strikes, 0.5, isCall)
+    assert np.allclose(solved, vols, atol=1e-6)
+
+
+def testImpliedVolsAreUnsolvedWhereThePriceHardlyDependsOnThem():
+    # A week to expiry, far out of the money, where every volatility up to 20% prices within the tolerance
+    prices = volatility.getPrices(100., np.array([200.]), 7 / 365., 0.2, True)
+    assert prices[0] < volatility.PRICE_TOLERANCE
+    assert np.isnan(volatility.getImpliedVols(prices, 100., np.array([200.]), 7 / 365., True, guesses=0.05)).all()
@@ -0,0 +1,184 @@
+import numpy as np
+
+
+RISK_FREE_RATE = 0.02
+DAYS_PER_YEAR = 365.
+MIN_VOL = 1e-4
+MAX_VOL = 10.
+PRICE_TOLERANCE = 1e-8
+# Largest volatility error accepted, judged from the price error over the vega or from the width of the bracket
+VOL_TOLERANCE = 1e-6
+# Vega as a fraction of the spot below which the price hardly depends on the volatility, which is then left unsolved
+MIN_RELATIVE_VEGA = 1e-8
+MAX_ITERATIONS = 100
+
+
+def getNormCdf(x):
+    """
+    Cumulative standard normal of a whole array, from Hart's rational approximation (double precision accuracy)
+    :param x: (np.ndarray)
+    :return: (np.ndarray)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    z = np.abs(x)
+    exponential = np.exp(-0.5 * z * z)
+
+    numerator = 3.52624965998911e-02 * z + 0.700383064443688
+    for c in [6.37396220353165, 33.912866078383, 112.079291497871, 221.213596169931, 220.206867912376]:
+        numerator = numerator * z + c
+    denominator = 8.83883476483184e-02 * z + 1.75566716318264
+    for c in [16.064177579207, 86.7807322029461, 296.564248779674, 637.333633378831, 793.826512519948,
+              440.413735824752]:
+        denominator = denominator * z + c
+    small = exponential * numerator / denominator
+
+    # Continued fraction for the tail
+    fraction = z + 0.65
+    for c in [4., 3., 2., 1.]:
+        fraction = z + c / fraction
+    with np.errstate(divide='ignore'):
+        large = exponential / fraction / 2.506628274631
+
+    tail = np.where(z < 7.07106781186547, small, np.where(z < 37., large, 0.))
+    return np.where(x > 0, 1. - tail, tail)
+
+
+def getNormPdf(x):
+    return np.exp(-0.5 * x * x) / np.sqrt(2. * np.pi)
+
+
+def getD1D2(spots, strikes, times, vols, rate, dividend):
+    volTime = vols * np.sqrt(times)
+    d1 = (np.log(spots / strikes) + (rate - dividend + 0.5 * vols * vols) * times) / volTime
+    return d1, d1 - volTime
+
+
+def getPrices(spots, strikes, times, vols, isCall, rate=RISK_FREE_RATE, dividend=0.):
+    """
+    Black-Scholes prices of European options, element-wise
+    :param spots: (np.ndarray) Underlying prices
+    :param strikes: (np.ndarray)
+    :param times: (np.ndarray) Years to expiry
+    :param vols: (np.ndarray) Annualized volatilities
+    :param isCall: (np.ndarray) True for calls, False for puts
+    :param rate: (float) Continuously compounded risk free rate
+    :param dividend: (float) Continuously compounded dividend yield
+    :return: (np.ndarray)
+    """
+    d1, d2 = getD1D2(spots, strikes, times, vols, rate, dividend)
+    forward = spots * np.exp(-dividend * times)
+    discounted = strikes * np.exp(-rate * times)
+    call = forward * getNormCdf(d1) - discounted * getNormCdf(d2)
+    # Put-call parity
+    return np.where(isCall, call, call - forward + discounted)
+
+
+def getVegas(spots, strikes, times, vols, rate=RISK_FREE_RATE, dividend=0.):
+    d1, _ = getD1D2(spots, strikes, times, vols, rate, dividend)
+    return spots * np.exp(-dividend * times) * getNormPdf(d1) * np.sqrt(times)
+
+
+def getBounds(spots, strikes, times, isCall, rate, dividend):
+    # No-arbitrage bounds of a European price: intrinsic value of the forward below, the forward or strike above
+    forward = spots * np.exp(-dividend * times)
+    discounted = strikes * np.exp(-rate * times)
+    lower = np.where(isCall, np.maximum(forward - discounted, 0.), np.maximum(discounted - forward, 0.))
+    upper = np.where(isCall, forward, discounted)
+    return lower, upper
+
+
+def getImpliedVols(prices, spots, strikes, times, isCall, rate=RISK_FREE_RATE, dividend=0., guesses=None,
+                   tolerance=PRICE_TOLERANCE, maxIterations=MAX_ITERATIONS):
+    """
+    Solves Black-Scholes for the volatility of every option at once. Each iteration takes a Newton step where it stays
+    inside the bracket known to hold the root and bisects the bracket elsewhere, and only rows which have not
+    converged are carried to the next iteration.
+    :param prices: (np.ndarray) Option prices
+    :param spots: (np.ndarray) Underlying prices
+    :param strikes: (np.ndarray)
+    :param times: (np.ndarray) Years to expiry
+    :param isCall: (np.ndarray) True for calls, False for puts
+    :param rate: (float) Continuously compounded risk free rate
+    :param dividend: (float) Continuously compounded dividend yield
+    :param guesses: (np.ndarray) Starting volatilities, e.g. the previous solution on live quotes. NaN where unknown
+    :param tolerance: (float) Largest price error accepted
+    :param maxIterations: (int)
+    :return: (np.ndarray) Implied volatilities, NaN where the price is outside its no-arbitrage bounds, where it is so
+             insensitive to the volatility that a price within tolerance does not pin it down, or where the solver
+             did not converge
+    """
+    prices, spots, strikes, times, isCall = np.broadcast_arrays(
+        np.asarray(prices, dtype=np.float64), np.asarray(spots, dtype=np.float64),
+        np.asarray(strikes, dtype=np.float64), np.asarray(times, dtype=np.float64), np.asarray(isCall, dtype=bool))
+    vols = np.full(prices.shape, np.nan)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lower, upper = getBounds(spots, strikes, times, isCall, rate, dividend)
+        valid = (times > 0) & (spots > 0) & (strikes > 0) & (prices > lower) & (prices < upper)
+    active = np.flatnonzero(valid)
+    prices, spots, strikes, times, isCall = (array[active] for array in (prices, spots, strikes, times, isCall))
+
+    if guesses is None:
+        sigma = np.full(len(active), np.nan)
+    else:
+        sigma = np.broadcast_to(np.asarray(guesses, dtype=np.float64), vols.shape)[active].copy()
+    # Brenner-Subrahmanyam, which is exact at the money
+    initial = np.sqrt(2. * np.pi / times) * prices / spots
+    sigma = np.clip(np.where(np.isfinite(sigma), sigma, initial), MIN_VOL, MAX_VOL)
+    low = np.full(len(active), MIN_VOL)
+    high = np.full(len(active), MAX_VOL)
+
+    for _ in range(maxIterations):
+        if len(active) == 0:
+            break
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            diff = getPrices(spots, strikes, times, sigma, isCall, rate, dividend) - prices
+            vega = getVegas(spots, strikes, times, sigma, rate, dividend)
+            # Near zero vega any volatility prices within tolerance, so the volatility error is bounded as well
+            converged = (np.abs(diff) < tolerance) & \
+                ((np.abs(diff) < VOL_TOLERANCE * vega) | (high - low < VOL_TOLERANCE))
+            solved = converged & (vega >= MIN_RELATIVE_VEGA * spots)
+            vols[active[solved]] = sigma[solved]
+
+            # Prices increase with volatility, which moves one side of the bracket
+            low = np.where(diff < 0, sigma, low)
+            high = np.where(diff > 0, sigma, high)
+            step = sigma - diff / vega
+            inside = (step > low) & (step < high)
+            sigma = np.where(inside, step, 0.5 * (low + high))
+
+        remaining = ~converged & (high - low > 1e-12)
+        active, sigma, low, high = active[remaining], sigma[remaining], low[remaining], high[remaining]
+        prices, spots, strikes, times, isCall = (array[remaining] for array in (prices, spots, strikes, times, isCall))
+    return vols
+
+
+def getGreeks(spots, strikes, times, vols, isCall, rate=RISK_FREE_RATE, dividend=0.):
+    """
+    :return: (dict) Arrays of delta, gamma, theta per calendar day and vega per volatility point
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        d1, d2 = getD1D2(spots, strikes, times, vols, rate, dividend)
+        forward = spots * np.exp(-dividend * times)
+        discounted = strikes * np.exp(-rate * times)
+        pdf = getNormPdf(d1)
+        sign = np.where(isCall, 1., -1.)
+        cdf1 = getNormCdf(sign * d1)
+        cdf2 = getNormCdf(sign * d2)
+        theta = -forward * pdf * vols / (2. * np.sqrt(times)) + \
+            sign * (dividend * forward * cdf1 - rate * discounted * cdf2)
+        return {
+            'delta': sign * np.exp(-dividend * times) * cdf1,
+            'gamma': np.exp(-dividend * times) * pdf / (spots * vols * np.sqrt(times)),
+            'theta': theta / DAYS_PER_YEAR,
+            'vega': forward * pdf * np.sqrt(times) / 100.,
+        }
+
+
+def parseOccSymbol(localSymbol):
+    """
+    :param localSymbol: (str) OCC option symbol as IB sends it, e.g. 'AAPL  180119C00150000'
+    :return: (tuple) Underlying symbol, expiry as YYYYMMDD, strike and whether it is a call
+    """
+    underlying, code = localSymbol[:6].strip(), localSymbol[6:]
+    return underlying, '20' + code[:6], int(code[7:15]) / 1000., code[6] == 'C'